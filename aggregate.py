@@ -0,0 +1,34 @@
+import sqlite3
+
+# 月ごとの予算（固定費の上限金額の合計）と使用額の合計をSQLiteの中で集計する
+# 使用額は month_service_totals（item を substr(purchase_date, 1, 7) で集計したもの）から読むので、
+# item の件数が増えてもPythonに渡る行数は「上限金額が記録されている月の数」だけになる
+# 締めた月（archive.py）の固定費はアーカイブに移しているので、上限金額の合計は archived_months から読む
+MONTHLY_UPPER_LIMIT_SELECT = """
+select year_month, sum(upper_limit) as total_upper_limit
+from service group by year_month
+union all
+select year_month, total_upper_limit from archived_months where service_count > 0
+"""
+
+MONTHLY_UPPER_LIMIT_AND_USAGE_QUERY = f"""
+select s.year_month, s.total_upper_limit, coalesce(u.total_usage, 0)
+from ({MONTHLY_UPPER_LIMIT_SELECT}) s
+left join (
+    select year_month, sum(total_usage) as total_usage
+    from month_service_totals group by year_month
+) u on u.year_month = s.year_month
+order by s.year_month
+"""
+
+
+def get_monthly_upper_limit_and_usage(
+    db: sqlite3.Connection,
+) -> tuple[list[str], list[int], list[int]]:
+    # (年月のリスト, 月ごとの上限金額の合計, 月ごとの使用額の合計) を同じ順番の配列で返す
+    # いくら節約できたかを可視化したいので、サービスの上限金額が記録されている月だけ選ぶ
+    rows = db.execute(MONTHLY_UPPER_LIMIT_AND_USAGE_QUERY).fetchall()
+    if not rows:
+        return [], [], []
+    year_month_list, total_upper_limit, total_usage = zip(*rows)
+    return list(year_month_list), list(total_upper_limit), list(total_usage)
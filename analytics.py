@@ -0,0 +1,269 @@
+import bisect
+import datetime
+import re
+import sqlite3
+import threading
+
+from aggregate import MONTHLY_UPPER_LIMIT_SELECT
+from cube import ALL
+from page_cache import ALL_MONTHS, get_month_version
+from util import (
+    add_months,
+    get_month_date_range,
+    get_month_number,
+    get_usage_ratio,
+    get_yyyymm_from_month_number,
+)
+
+# 任意の期間（月単位・日単位）の使用額・上限金額の集計
+# 月ごと・日ごとの合計の累積和（先頭からの合計）を配列で持っておくと、
+# 期間 [from, to] の合計は「toまでの累積和 - fromの前までの累積和」の2回の参照で求まる
+# 配列は記録のある月（日）だけを通し番号の順に並べ、位置は二分探索で求める
+# （記録のない月・日を埋めないので、1900年のような離れた日付が1つあっても配列は大きくならない）
+# 累積和はDBのデータが変わる（全体の版数 ALL_MONTHS が上がる）までプロセスの中で使い回す
+
+YYYYMM_PATTERN = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+
+
+class RangeError(Exception):
+    # 期間の指定が正しくない
+    pass
+
+
+def get_cumulative_sum(value_list: list[int]) -> list[int]:
+    # cumulative_sum[i] は value_list[0] から value_list[i - 1] までの合計（cumulative_sum[0] は0）
+    cumulative_sum = [0]
+    for value in value_list:
+        cumulative_sum.append(cumulative_sum[-1] + value)
+    return cumulative_sum
+
+
+class RangeIndex:
+    def __init__(self, month_usage: dict, month_upper_limit: dict, day_usage: dict):
+        # 月ごとの使用額・上限金額と、日ごとの使用額から累積和の配列を作る
+        # month_number_list・day_ordinal_list は記録のある月・日の通し番号（昇順）で、累積和の配列と同じ順に並ぶ
+        self.month_number_list = sorted(
+            {get_month_number(yyyymm) for yyyymm in [*month_usage, *month_upper_limit]}
+        )
+        yyyymm_list = [get_yyyymm_from_month_number(month_number) for month_number in self.month_number_list]
+        self.month_usage_sum = get_cumulative_sum([month_usage.get(yyyymm, 0) for yyyymm in yyyymm_list])
+        self.month_upper_limit_sum = get_cumulative_sum(
+            [month_upper_limit.get(yyyymm, 0) for yyyymm in yyyymm_list]
+        )
+
+        usage_by_ordinal = {
+            datetime.date.fromisoformat(purchase_date).toordinal(): usage
+            for purchase_date, usage in day_usage.items()
+        }
+        self.day_ordinal_list = sorted(usage_by_ordinal)
+        self.day_usage_sum = get_cumulative_sum(
+            [usage_by_ordinal[ordinal] for ordinal in self.day_ordinal_list]
+        )
+
+    def _get_prefix(self, cumulative_sum: list[int], number_list: list[int], number: int) -> int:
+        # 通し番号numberまで（numberを含む）の累積和。記録より前なら0、後なら全体の合計
+        return cumulative_sum[bisect.bisect_right(number_list, number)]
+
+    def get_month_range_total(self, first_yyyymm: str, last_yyyymm: str) -> tuple[int, int]:
+        # 期間 [first_yyyymm, last_yyyymm] の (使用額, 上限金額) の合計
+        first_number = get_month_number(first_yyyymm)
+        last_number = get_month_number(last_yyyymm)
+        return tuple(
+            self._get_prefix(cumulative_sum, self.month_number_list, last_number)
+            - self._get_prefix(cumulative_sum, self.month_number_list, first_number - 1)
+            for cumulative_sum in [self.month_usage_sum, self.month_upper_limit_sum]
+        )
+
+    def get_day_range_total(self, first_date: datetime.date, last_date: datetime.date) -> int:
+        # 期間 [first_date, last_date] の使用額の合計
+        return self._get_prefix(
+            self.day_usage_sum, self.day_ordinal_list, last_date.toordinal()
+        ) - self._get_prefix(self.day_usage_sum, self.day_ordinal_list, first_date.toordinal() - 1)
+
+
+def is_valid_date(purchase_date: str) -> bool:
+    try:
+        datetime.date.fromisoformat(purchase_date)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
+def build_range_index(db: sqlite3.Connection) -> RangeIndex:
+    # 月ごとの使用額はspending_cubeの合計の行、日ごとの使用額はday_totalsから読む（itemは走査しない）
+    # 購入日の形式が正しくない商品（入力のチェックを入れる前に登録されたものなど）は、期間の集計には含めない
+    month_usage = {
+        year_month: total_usage
+        for year_month, total_usage in db.execute(
+            "select year_month, total_usage from spending_cube "
+            "where service_name = ? and item_attribute = ? and year_month != ?",
+            [ALL, ALL, ALL],
+        ).fetchall()
+        if YYYYMM_PATTERN.match(year_month)
+    }
+    month_upper_limit = {
+        year_month: upper_limit
+        for year_month, upper_limit in db.execute(MONTHLY_UPPER_LIMIT_SELECT).fetchall()
+        if YYYYMM_PATTERN.match(year_month)
+    }
+    day_usage = {
+        purchase_date: total_usage
+        for purchase_date, total_usage in db.execute(
+            "select purchase_date, total_usage from day_totals"
+        ).fetchall()
+        if is_valid_date(purchase_date)
+    }
+    return RangeIndex(month_usage, month_upper_limit, day_usage)
+
+
+class RangeIndexCache:
+    # 世帯ごとに、全体の版数が同じ間は累積和の配列を使い回す
+    def __init__(self):
+        self._range_indexes = {}
+        self._lock = threading.Lock()
+
+    def get(self, db: sqlite3.Connection, key) -> RangeIndex:
+        version = get_month_version(db, ALL_MONTHS)
+        with self._lock:
+            cached = self._range_indexes.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        range_index = build_range_index(db)
+        with self._lock:
+            self._range_indexes[key] = (version, range_index)
+        return range_index
+
+    def clear(self):
+        with self._lock:
+            self._range_indexes.clear()
+
+
+def parse_range(first: str, last: str):
+    # "YYYY-MM" 同士なら月単位、"YYYY-MM-DD" 同士なら日単位の期間にする
+    if YYYYMM_PATTERN.match(first) and YYYYMM_PATTERN.match(last):
+        if first > last:
+            raise RangeError("期間の始まりが終わりより後になっています")
+        return "month", first, last
+    try:
+        first_date = datetime.date.fromisoformat(first)
+        last_date = datetime.date.fromisoformat(last)
+    except ValueError:
+        raise RangeError("期間はYYYY-MMまたはYYYY-MM-DDの形式で、同じ形式で指定してください")
+    if first_date > last_date:
+        raise RangeError("期間の始まりが終わりより後になっています")
+    return "day", first_date, last_date
+
+
+def subtract_one_year(date: datetime.date) -> datetime.date:
+    # 2月29日の1年前は2月28日にする
+    try:
+        return date.replace(year=date.year - 1)
+    except ValueError:
+        return date.replace(year=date.year - 1, day=28)
+
+
+def _get_range_summary(range_index: RangeIndex, unit: str, first, last) -> dict:
+    if unit == "month":
+        usage, upper_limit = range_index.get_month_range_total(first, last)
+        length = get_month_number(last) - get_month_number(first) + 1
+        return {
+            "from": first,
+            "to": last,
+            "months": length,
+            "total_usage": usage,
+            "total_upper_limit": upper_limit,
+            "saved": upper_limit - usage,
+            "usage_ratio": get_usage_ratio(usage, upper_limit),
+            "average_usage": round(usage / length, 1),
+            "average_upper_limit": round(upper_limit / length, 1),
+        }
+    # 上限金額は月ごとに決めているので、日単位の期間では使用額だけを返す
+    usage = range_index.get_day_range_total(first, last)
+    length = (last - first).days + 1
+    return {
+        "from": first.isoformat(),
+        "to": last.isoformat(),
+        "days": length,
+        "total_usage": usage,
+        "average_usage": round(usage / length, 1),
+    }
+
+
+def get_range_summary(range_index: RangeIndex, first: str, last: str) -> dict:
+    # 期間の合計・平均・上限金額との比較と、前年の同じ期間との比較を返す
+    unit, first, last = parse_range(first, last)
+    summary = _get_range_summary(range_index, unit, first, last)
+    if unit == "month":
+        previous_summary = _get_range_summary(
+            range_index,
+            unit,
+            add_months(first, -12),
+            add_months(last, -12),
+        )
+    else:
+        previous_summary = _get_range_summary(
+            range_index, unit, subtract_one_year(first), subtract_one_year(last)
+        )
+    summary["previous_year"] = previous_summary
+    summary["year_over_year"] = {
+        "difference": summary["total_usage"] - previous_summary["total_usage"],
+        "ratio": get_usage_ratio(summary["total_usage"], previous_summary["total_usage"]),
+    }
+    return summary
+
+
+def get_month_range_dates(first_yyyymm: str, last_yyyymm: str) -> tuple[datetime.date, datetime.date]:
+    # 月単位の期間を、最初の月の1日から最後の月の末日までの日付にする
+    return (
+        datetime.date.fromisoformat(first_yyyymm + "-01"),
+        datetime.date.fromisoformat(get_month_date_range(last_yyyymm)[1]) - datetime.timedelta(days=1),
+    )
+
+
+def _get_filtered_range_summary(snapshot, unit: str, first, last, service_name: str, item_attribute: str) -> dict:
+    if unit == "month":
+        totals = snapshot.aggregate(*get_month_range_dates(first, last), service_name, item_attribute)
+        length = get_month_number(last) - get_month_number(first) + 1
+        summary = {"from": first, "to": last, "months": length}
+    else:
+        totals = snapshot.aggregate(first, last, service_name, item_attribute)
+        length = (last - first).days + 1
+        summary = {"from": first.isoformat(), "to": last.isoformat(), "days": length}
+    usage_by_service = {}
+    usage_by_attribute = {}
+    for (total_service_name, total_item_attribute), (usage, _) in totals.items():
+        usage_by_service[total_service_name] = usage_by_service.get(total_service_name, 0) + usage
+        usage_by_attribute[total_item_attribute] = usage_by_attribute.get(total_item_attribute, 0) + usage
+    usage = sum(usage_by_service.values())
+    summary.update(
+        total_usage=usage,
+        item_count=sum(count for _, count in totals.values()),
+        average_usage=round(usage / length, 1),
+        services=usage_by_service,
+        item_attributes=usage_by_attribute,
+    )
+    return summary
+
+
+def get_filtered_range_summary(
+    snapshot, first: str, last: str, service_name: str = ALL, item_attribute: str = ALL
+) -> dict:
+    # 固定費・購入者で絞り込んだ期間の集計（snapshot.py の列ごとのスナップショットから求める）
+    # 上限金額は固定費ごと・月ごとにしか決まっていないので、絞り込んだときは使用額と件数だけを返す
+    unit, first, last = parse_range(first, last)
+    summary = _get_filtered_range_summary(snapshot, unit, first, last, service_name, item_attribute)
+    if unit == "month":
+        previous_first, previous_last = add_months(first, -12), add_months(last, -12)
+    else:
+        previous_first, previous_last = subtract_one_year(first), subtract_one_year(last)
+    previous_summary = _get_filtered_range_summary(
+        snapshot, unit, previous_first, previous_last, service_name, item_attribute
+    )
+    summary["service_name"] = service_name
+    summary["item_attribute"] = item_attribute
+    summary["previous_year"] = previous_summary
+    summary["year_over_year"] = {
+        "difference": summary["total_usage"] - previous_summary["total_usage"],
+        "ratio": get_usage_ratio(summary["total_usage"], previous_summary["total_usage"]),
+    }
+    return summary
@@ -0,0 +1,368 @@
+import base64
+import contextlib
+import datetime
+import itertools
+import re
+import sqlite3
+
+from aggregate import get_monthly_upper_limit_and_usage
+from analytics import RangeError, RangeIndex, get_filtered_range_summary, get_range_summary
+from archive import open_month, read_ledger
+from changes import ChangeLogExpiredError, get_changes
+from config import ITEM_ATTRIBUTE_LIST
+from cube import ALL, get_spending_cube
+from rollup import get_month_service_totals
+from search import get_item_name_suggestions, search_items
+from snapshot import LedgerSnapshot
+from util import ITEM_COLUMN_LIST, get_month_date_range, get_usage_ratio, validate_item_row
+
+# JSON APIの処理（ルーティングはapp.pyの /api/v1/ 以下）
+
+API_DEFAULT_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+ITEM_BATCH_ACTION_LIST = ["delete", "move"]
+# 差分同期（/api/v1/changes）は1回で多くの行を返せるようにする
+API_DEFAULT_CHANGES_PAGE_SIZE = 1000
+API_MAX_CHANGES_PAGE_SIZE = 5000
+API_MAX_UPLOAD_CHANGES = 1000
+
+ITEM_FIELD_LIST = [
+    "item_id",
+    "purchase_date",
+    "service_name",
+    "item_name",
+    "item_price",
+    "item_attribute",
+]
+
+YYYYMM_PATTERN = re.compile(r"^\d{4}-(0[1-9]|1[0-2])$")
+YEAR_PATTERN = re.compile(r"^\d{4}$")
+
+# /api/v1/spending のパラメーター名と spending_cube の列の対応
+SPENDING_DIMENSIONS = {
+    "month": "year_month",
+    "service": "service_name",
+    "attribute": "item_attribute",
+}
+
+
+class ApiError(Exception):
+    # APIの入力が正しくない場合のエラー。status_codeがそのままレスポンスのステータスになる
+    def __init__(self, message: str, status_code: int = 400):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+
+def validate_yyyymm(yyyymm: str) -> str:
+    if not YYYYMM_PATTERN.match(yyyymm):
+        raise ApiError(f"年月はYYYY-MMの形式で指定してください：{yyyymm}")
+    return yyyymm
+
+
+def get_month_services(db: sqlite3.Connection, yyyymm: str) -> list:
+    # 締めた月の固定費はアーカイブから読む（archive.py）
+    with open_month(db, yyyymm) as schema:
+        return db.execute(
+            f"select service_name, upper_limit from {schema}.service where year_month = ? order by service_id",
+            [yyyymm],
+        ).fetchall()
+
+
+def get_month_summary(db: sqlite3.Connection, yyyymm: str) -> dict:
+    # その月の固定費ごとの上限金額・使用額と、その合計
+    validate_yyyymm(yyyymm)
+    month_service_totals = get_month_service_totals(db, yyyymm)
+    service_list = [
+        {
+            "service_name": service["service_name"],
+            "upper_limit": service["upper_limit"],
+            "current_usage": month_service_totals.get(service["service_name"], 0),
+            "usage_ratio": get_usage_ratio(
+                month_service_totals.get(service["service_name"], 0),
+                service["upper_limit"],
+            ),
+        }
+        for service in get_month_services(db, yyyymm)
+    ]
+    total_upper_limit = sum(service["upper_limit"] for service in service_list)
+    # トップ画面と同じく、その月に登録されている固定費の使用額だけを合計する
+    total_usage = sum(service["current_usage"] for service in service_list)
+    return {
+        "year_month": yyyymm,
+        "total_upper_limit": total_upper_limit,
+        "total_usage": total_usage,
+        "usage_ratio": get_usage_ratio(total_usage, total_upper_limit),
+        "services": service_list,
+    }
+
+
+def get_history(db: sqlite3.Connection) -> dict:
+    # 履歴画面と同じ月ごとの上限金額・使用額を、同じ順番の配列で返す
+    year_month_list, total_upper_limit, total_usage = get_monthly_upper_limit_and_usage(db)
+    return {
+        "year_months": year_month_list,
+        "total_upper_limit": total_upper_limit,
+        "total_usage": total_usage,
+    }
+
+
+def encode_cursor(purchase_date: str, item_id: int) -> str:
+    # 最後に返した商品の (購入日, item_id) を、URLにそのまま入れられる文字列にする
+    return base64.urlsafe_b64encode(f"{purchase_date}|{item_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        purchase_date, item_id = (
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split("|")
+        )
+        # 書き換えられたcursorで、関係のない年のアーカイブまで開かないよう、購入日の形式も確かめる
+        datetime.date.fromisoformat(purchase_date)
+        return purchase_date, int(item_id)
+    except ValueError:
+        raise ApiError("cursorが正しくありません")
+
+
+def parse_fields(fields: str) -> list[str]:
+    # ?fields=item_name,item_price のように返す項目を選べる（指定がなければ全項目）
+    if not fields:
+        return ITEM_FIELD_LIST
+    field_list = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown_field_list = [field for field in field_list if field not in ITEM_FIELD_LIST]
+    if unknown_field_list:
+        raise ApiError(f"存在しない項目です：{', '.join(unknown_field_list)}")
+    return field_list
+
+
+def parse_limit(limit: str) -> int:
+    if not limit:
+        return API_DEFAULT_PAGE_SIZE
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ApiError("limitは数値で指定してください")
+    return min(max(limit, 1), API_MAX_PAGE_SIZE)
+
+
+def get_service_items(
+    db: sqlite3.Connection,
+    service_name: str,
+    yyyymm: str = "",
+    fields: str = "",
+    limit: str = "",
+    cursor: str = "",
+) -> dict:
+    # 固定費の商品を (購入日, item_id) の順に limit 件ずつ返す
+    # OFFSETを使わず、前のページの最後の (購入日, item_id) より後ろから読む（キーセットページネーション）
+    # idx_item_service_name_purchase_date を使うので、何ページ目でも読む行数は limit 件だけ
+    field_list = parse_fields(fields)
+    limit = parse_limit(limit)
+    condition_list = ["service_name = ?"]
+    parameters = [service_name]
+    if yyyymm:
+        validate_yyyymm(yyyymm)
+        condition_list.append("purchase_date >= ? and purchase_date < ?")
+        parameters.extend(get_month_date_range(yyyymm))
+    if cursor:
+        condition_list.append("(purchase_date, item_id) > (?, ?)")
+        parameters.extend(decode_cursor(cursor))
+    # 次のページのcursorを作るために、購入日とitem_idは必ず読む
+    # 締めた月の商品はアーカイブから読む（cursorより前の年のアーカイブは開かない）
+    statement = "select purchase_date, item_id, {} from {{schema}}.item where {} order by purchase_date, item_id limit ?".format(
+        ", ".join(field_list), " and ".join(condition_list)
+    )
+    first_yyyymm = yyyymm or (parameters[-2][:7] if cursor else "")
+    with contextlib.closing(
+        read_ledger(db, statement, parameters + [limit + 1], first_yyyymm, yyyymm)
+    ) as row_iter:
+        row_list = list(itertools.islice(row_iter, limit + 1))
+    next_cursor = None
+    if len(row_list) > limit:
+        row_list = row_list[:limit]
+        next_cursor = encode_cursor(row_list[-1][0], row_list[-1][1])
+    return {
+        "fields": field_list,
+        "items": [list(row)[2:] for row in row_list],
+        "next_cursor": next_cursor,
+    }
+
+
+def parse_item_batch(body) -> tuple[str, list[int], str]:
+    # POST /api/v1/items/batch の本文を (action, item_idのリスト, 変更先の固定費名) にする
+    if not isinstance(body, dict):
+        raise ApiError("JSONの本文を送ってください")
+    action = body.get("action", "")
+    if action not in ITEM_BATCH_ACTION_LIST:
+        raise ApiError(f"actionは{'・'.join(ITEM_BATCH_ACTION_LIST)}のどれかにしてください")
+    item_id_list = body.get("item_ids")
+    if (
+        not isinstance(item_id_list, list)
+        or not item_id_list
+        or not all(type(item_id) is int for item_id in item_id_list)
+    ):
+        raise ApiError("item_idsは商品のidの配列で指定してください")
+    service_name = body.get("service_name", "")
+    if action == "move" and (not isinstance(service_name, str) or not service_name):
+        raise ApiError("moveではservice_nameを指定してください")
+    return action, item_id_list, service_name
+
+
+def get_spending(
+    db: sqlite3.Connection,
+    filters: dict,
+    group_by: str = "",
+    year: str = "",
+) -> dict:
+    # filtersは {"month": "2024-06", "attribute": "夫"} のように次元の値で絞り込む（指定しない次元は合計の"*"）
+    # group_byに書いた次元は値ごとに返す（その次元の合計は"*"の行になる）
+    group_by_list = [dimension.strip() for dimension in group_by.split(",") if dimension.strip()]
+    unknown_dimension_list = [
+        dimension for dimension in group_by_list + list(filters) if dimension not in SPENDING_DIMENSIONS
+    ]
+    if unknown_dimension_list:
+        raise ApiError(f"存在しない次元です：{', '.join(unknown_dimension_list)}")
+    dimension_values = {}
+    for dimension, column in SPENDING_DIMENSIONS.items():
+        value = filters.get(dimension, "")
+        if value and dimension in group_by_list:
+            raise ApiError(f"{dimension}は絞り込みとgroup_byの両方には指定できません")
+        if dimension in group_by_list:
+            dimension_values[column] = None
+        else:
+            dimension_values[column] = value or ALL
+    if dimension_values["year_month"] not in (None, ALL):
+        validate_yyyymm(dimension_values["year_month"])
+    if dimension_values["item_attribute"] not in (None, ALL, *ITEM_ATTRIBUTE_LIST):
+        raise ApiError(f"購入者は{'・'.join(ITEM_ATTRIBUTE_LIST)}のどれかにしてください")
+    if year:
+        if not YEAR_PATTERN.match(year):
+            raise ApiError(f"年はYYYYの形式で指定してください：{year}")
+        if dimension_values["year_month"] is not None:
+            raise ApiError("yearはgroup_byにmonthを指定したときだけ使えます")
+    return {
+        "group_by": group_by_list,
+        "cells": get_spending_cube(db, year=year, **dimension_values),
+    }
+
+
+def get_range(range_index: RangeIndex, first: str, last: str) -> dict:
+    # ?from=2024-01&to=2024-06 のような期間の集計（analytics.py）
+    if not first or not last:
+        raise ApiError("fromとtoを指定してください")
+    try:
+        return get_range_summary(range_index, first, last)
+    except RangeError as e:
+        raise ApiError(str(e))
+
+
+def get_filtered_range(
+    snapshot: LedgerSnapshot, first: str, last: str, service_name: str, item_attribute: str
+) -> dict:
+    # ?from=&to=&service=固定費名&attribute=購入者 のように絞り込んだ期間の集計（snapshot.py）
+    if not first or not last:
+        raise ApiError("fromとtoを指定してください")
+    if item_attribute and item_attribute not in ITEM_ATTRIBUTE_LIST:
+        raise ApiError(f"購入者は{'・'.join(ITEM_ATTRIBUTE_LIST)}のどれかにしてください")
+    try:
+        return get_filtered_range_summary(
+            snapshot, first, last, service_name or ALL, item_attribute or ALL
+        )
+    except RangeError as e:
+        raise ApiError(str(e))
+
+
+def get_search_results(
+    db: sqlite3.Connection,
+    query: str,
+    yyyymm: str = "",
+    service_name: str = "",
+    item_attribute: str = "",
+    limit: str = "",
+    cursor: str = "",
+) -> dict:
+    # 商品名・固定費名で検索し、新しい順に limit 件ずつ返す（月・固定費・購入者で絞り込める）
+    if not query.strip():
+        raise ApiError("検索する語を入力してください")
+    if yyyymm:
+        validate_yyyymm(yyyymm)
+    if item_attribute and item_attribute not in ITEM_ATTRIBUTE_LIST:
+        raise ApiError(f"購入者は{'・'.join(ITEM_ATTRIBUTE_LIST)}のどれかにしてください")
+    row_list, has_next_page = search_items(
+        db,
+        query,
+        yyyymm=yyyymm,
+        service_name=service_name,
+        item_attribute=item_attribute,
+        limit=parse_limit(limit),
+        cursor=decode_cursor(cursor) if cursor else None,
+    )
+    return {
+        "items": [{field: row[field] for field in ITEM_FIELD_LIST} for row in row_list],
+        "next_cursor": (
+            encode_cursor(row_list[-1]["purchase_date"], row_list[-1]["item_id"])
+            if has_next_page
+            else None
+        ),
+    }
+
+
+def get_autocomplete(db: sqlite3.Connection, prefix: str) -> dict:
+    return {"suggestions": get_item_name_suggestions(db, prefix.strip())}
+
+
+def get_change_list(db: sqlite3.Connection, since: str = "", limit: str = "") -> dict:
+    # ?since=最後に受け取った版数&limit= でそれより後の変更を返す（changes.py）
+    # has_moreがtrueなら、返したversionをsinceにして続きを取る
+    try:
+        since = int(since or 0)
+        limit = int(limit or API_DEFAULT_CHANGES_PAGE_SIZE)
+    except ValueError:
+        raise ApiError("sinceとlimitは数値で指定してください")
+    if since < 0:
+        raise ApiError("sinceは0以上にしてください")
+    try:
+        change_list, version, has_more = get_changes(
+            db, since, min(max(limit, 1), API_MAX_CHANGES_PAGE_SIZE)
+        )
+    except ChangeLogExpiredError as e:
+        raise ApiError(str(e), 410)
+    return {"version": version, "has_more": has_more, "changes": change_list}
+
+
+def parse_item_changes(body) -> list[dict]:
+    # POST /api/v1/changes の本文（オフラインの間に溜めた商品の変更）を検証する
+    # {"changes": [{"entity": "item", "operation": "upsert", "id": null, "data": {...}}, {"entity": "item", "operation": "delete", "id": 1}]}
+    # idがnullのupsertは新しい商品の登録になる
+    if not isinstance(body, dict) or not isinstance(body.get("changes"), list) or not body["changes"]:
+        raise ApiError("changesに変更の配列を指定してください")
+    if len(body["changes"]) > API_MAX_UPLOAD_CHANGES:
+        raise ApiError(f"1回に送れる変更は{API_MAX_UPLOAD_CHANGES}件までです")
+    change_list = []
+    for number, change in enumerate(body["changes"], start=1):
+        if not isinstance(change, dict) or change.get("entity") != "item":
+            raise ApiError(f"{number}番目：送れるのは商品（entityがitem）の変更だけです")
+        item_id = change.get("id")
+        if item_id is not None and type(item_id) is not int:
+            raise ApiError(f"{number}番目：idは商品のidで指定してください")
+        if change.get("operation") == "delete":
+            if item_id is None:
+                raise ApiError(f"{number}番目：deleteではidを指定してください")
+            change_list.append({"operation": "delete", "id": item_id, "data": None})
+            continue
+        if change.get("operation") != "upsert" or not isinstance(change.get("data"), dict):
+            raise ApiError(f"{number}番目：operationはupsertかdeleteにし、upsertではdataを指定してください")
+        item = {}
+        for column in ITEM_COLUMN_LIST:
+            # nullは入力がないものとして扱う（"None"という文字列にしない）。配列・オブジェクト・真偽値は受け付けない
+            value = change["data"].get(column)
+            if value is None:
+                value = ""
+            elif isinstance(value, bool) or not isinstance(value, (str, int, float)):
+                raise ApiError(f"{number}番目：{column}は文字列か数値で指定してください")
+            item[column] = str(value).strip()
+        error_message = validate_item_row(item)
+        if error_message:
+            raise ApiError(f"{number}番目：{error_message}")
+        change_list.append({"operation": "upsert", "id": item_id, "data": item})
+    return change_list
@@ -1,61 +1,322 @@
-from flask import Flask, render_template, request, redirect, g
+from flask import (
+    Blueprint,
+    Flask,
+    before_render_template,
+    current_app,
+    template_rendered,
+    Response,
+    abort,
+    render_template,
+    request,
+    redirect,
+    g,
+    jsonify,
+    make_response,
+    send_file,
+    stream_with_context,
+)
+import functools
+import os
+import queue
 import sqlite3
-
-from config import DATABASE, ITEM_ATTRIBUTE_LIST
+import time
+from urllib.parse import quote
+
+from database import apply_pragmas
+from analytics import RangeError, RangeIndexCache, get_range_summary
+from archive import is_archived_month, open_month
+from assets import (
+    ASSET_DIST_DIRECTORY,
+    choose_asset_encoding,
+    get_asset_mimetype,
+    load_asset_manifest,
+)
+from api import (
+    ApiError,
+    get_autocomplete,
+    get_change_list,
+    get_filtered_range,
+    get_history,
+    get_month_summary,
+    get_range,
+    get_search_results,
+    get_service_items,
+    get_spending,
+    parse_item_batch,
+    parse_item_changes,
+)
+from cube import ALL, get_spending_table
+from exporter import (
+    HISTORY_EXPORT_COLUMN_LIST,
+    ITEM_EXPORT_COLUMN_LIST,
+    iter_csv,
+    iter_gzip,
+    iter_history_rows,
+    iter_item_rows,
+    iter_json,
+)
+from events import LiveEventLimitError
+from households import HouseholdRouter, UnknownHouseholdError
+from importer import ImportFormatError, insert_items, iter_rows
+from metrics import (
+    InstrumentedConnection,
+    MetricsRegistry,
+    RequestProfiler,
+    RequestTrace,
+    current_request_trace,
+)
+from page_cache import (
+    ALL_MONTHS,
+    CachedPage,
+    PageCache,
+    get_month_version,
+    make_etag,
+)
+from rollover import copy_services_to_new_month
+from schema import migrate
+from snapshot import SnapshotCache
+import operations
+from rollup import get_month_service_totals
+from config import DATABASE, DEFAULT_HOUSEHOLD, ITEM_ATTRIBUTE_LIST
 from util import (
     get_current_yyyymm,
-    is_there_empty_entry,
+    get_month_date_range,
+    get_previous_yyyymm,
     get_total_usage_info,
+    get_usage_ratio,
     add_usage_info_to_service_detail,
+    format_usage_ratio,
+    ITEM_COLUMN_LIST,
+    validate_item_row,
 )
 
-app = Flask(__name__)
+# 画面・APIはBlueprintに登録しておき、create_appで作ったアプリに取り付ける
+# importしただけではアプリもDBとの接続も作らないので、複数のワーカーで動かすときはワーカーごとにcreate_appを呼ぶ
+bp = Blueprint("kakeibo", __name__)
 
 # データベースとの接続を確立する部分
 # rvに接続を格納する
 # row_factoryにsqlite3.Rowを設定することで、SELECTを使って返るものがタプルではなくsqlite3.Rowオブジェクト（辞書のようなもの）になる
 # そのため、ret.idやret.title、ret.bodyといった形でメモの中身にアクセスすることができるようになる
 # https://stackoverflow.com/questions/44009452/what-is-the-purpose-of-the-row-factory-method-of-an-sqlite3-connection-object
-def connect_db(): 
-    rv = sqlite3.connect(DATABASE) 
+# 接続ごとに1回だけ、WALモードなどのPRAGMAを設定する（database.py）
+# check_same_thread=Falseにしているのは、プールに戻した接続を別のスレッドのリクエストで使い回すため
+# InstrumentedConnectionは、リクエスト中に実行したSQLの時間と行数を記録する（metrics.py）
+def connect_db(database=DATABASE): 
+    rv = sqlite3.connect(database, check_same_thread=False, factory=InstrumentedConnection) 
     rv.row_factory = sqlite3.Row
+    apply_pragmas(rv)
     return rv
 
+# アプリごとの状態（世帯ごとのプール・画面のキャッシュ・計測）はcreate_appで作り、app.extensionsに置く
+def get_app_state():
+    return current_app.extensions["kakeibo"]
+
+# 接続はリクエストごとに作らず、世帯ごとのプールから借りて使い回す（households.py）
+def get_router():
+    return get_app_state()["router"]
+
+# 世帯IDはリバースプロキシが付けるヘッダーで受け取る。ヘッダーがなければこれまで通りのDBを使う
+def get_household_id():
+    return request.headers.get(current_app.config["HOUSEHOLD_HEADER"], DEFAULT_HOUSEHOLD)
+
+@bp.app_errorhandler(UnknownHouseholdError)
+def handle_unknown_household(e):
+    return str(e), 404
+
 # gオブジェクトはグローバル変数で、DBのデータを保存するために使われる
 # gオブジェクトは、1回のリクエスト（ユーザーがWebページからFlaskアプリへ要求すること）ごとに個別なものになる
 # gオブジェクトは、リクエストの（処理）期間中は複数の関数によってアクセスされるようなデータを格納するために使われる
 # DBとの接続はgオブジェクトに格納されて、もしも同じリクエストの中でget_dbが2回呼び出された場合、新しい接続を作成する代わりに、再利用される
 def get_db():
-    # gオブジェクトはグローバル変数で、DBのデータを保存するために使われる
-    # gオブジェクトは、1回のリクエスト（ユーザーがWebページからFlaskアプリへ要求すること）ごとに個別なものになる
-    # gオブジェクトは、リクエストの（処理）期間中は複数の関数によってアクセスされるようなデータを格納するために使われる
-    # DBとの接続はgオブジェクトに格納されて、もしも同じリクエストの中でget_dbが2回呼び出された場合、新しい接続を作成する代わりに、再利用される
-    # もしgが"sqlite_db"属性でない＝まだDBに接続していないようなら、データベースと接続する
+    # もしgが"sqlite_db"属性でない＝まだDBに接続していないようなら、その世帯のプールから接続を借りる
     if not hasattr(g, "sqlite_db"):  
-        g.sqlite_db = connect_db()
+        g.sqlite_pool = get_router().get_pool(get_household_id())
+        g.sqlite_db = g.sqlite_pool.acquire()
     # これで一時的にDBとの接続を保存する。これに対してSQL文を投げる
     return g.sqlite_db  
 
+# 書き込みはリクエストの接続では行わず、世帯ごとの書き込み用のスレッドに渡す（writer.py・operations.py）
+def get_writer():
+    return get_router().get_writer(get_household_id())
+
+# リクエストが終わったら、借りた接続をプールに返す（コミットされていない変更は取り消される）
+@bp.teardown_app_request
+def release_db(exception):
+    sqlite_db = g.pop("sqlite_db", None)
+    if sqlite_db is not None:
+        g.pop("sqlite_pool").release(sqlite_db)
+
+# プールの状態（世帯ごとの接続数・待ち時間・貸し出し回数）を返す
+@bp.route("/health")
+def show_health():
+    db = get_db()
+    db.execute("select 1").fetchone()
+    return jsonify(
+        status="ok",
+        households=get_router().stats(),
+        page_cache=get_app_state()["page_cache"].stats(),
+        snapshots=get_app_state()["snapshots"].stats(),
+    )
+
+# ここからリクエストごとの計測（metrics.py）
+# 処理全体・SQL・テンプレートの描画にかかった時間を画面ごとに集計し、/metricsで返す
+@bp.before_app_request
+def start_request_trace():
+    g.request_trace = RequestTrace(request.endpoint or "unknown")
+    g.request_trace_token = current_request_trace.set(g.request_trace)
+    # KAKEIBO_PROFILING=1のときだけ、?profile=cprofile / ?profile=sample でプロファイルを取る
+    profile_mode = request.args.get("profile", "")
+    if current_app.config["PROFILING_ENABLED"] and profile_mode in ("cprofile", "sample"):
+        g.request_profiler = RequestProfiler(profile_mode)
+        g.request_profiler.start()
+
+@bp.after_app_request
+def finish_request_trace(response):
+    request_trace = g.pop("request_trace", None)
+    if request_trace is None:
+        return response
+    request_profiler = g.pop("request_profiler", None)
+    if request_profiler is not None:
+        response.headers["X-Profile-Path"] = request_profiler.stop(request_trace.endpoint)
+    get_app_state()["metrics"].record(request_trace, response.status_code)
+    current_request_trace.reset(g.pop("request_trace_token"))
+    return response
+
+# テンプレートのシグナルはcreate_appでアプリごとに登録する
+def start_template_timer(sender, template, context, **extra):
+    request_trace = current_request_trace.get()
+    if request_trace is not None:
+        request_trace.template_started_at = time.perf_counter()
+
+def stop_template_timer(sender, template, context, **extra):
+    request_trace = current_request_trace.get()
+    if request_trace is not None and request_trace.template_started_at is not None:
+        request_trace.template_time += time.perf_counter() - request_trace.template_started_at
+        request_trace.template_started_at = None
+
+@bp.route("/metrics")
+def show_metrics():
+    return Response(get_app_state()["metrics"].render(), mimetype="text/plain; version=0.0.4")
+
+# ここから静的ファイル（assets.py で static/dist に作ったもの）
+# テンプレートでは {{ asset_url("app.css") }} のように、バンドル名からハッシュ付きのURLを作る
+@bp.app_template_global()
+def asset_url(bundle_name):
+    return "/assets/" + get_app_state()["asset_manifest"]["bundles"][bundle_name]
+
+# ファイル名に内容のハッシュが付いているので、内容が変わればURLも変わる。ブラウザには1年間確認せずに使わせる
+# 圧縮版は前もって作ってあるので、Accept-Encodingを見てbrotli・gzip・圧縮なしのどれかのファイルを返すだけ
+@bp.route("/assets/<filename>")
+def send_asset(filename):
+    encoding_list = get_app_state()["asset_manifest"]["files"].get(filename)
+    # manifestにないファイル名は返さない（static/dist の外のファイルも読めない）
+    if encoding_list is None:
+        abort(404)
+    encoding = choose_asset_encoding(encoding_list, request.accept_encodings)
+    path = os.path.join(ASSET_DIST_DIRECTORY, filename)
+    if encoding:
+        path += {"br": ".br", "gzip": ".gz"}[encoding]
+    response = send_file(
+        path,
+        mimetype=get_asset_mimetype(filename),
+        download_name=filename,
+        conditional=True,
+        max_age=current_app.config["ASSET_MAX_AGE"],
+    )
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    response.cache_control.immutable = True
+    return response
+
+# 固定費を読まないエンドポイント（死活監視・メトリクス・静的ファイル・ライブ更新）では、固定費のコピーをしない
+ROLL_OVER_SKIPPED_ENDPOINTS = {
+    "static",
+    "kakeibo.show_health",
+    "kakeibo.show_metrics",
+    "kakeibo.send_asset",
+    "kakeibo.stream_live_events",
+}
+
+# 月が変わって最初のリクエストのときだけ、前の月の固定費を新しい月にコピーする
+# コピーは他の書き込みと同じく書き込み用のキューで行う（読み込み用の接続では書き込まない）
+# コピーが済んだ月は世帯ごとにプロセスの中で覚えておき、2回目以降のリクエストでは何もしない
+@bp.before_app_request
+def roll_over_services_for_new_month():
+    if request.endpoint is None or request.endpoint in ROLL_OVER_SKIPPED_ENDPOINTS:
+        return
+    household_id = get_household_id()
+    yyyymm = get_current_yyyymm()
+    rolled_over_yyyymm = get_app_state()["rolled_over_yyyymm"]
+    if rolled_over_yyyymm.get(household_id) != yyyymm:
+        get_writer().submit(copy_services_to_new_month, yyyymm)
+        rolled_over_yyyymm[household_id] = yyyymm
+
+# 期間の集計に使う累積和（analytics.py）。データが変わるまで世帯ごとに使い回す
+def get_range_index():
+    return get_app_state()["range_indexes"].get(get_db(), get_household_id())
+
+# 固定費・購入者で絞り込んだ集計に使う、商品の列ごとのスナップショット（snapshot.py）
+def get_snapshot():
+    return get_app_state()["snapshots"].get(get_db(), get_household_id())
+
+# 描画済みの画面をキャッシュする
+# 画面ごとに「どの月のデータを表示しているか」を決めておき、その月の版数が変わるまでは保存した画面を返す
+# 固定費・商品を書き換える処理では、bump_month_versionsで書き換えた月の版数を上げること
+def cached_page(get_year_month):
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != "GET":
+                return view(*args, **kwargs)
+            year_month = get_year_month(kwargs)
+            version = get_month_version(get_db(), year_month)
+            # 世帯ごとに別のページになるので、キーには世帯IDも含める
+            # トップ画面など今月を表示する画面は、月が変わると同じURLで別の月になるので、キーには表示する月も含める
+            # （新しい月の版数が、前の月の画面を保存したときの版数と同じになることがある）
+            key = (get_household_id(), year_month, request.full_path)
+            page_cache = get_app_state()["page_cache"]
+            page = page_cache.get(key, version)
+            if page is None:
+                response = make_response(view(*args, **kwargs))
+                # リダイレクトやエラーはキャッシュしない
+                if response.status_code != 200:
+                    return response
+                body = response.get_data()
+                page = CachedPage(version, make_etag(body), body, response.mimetype)
+                page_cache.put(key, page)
+            response = make_response(page.body)
+            response.mimetype = page.mimetype
+            response.set_etag(page.etag)
+            # ブラウザには毎回確認させ、内容が変わっていなければ304を返す
+            response.cache_control.no_cache = True
+            return response.make_conditional(request)
+
+        return wrapper
+
+    return decorator
+
 # トップ画面を表示
-@app.route("/")
+@bp.route("/")
+@cached_page(lambda view_args: get_current_yyyymm())
 def top():  
     yyyymm = get_current_yyyymm()
     # 接続を確立
     db = get_db() 
     service_detail_list = db.execute( 
-        "select * from service where year_month = ?", [yyyymm]
+        "select * from service where year_month = ? order by service_id", [yyyymm]
     ).fetchall() 
 
     if service_detail_list != []: 
-        item_detail_list = db.execute(
-            "select * from item where purchase_date like ?", [yyyymm + "%"]
-        ).fetchall() 
+        # 固定費ごとの使用額は集計テーブルから読む（商品の件数によらず固定費の数だけの行になる）
+        month_service_totals = get_month_service_totals(db, yyyymm)
         expense_for_each_service = {
-            service_detail["service_name"]: 0 for service_detail in service_detail_list
+            service_detail["service_name"]: month_service_totals.get(
+                service_detail["service_name"], 0
+            )
+            for service_detail in service_detail_list
         }
-        for item in item_detail_list:
-            if item["service_name"] in expense_for_each_service:
-                expense_for_each_service[item["service_name"]] += item["item_price"]
 
         service_detail_list_with_each_data = []
         for service_detail in service_detail_list:
@@ -68,9 +329,10 @@ def top():
         total_upper_limit = sum(
             [service_detail["upper_limit"] for service_detail in service_detail_list]
         )
-        total_usage_ratio = round((total_current_usage * 100 / total_upper_limit), 1)
-        text_style_total_usage_ratio = f"width:{total_usage_ratio}%"
-        total_usage_ratio_with_percent = f"{total_usage_ratio}%"
+        # 上限金額が全て0の月でも表示できるように、使用率はget_usage_ratioで求める
+        text_style_total_usage_ratio, total_usage_ratio_with_percent = format_usage_ratio(
+            get_usage_ratio(total_current_usage, total_upper_limit)
+        )
 
         return render_template(
             "index.html",
@@ -83,68 +345,26 @@ def top():
             service_detail_list=service_detail_list_with_each_data,
         )
     else:
-        is_service_exist = db.execute("select * from service").fetchone()
-        if is_service_exist != None:
-            newest_service = db.execute(
-                "select * from service where service_id = (select max(service_id) from service)"
-            ).fetchone()
-            most_recent_day_recorded = newest_service["year_month"]
-            service_detail_list = db.execute( 
-                "select * from service where year_month = ?", [most_recent_day_recorded]
-            )
-            service_detail_list_with_each_data = []
-            for service_detail in service_detail_list:
-                service_detail_dict = add_usage_info_to_service_detail(
-                    service_detail=service_detail, current_usage=0
-                )
-                service_detail_list_with_each_data.append(service_detail_dict)
-
-                db.execute( 
-                    "insert into service (year_month, service_name, upper_limit) values (?, ?, ?)",
-                    [
-                        yyyymm,
-                        service_detail_dict["service_name"],
-                        service_detail_dict["upper_limit"],
-                    ],
-                )
-                db.commit()
-            total_upper_limit = sum(
-                [
-                    service_detail["upper_limit"]
-                    for service_detail in service_detail_list_with_each_data
-                ]
-            )
-
-            return render_template(
-                "index.html",
-                year=yyyymm[:4],
-                month=yyyymm[5:],
-                total_upper_limit=total_upper_limit,
-                total_current_usage=0,
-                text_style_total_usage_ratio=f"width:{0}%",
-                total_usage_ratio_with_percent=f"{0}%",
-                service_detail_list=service_detail_list_with_each_data,
-            )
-        else:
-            return render_template(
-                "index.html",
-                year=yyyymm[:4],
-                month=yyyymm[5:],
-                total_current_usage=0,
-                total_upper_limit=0,
-                text_style_total_usage_ratio="width:0%",
-                total_usage_ratio_with_percent="-",
-                service_detail_list=service_detail_list,
-            )
+        return render_template(
+            "index.html",
+            year=yyyymm[:4],
+            month=yyyymm[5:],
+            total_current_usage=0,
+            total_upper_limit=0,
+            text_style_total_usage_ratio="width:0%",
+            total_usage_ratio_with_percent="-",
+            service_detail_list=service_detail_list,
+        )
 
 
 # ここから固定費登録画面
-@app.route("/service_detail")
+@bp.route("/service_detail")
+@cached_page(lambda view_args: get_current_yyyymm())
 def show_registered_services():
     yyyymm = get_current_yyyymm()
     db = get_db()
     service_detail_list = db.execute( 
-        "select * from service where year_month = ?", [yyyymm]
+        "select * from service where year_month = ? order by service_id", [yyyymm]
     ).fetchall()
     return render_template(
         "service_detail.html", service_detail_list=service_detail_list
@@ -152,19 +372,20 @@ def show_registered_services():
 
 
 # ここから商品画面
-@app.route("/services_detail")
+@bp.route("/services_detail")
 def show_items():
     yyyymm = get_current_yyyymm()
     db = get_db() 
     items_detail_list = db.execute( 
-        "select * from item where year_month = ?", [yyyymm]
+        "select * from item where purchase_date >= ? and purchase_date < ?",
+        get_month_date_range(yyyymm),
     ).fetchall()
     return render_template(
         "services_detail.html", items_detail_list=items_detail_list
     )
 
 
-@app.route("/service_register", methods=["GET", "POST"])
+@bp.route("/service_register", methods=["GET", "POST"])
 def register_new_service(error_message=""): 
     db = get_db()
     is_any_service_exists = db.execute( 
@@ -174,45 +395,26 @@ def register_new_service(error_message=""):
         service_name = request.form.get("service_name") 
         upper_limit = request.form.get("upper_limit") 
         yyyymm = get_current_yyyymm()
-        is_existed_service = db.execute(
-            "select service_name from service where service_name = ? and year_month = ?",
-            [service_name, yyyymm],
-        ).fetchall()
 
-        # 同名の固定費がある場合・入力が空欄の場合のエラーキャッチ
-        if is_existed_service:
-            return render_template(
-                "service_register.html", error_message="同じ名前の固定費が既に存在しています"
-            )
+        # 入力が空欄の場合のエラーキャッチ
         if service_name == "" or upper_limit == "":
             return render_template(
                 "service_register.html", error_message="固定費名もしくは使用上限金額が空欄です"
             )
 
-        # ここからDBに登録する処理
-        register_body = {
-            "year_month": yyyymm,
-            "service_name": service_name,
-            "upper_limit": upper_limit,
-        }
-        statement = "".join(
-            [
-                "insert into service (",
-                ", ".join("`" + key + "`" for key in register_body.keys()),
-                ") values (",
-                ", ".join(["?"] * len(register_body)),
-                ")",
-            ]
+        # ここからDBに登録する処理（同名の固定費がある場合はエラーメッセージが返る）
+        error_message = get_writer().submit(
+            operations.register_service, yyyymm, service_name, upper_limit
         )
-        db.execute(statement, [value for value in register_body.values()])
-        db.commit() 
+        if error_message:
+            return render_template("service_register.html", error_message=error_message)
         return redirect("/service_detail") 
     if is_any_service_exists is None:
         error_message = "固定費が登録されていません。まずは購入した商品と、使用する上限金額を登録してください。"
     return render_template("service_register.html", error_message=error_message)
 
 
-@app.route("/<service_name>/service_edit", methods=["GET", "POST"])
+@bp.route("/<service_name>/service_edit", methods=["GET", "POST"])
 def edit_service(service_name):
     db = get_db()
     yyyymm = get_current_yyyymm()
@@ -223,7 +425,7 @@ def edit_service(service_name):
 
     # 編集完了ボタンが押された時の処理
     if request.method == "POST":
-        service_name = request.form.get("service_name") 
+        new_service_name = request.form.get("service_name", "").strip()
         upper_limit = request.form.get("upper_limit") 
 
         # 入力が空欄の場合のエラーキャッチ
@@ -231,19 +433,23 @@ def edit_service(service_name):
             return render_template(
                 "service_edit.html", error_message="使用上限金額が空欄です", post=post
             )
+        if new_service_name == "":
+            return render_template(
+                "service_edit.html", error_message="固定費名が空欄です", post=post
+            )
 
-        # DBに上書き登録する処理
-        db.execute(
-            "update service set upper_limit = ? where service_name = ? and year_month = ?",
-            [upper_limit, service_name, yyyymm],
+        # DBに上書き登録する処理（固定費名を変えた場合は、全ての月の固定費と商品の固定費名も変わる）
+        error_message = get_writer().submit(
+            operations.update_service, yyyymm, service_name, new_service_name, upper_limit
         )
-        db.commit()
+        if error_message:
+            return render_template("service_edit.html", error_message=error_message, post=post)
         return redirect("/service_detail") 
 
     return render_template("service_edit.html", error_message="", post=post)
 
 
-@app.route("/<service_name>/service_delete", methods=["GET", "POST"])
+@bp.route("/<service_name>/service_delete", methods=["GET", "POST"])
 def delete_service(service_name): 
     db = get_db()
     yyyymm = get_current_yyyymm()
@@ -252,11 +458,7 @@ def delete_service(service_name):
         service_name = request.form.get("service_name") 
 
         # DBからサービスを削除する
-        db.execute(
-            "delete from service where service_name = ? and year_month = ?",
-            [service_name, yyyymm],
-        )
-        db.commit()
+        get_writer().submit(operations.delete_service, yyyymm, service_name)
         return redirect("/service_detail") 
 
     post = db.execute(
@@ -267,20 +469,32 @@ def delete_service(service_name):
 
 
 # ここから商品画面
-@app.route("/<service_name>/<yyyymm>/item_detail")
+@bp.route("/<service_name>/<yyyymm>/item_detail")
+@cached_page(lambda view_args: view_args["yyyymm"])
 def show_registered_items(service_name, yyyymm): 
     db = get_db()  # 接続を確立
-    item_detail_list = db.execute( 
-        "select * from item where purchase_date like ? and service_name = ?",
-        [
-            yyyymm + "%",
-            service_name,
-        ],
-    ).fetchall()
-    service_data = db.execute(
-        "select service_name, upper_limit from service where service_name = ? and year_month = ?",
-        [service_name, yyyymm],
-    ).fetchone()
+    # 締めた月はアーカイブから読む（archive.py）。締めた月の商品は変更・削除できない
+    with open_month(db, yyyymm) as schema:
+        item_detail_list = db.execute(
+            f"select * from {schema}.item where purchase_date >= ? and purchase_date < ? and service_name = ?",
+            [
+                *get_month_date_range(yyyymm),
+                service_name,
+            ],
+        ).fetchall()
+        service_data = db.execute(
+            f"select service_name, upper_limit from {schema}.service where service_name = ? and year_month = ?",
+            [service_name, yyyymm],
+        ).fetchone()
+        # まとめて固定費を変えるときの変更先（その月の固定費）
+        service_name_list = [
+            row[0]
+            for row in db.execute(
+                f"select service_name from {schema}.service where year_month = ? order by service_id",
+                [yyyymm],
+            )
+        ]
+    archived = is_archived_month(db, yyyymm)
 
     if service_data is not None:
         service_detail = add_usage_info_to_service_detail(
@@ -293,6 +507,8 @@ def show_registered_items(service_name, yyyymm):
             year=yyyymm[:4],
             month=yyyymm[5:],
             service_detail=service_detail,
+            service_name_list=service_name_list,
+            archived=archived,
         )
     else: 
         service_detail = {
@@ -309,80 +525,47 @@ def show_registered_items(service_name, yyyymm):
             year=yyyymm[:4],
             month=yyyymm[5:],
             service_detail=service_detail,
+            service_name_list=service_name_list,
+            archived=archived,
         )
 
 # 新しい商品を登録する
-@app.route("/item_register", methods=["GET", "POST"])
+@bp.route("/item_register", methods=["GET", "POST"])
 def register_new_item():  
     db = get_db()
     yyyymm = get_current_yyyymm()
     service_detail_list = db.execute(
-        "select * from service where year_month = ?", [yyyymm]
+        "select * from service where year_month = ? order by service_id", [yyyymm]
     ).fetchall()
     if service_detail_list == []:
         return redirect("/service_register")
 
     if request.method == "POST": 
-        purchase_date = request.form.get("purchase_date")  
-        service_name = request.form.get("service_name")  
-        item_name = request.form.get("item_name")  
-        item_price = request.form.get("item_price") 
-        item_attribute = request.form.get("item_attribute") 
-
-        is_existed_item = db.execute( 
-            "select service_name, item_name from item where service_name = ? and item_name = ?",
-            [
-                service_name,
-                item_name,
-            ],
-        ).fetchall()
-
-        # 同じ商品が同じサービスで購入されている場合・入力が空欄の場合のエラーキャッチ
-        if is_existed_item:
+        # 空欄・購入日の形式・値段・購入者を、一括登録・APIと同じようにチェックする（util.validate_item_row）
+        # 購入日は "YYYY-MM-DD" にそろえ、値段は数値にしてから登録する
+        register_body = {
+            column: request.form.get(column, "").strip() for column in ITEM_COLUMN_LIST
+        }
+        error_message = validate_item_row(register_body)
+        if error_message:
             return render_template(
                 "item_register.html",
-                error_message=f"同じ名前の商品が{service_name}で既に購入されています",
+                error_message=error_message,
                 service_detail_list=service_detail_list,
                 item_attribute_list=ITEM_ATTRIBUTE_LIST,
             )
-        if (
-            is_there_empty_entry(
-                [
-                    purchase_date,
-                    service_name,
-                    item_name,
-                    item_price,
-                    item_attribute,
-                ]
-            )
-            is True
-        ):
+        service_name = register_body["service_name"]
+        purchase_date = register_body["purchase_date"]
+
+        # ここからDBに登録する処理（同じ商品が同じサービスで購入されている場合はエラーメッセージが返る）
+        error_message = get_writer().submit(operations.register_item, register_body)
+        if error_message:
             return render_template(
                 "item_register.html",
-                error_message="全て入力してください",
+                error_message=error_message,
                 service_detail_list=service_detail_list,
                 item_attribute_list=ITEM_ATTRIBUTE_LIST,
             )
-
-        # ここからDBに登録する処理
-        register_body = {
-            "purchase_date": purchase_date,
-            "service_name": service_name,
-            "item_name": item_name,
-            "item_price": item_price,
-            "item_attribute": item_attribute,
-        }
-        statement = "".join(
-            [
-                "insert into item (",
-                ", ".join("`" + key + "`" for key in register_body.keys()),
-                ") values (",
-                ", ".join(["?"] * len(register_body)),
-                ")",
-            ]
-        )  
-        db.execute(statement, [value for value in register_body.values()])
-        db.commit() 
         return redirect(
             f"/{service_name}/{purchase_date[:7]}/item_detail"
         )  # DBに新たなサービスを入れたら、商品登録画面に戻る
@@ -395,12 +578,59 @@ def register_new_item():
     )
 
 
-@app.route("/<service_name>/item_edit/<item_id>", methods=["GET", "POST"])
+# CSV・xlsxから出費をまとめて登録する
+@bp.route("/item_import", methods=["GET", "POST"])
+def import_new_items():
+    if request.method == "POST":
+        file = request.files.get("file")
+        if file is None or file.filename == "":
+            return render_template(
+                "item_import.html", error_message="ファイルを選択してください", result=None
+            )
+        # 検証から登録までを書き込み用のスレッドの1つのトランザクションで行う（同時に登録された商品と重ならない）
+        try:
+            result = get_writer().submit(
+                insert_items,
+                iter_rows(
+                    file.stream,
+                    file.filename,
+                    request.form.get("encoding", "utf-8-sig"),
+                ),
+            )
+        except sqlite3.IntegrityError:
+            return render_template(
+                "item_import.html",
+                error_message="取り込んでいる間に同じ名前の商品が登録されました。もう一度取り込んでください",
+                result=None,
+            )
+        except sqlite3.OperationalError as e:
+            # 他のワーカーの書き込みが終わらず、書き込みのロックを取れなかった
+            if "locked" not in str(e):
+                raise
+            return render_template(
+                "item_import.html",
+                error_message="他の書き込みが終わらなかったため取り込めませんでした。しばらくしてからもう一度取り込んでください",
+                result=None,
+            )
+        except ImportFormatError as e:
+            return render_template("item_import.html", error_message=str(e), result=None)
+        except UnicodeDecodeError:
+            return render_template(
+                "item_import.html",
+                error_message="ファイルの文字コードが正しくありません",
+                result=None,
+            )
+        return render_template("item_import.html", error_message="", result=result)
+
+    return render_template("item_import.html", error_message="", result=None)
+
+
+@bp.route("/<service_name>/item_edit/<item_id>", methods=["GET", "POST"])
 def edit_item(service_name, item_id):
     yyyymm = get_current_yyyymm()
     db = get_db() 
     service_detail_list = db.execute( 
-        "select * from service where year_month = ?", [yyyymm]
+        "select * from service where year_month = ? order by service_id", [yyyymm]
     ).fetchall()
     objective_item = db.execute(
         "select * from item where item_id = ?", [item_id]
@@ -408,61 +638,32 @@ def edit_item(service_name, item_id):
     # 登録ボタンが押された場合の処理
     if request.method == "POST":
         # request.form.getで得られるのは全部str型
-        purchase_date = request.form.get("purchase_date") 
-        service_name = request.form.get("service_name") 
-        item_name = request.form.get("item_name") 
-        item_price = request.form.get("item_price") 
-        item_attribute = request.form.get("item_attribute")  
-
-        is_existed_item = db.execute(  
-            "select service_name, item_name from item where service_name = ? and item_name = ? and item_id != ?",
-            [service_name, item_name, item_id],
-        ).fetchall() 
-
-        # 同名の商品が変更先のサービスで購入されている場合のエラーキャッチ
-        if is_existed_item:
+        # 商品登録と同じように、空欄・購入日の形式・値段・購入者をチェックする
+        update_body = {
+            column: request.form.get(column, "").strip() for column in ITEM_COLUMN_LIST
+        }
+        error_message = validate_item_row(update_body)
+        if error_message:
             return render_template(
                 "item_edit.html",
-                error_message=f"同じ名前の商品が{service_name}で既に購入されています",
+                error_message=error_message,
                 objective_item=objective_item,
                 service_detail_list=service_detail_list,
                 item_attribute_list=ITEM_ATTRIBUTE_LIST,
             )
+        service_name = update_body["service_name"]
+        purchase_date = update_body["purchase_date"]
 
-        # 入力が空欄の場合のエラーキャッチ
-        if (
-            is_there_empty_entry(
-                [
-                    purchase_date,
-                    service_name,
-                    item_name,
-                    item_price,
-                    item_attribute,
-                ]
-            )
-            is True
-        ):
+        # DBに上書き登録する処理（同名の商品が変更先のサービスで購入されている場合はエラーメッセージが返る）
+        error_message = get_writer().submit(operations.update_item, item_id, update_body)
+        if error_message:
             return render_template(
                 "item_edit.html",
-                error_message="全て入力してください",
+                error_message=error_message,
                 objective_item=objective_item,
                 service_detail_list=service_detail_list,
                 item_attribute_list=ITEM_ATTRIBUTE_LIST,
             )
-
-        # DBに上書き登録する処理
-        db.execute(
-            "update item set purchase_date = ?, service_name = ?, item_name = ?, item_price = ?, item_attribute = ? where item_id = ?",
-            [
-                purchase_date,
-                service_name,
-                item_name,
-                item_price,
-                item_attribute,
-                item_id,
-            ],
-        )
-        db.commit()
         return redirect(
             f"/{service_name}/{purchase_date[:7]}/item_detail"
         ) 
@@ -476,20 +677,15 @@ def edit_item(service_name, item_id):
     )
 
 
-@app.route("/<service_name>/item_delete/<item_id>", methods=["GET", "POST"])
+@bp.route("/<service_name>/item_delete/<item_id>", methods=["GET", "POST"])
 def delete_item(service_name, item_id): 
     db = get_db()
 
     if request.method == "POST":
         # DBから商品を削除する
-        purchase_date = db.execute(
-            "select purchase_date from item where item_id = ?", [item_id]
-        ).fetchone()["purchase_date"]
-        db.execute(
-            "delete from item where item_id = ?",
-            [item_id],
-        )
-        db.commit() 
+        purchase_date = get_writer().submit(operations.delete_item, item_id)
+        if purchase_date is None:
+            abort(404)
         return redirect(
             f"/{service_name}/{purchase_date[:7]}/item_detail"
         )  # DBから商品を削除したら、TOP画面に戻る
@@ -502,7 +698,7 @@ def delete_item(service_name, item_id):
     ).fetchone()
     yyyymm = get_current_yyyymm()
     service_detail_list = db.execute(
-        "select * from service where year_month = ?", [yyyymm]
+        "select * from service where year_month = ? order by service_id", [yyyymm]
     ).fetchall()
     return render_template(
         "item_delete.html",
@@ -512,90 +708,439 @@ def delete_item(service_name, item_id):
     )
 
 
-@app.route("/history", methods=["GET", "POST"])
-def show_graph():
-    db = get_db()
-    service_detail_list = db.execute(
-        "select * from service",
-    ).fetchall()
-    recorded_year_month_list = list(
-        set([service_detail["year_month"] for service_detail in service_detail_list])
-    )
-    recorded_year_month_list.sort()
+# ライブ更新（Server-Sent Events）。トップ画面・商品一覧が購読し、もう片方の端末での変更を画面に反映する（events.py）
+# ストリームの中ではDBの接続を借りない（レスポンスを返した時点で、リクエストの接続はプールに戻る）
+# 接続の数はプロセスごとに LIVE_EVENT_MAX_CONNECTIONS までで、LIVE_EVENT_STREAM_MAX_AGE 秒たったら閉じて繋ぎ直させる
+@bp.route("/events")
+def stream_live_events():
+    hub = get_router().get_events(get_household_id())
+    try:
+        subscription = hub.subscribe(request.headers.get("Last-Event-ID", ""))
+    except LiveEventLimitError as e:
+        response = Response(str(e), status=503, mimetype="text/plain")
+        response.headers["Retry-After"] = str(current_app.config["LIVE_EVENT_STREAM_MAX_AGE"])
+        return response
+    heartbeat_interval = current_app.config["LIVE_EVENT_HEARTBEAT_INTERVAL"]
+    max_age = current_app.config["LIVE_EVENT_STREAM_MAX_AGE"]
+    retry_ms = current_app.config["LIVE_EVENT_RETRY_MS"]
+
+    def generate():
+        try:
+            yield f"retry: {retry_ms}\n\n".encode()
+            deadline = time.monotonic() + max_age
+            while time.monotonic() < deadline:
+                try:
+                    message = subscription.get(min(heartbeat_interval, deadline - time.monotonic()))
+                except queue.Empty:
+                    # プロキシに切られないよう、イベントがなくても空のコメントを送る
+                    yield b": keepalive\n\n"
+                    continue
+                if message is None:
+                    break
+                yield message
+        finally:
+            hub.unsubscribe(subscription)
+
+    response = Response(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    # nginxなどのリバースプロキシにバッファさせない
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+# 商品一覧で選んだ商品をまとめて削除する・固定費を変える
+@bp.route("/items/batch", methods=["POST"])
+def edit_items():
+    service_name = request.form.get("from_service_name", "")
+    yyyymm = request.form.get("year_month", "")
+    try:
+        item_id_list = [int(item_id) for item_id in request.form.getlist("item_id")]
+    except ValueError:
+        abort(400)
+    if not item_id_list:
+        error_message = "商品を選んでください"
+    elif request.form.get("action") == "delete":
+        get_writer().submit(operations.delete_items, item_id_list)
+        error_message = ""
+    elif request.form.get("action") == "move" and request.form.get("service_name"):
+        error_message = get_writer().submit(
+            operations.move_items_to_service, item_id_list, request.form.get("service_name")
+        )
+    else:
+        abort(400)
+    if error_message:
+        return render_template(
+            "item_batch.html",
+            error_message=error_message,
+            back_url=f"/{service_name}/{yyyymm}/item_detail",
+        )
+    return redirect(f"/{service_name}/{yyyymm}/item_detail")
 
-    total_upper_limit_and_usage_for_each_month = {}
-    for year_month in recorded_year_month_list:
-        total_upper_limit_and_usage_for_each_month[year_month] = {
-            "total_upper_limit": 0,
-            "total_usage": 0,
-        }
 
-    for service_detail in service_detail_list:
-        total_upper_limit_and_usage_for_each_month[service_detail["year_month"]][
-            "total_upper_limit"
-        ] += service_detail["upper_limit"]
-
-    item_detail_list = db.execute("select * from item").fetchall()
-    for item_detail in item_detail_list:
-        # サービスの使用上限金額が決まっている月に購入された商品のみ購入する
-        if (
-            item_detail["purchase_date"][:7]
-            in total_upper_limit_and_usage_for_each_month
-        ):
-            total_upper_limit_and_usage_for_each_month[
-                item_detail["purchase_date"][:7]
-            ]["total_usage"] += item_detail["item_price"]
-
-    total_upper_limit = [
-        total_upper_limit_and_usage["total_upper_limit"]
-        for total_upper_limit_and_usage in total_upper_limit_and_usage_for_each_month.values()
-    ]
-    total_usage = [
-        total_upper_limit_and_usage["total_usage"]
-        for total_upper_limit_and_usage in total_upper_limit_and_usage_for_each_month.values()
-    ]
+@bp.route("/history", methods=["GET", "POST"])
+@cached_page(lambda view_args: ALL_MONTHS)
+def show_graph():
+    db = get_db()
+    (
+        recorded_year_month_list,
+        total_upper_limit,
+        total_usage,
+        sum_of_total_upper_limit,
+        sum_of_total_usage,
+        _,
+    ) = get_total_usage_info(db)
+
+    # ?from=&to=（YYYY-MMまたはYYYY-MM-DD）で期間を絞り込む。合計は累積和から求め、前年の同じ期間と比べる
+    first_yyyymm = request.args.get("from", "")
+    last_yyyymm = request.args.get("to", "")
+    range_summary = None
+    error_message = ""
+    if first_yyyymm and last_yyyymm:
+        try:
+            range_summary = get_range_summary(get_range_index(), first_yyyymm, last_yyyymm)
+        except RangeError as e:
+            error_message = str(e)
+    if range_summary is not None:
+        # 日単位の期間でも、グラフは期間に含まれる月だけにする
+        month_list = [
+            (year_month, upper_limit, usage)
+            for year_month, upper_limit, usage in zip(
+                recorded_year_month_list, total_upper_limit, total_usage
+            )
+            if first_yyyymm[:7] <= year_month <= last_yyyymm[:7]
+        ]
+        recorded_year_month_list = [year_month for year_month, _, _ in month_list]
+        total_upper_limit = [upper_limit for _, upper_limit, _ in month_list]
+        total_usage = [usage for _, _, usage in month_list]
+        sum_of_total_usage = range_summary["total_usage"]
+        sum_of_total_upper_limit = range_summary.get("total_upper_limit", sum(total_upper_limit))
 
     # グラフの見栄えを良くするために、最初に記録された月より一ヶ月前にデータを追加する
     if recorded_year_month_list: 
-        first_recorded_year_month = recorded_year_month_list[0]
-        if first_recorded_year_month[5:] == "01":
-            previous_year = str(int(first_recorded_year_month[:4]) - 1)
-            previous_month = "12"
-            recorded_year_month_list = [
-                previous_year + "-" + previous_month
-            ] + recorded_year_month_list
-            total_upper_limit = [0] + total_upper_limit
-            total_usage = [0] + total_usage
-        else:
-            previous_month = str(int(first_recorded_year_month[5:]) - 1).zfill(2)
-            recorded_year_month_list = [
-                first_recorded_year_month[:4] + "-" + previous_month
-            ] + recorded_year_month_list
-            total_upper_limit = [0] + total_upper_limit
-            total_usage = [0] + total_usage
+        recorded_year_month_list = [
+            get_previous_yyyymm(recorded_year_month_list[0])
+        ] + recorded_year_month_list
+        total_upper_limit = [0] + total_upper_limit
+        total_usage = [0] + total_usage
 
     return render_template(
         "line_graph.html",
         recorded_year_month_list=recorded_year_month_list,
         total_upper_limit=total_upper_limit,
         total_usage=total_usage,
-        sum_of_total_upper_limit=sum(total_upper_limit),
-        sum_of_total_usage=sum(total_usage),
+        sum_of_total_upper_limit=sum_of_total_upper_limit,
+        sum_of_total_usage=sum_of_total_usage,
+        first_yyyymm=first_yyyymm,
+        last_yyyymm=last_yyyymm,
+        range_summary=range_summary,
+        error_message=error_message,
     )
 
 
+# ここから使用額の内訳画面（誰が何にいくら使ったか）
+# ?month=YYYY-MM ならその月の固定費ごと、?service=固定費名 ならその固定費の月ごと、どちらもなければ月ごとの内訳
+# ?year=YYYY で月を1年分に絞り込める。集計はspending_cube（cube.py）から読む
+@bp.route("/spending")
+@cached_page(lambda view_args: ALL_MONTHS)
+def show_spending():
+    db = get_db()
+    yyyymm = request.args.get("month", "")
+    service_name = request.args.get("service", "")
+    year = request.args.get("year", "")
+    if yyyymm:
+        row_list, total_row = get_spending_table(db, "service_name", year_month=yyyymm)
+        title = f"{yyyymm[:4]}年{yyyymm[5:]}月の固定費ごとの内訳"
+    else:
+        row_list, total_row = get_spending_table(
+            db, "year_month", service_name=service_name or ALL, year=year
+        )
+        title = (service_name or "全ての固定費") + "の月ごとの内訳" + (f"（{year}年）" if year else "")
+    return render_template(
+        "spending.html",
+        title=title,
+        yyyymm=yyyymm,
+        service_name=service_name,
+        row_list=row_list,
+        total_row=total_row,
+        item_attribute_list=ITEM_ATTRIBUTE_LIST,
+    )
+
+# ここから商品の検索画面（?q=検索する語&month=YYYY-MM&service=固定費名&attribute=夫）
+@bp.route("/search")
+def search_items():
+    query = request.args.get("q", "")
+    search_filters = {
+        "yyyymm": request.args.get("month", ""),
+        "service_name": request.args.get("service", ""),
+        "item_attribute": request.args.get("attribute", ""),
+    }
+    result = None
+    error_message = ""
+    if query:
+        try:
+            result = get_search_results(
+                get_db(), query, cursor=request.args.get("cursor", ""), **search_filters
+            )
+        except ApiError as e:
+            error_message = e.message
+    return render_template(
+        "search.html",
+        query=query,
+        result=result,
+        error_message=error_message,
+        item_attribute_list=ITEM_ATTRIBUTE_LIST,
+        **search_filters,
+    )
 
 
-con = sqlite3.connect(DATABASE)
-cur = con.cursor()
-cur.execute(
-    "create table if not exists service(service_id integer primary key autoincrement, year_month text not null, service_name text not null, upper_limit integer not null)"
-)
-cur.execute(
-    "create table if not exists item(item_id integer primary key autoincrement, purchase_date text not null, service_name text not null, item_name text not null, item_price integer not null, item_attribute text not null)"
-)
-cur.execute(
-    "create table if not exists extra_item(extra_item_id integer primary key autoincrement, purchase_date text not null, service_name text not null, extra_item_name text not null, extra_item_price integer not null, extra_item_attribute text not null)"
-)
-con.close()
-app.run(debug=True)  # debug=Trueでリロードすればコードの変更が反映される
+EXPORT_MIMETYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "json": "application/json",
+}
+
+
+def make_export_response(filename: str, export_format: str, column_list: list[str], row_iter):
+    # 行を読みながら少しずつ返すので、データの量によらずメモリの使用量は一定で、最初のバイトもすぐに返る
+    # ジェネレーターが最後まで読み終わるまでDBとの接続を返さないように、stream_with_contextを使う
+    if export_format == "csv":
+        chunk_iter = iter_csv(column_list, row_iter)
+    else:
+        chunk_iter = iter_json(column_list, row_iter)
+    headers = {
+        # 固定費名が日本語のこともあるので、ファイル名はRFC 5987の形式で渡す
+        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}.{export_format}",
+        "Vary": "Accept-Encoding",
+    }
+    if request.accept_encodings["gzip"]:
+        chunk_iter = iter_gzip(chunk_iter)
+        headers["Content-Encoding"] = "gzip"
+    return Response(
+        stream_with_context(chunk_iter),
+        mimetype=EXPORT_MIMETYPES[export_format],
+        headers=headers,
+    )
+
+
+# 商品の書き出し（?month=YYYY-MM&service=固定費名 で絞り込める）
+@bp.route("/export/items.<export_format>")
+def export_items(export_format):
+    if export_format not in EXPORT_MIMETYPES:
+        abort(404)
+    db = get_db()
+    yyyymm = request.args.get("month", "")
+    service_name = request.args.get("service", "")
+    filename = "_".join(["items"] + [value for value in [yyyymm, service_name] if value])
+    return make_export_response(
+        filename,
+        export_format,
+        ITEM_EXPORT_COLUMN_LIST,
+        iter_item_rows(db, yyyymm, service_name),
+    )
+
+
+# 履歴画面の月ごとの上限金額・使用額の書き出し
+@bp.route("/export/history.<export_format>")
+def export_history(export_format):
+    if export_format not in EXPORT_MIMETYPES:
+        abort(404)
+    db = get_db()
+    return make_export_response(
+        "history", export_format, HISTORY_EXPORT_COLUMN_LIST, iter_history_rows(db)
+    )
+
+
+# ここからJSON API（/api/v1/）
+# 内容のハッシュをETagにするので、変更がなければ304が返る
+def make_api_response(body: dict):
+    response = jsonify(body)
+    response.add_etag()
+    return response.make_conditional(request)
+
+
+@bp.app_errorhandler(ApiError)
+def handle_api_error(e):
+    return jsonify(error=e.message), e.status_code
+
+
+@bp.route("/api/v1/months/<yyyymm>/summary")
+def api_month_summary(yyyymm):
+    return make_api_response(get_month_summary(get_db(), yyyymm))
+
+
+# ?month=YYYY-MM&fields=item_name,item_price&limit=50&cursor=... で絞り込み・ページ送りができる
+@bp.route("/api/v1/services/<service_name>/items")
+def api_service_items(service_name):
+    return make_api_response(
+        get_service_items(
+            get_db(),
+            service_name,
+            yyyymm=request.args.get("month", ""),
+            fields=request.args.get("fields", ""),
+            limit=request.args.get("limit", ""),
+            cursor=request.args.get("cursor", ""),
+        )
+    )
+
+
+# ?month=&service=&attribute= で絞り込み、?group_by=month,attribute のように次元ごとの内訳を返す
+@bp.route("/api/v1/spending")
+def api_spending():
+    return make_api_response(
+        get_spending(
+            get_db(),
+            {
+                dimension: request.args[dimension]
+                for dimension in ("month", "service", "attribute")
+                if dimension in request.args
+            },
+            group_by=request.args.get("group_by", ""),
+            year=request.args.get("year", ""),
+        )
+    )
+
+
+# ?from=2024-01&to=2024-06（月単位）または ?from=2024-01-01&to=2024-03-31（日単位）
+# &service=固定費名&attribute=購入者 で絞り込める（絞り込んだときは固定費・購入者ごとの内訳も返す）
+@bp.route("/api/v1/range")
+def api_range():
+    first = request.args.get("from", "")
+    last = request.args.get("to", "")
+    service_name = request.args.get("service", "")
+    item_attribute = request.args.get("attribute", "")
+    if service_name or item_attribute:
+        return make_api_response(
+            get_filtered_range(get_snapshot(), first, last, service_name, item_attribute)
+        )
+    return make_api_response(get_range(get_range_index(), first, last))
+
+
+# ?q=検索する語&month=&service=&attribute=&limit=&cursor=
+@bp.route("/api/v1/items/search")
+def api_search_items():
+    return make_api_response(
+        get_search_results(
+            get_db(),
+            request.args.get("q", ""),
+            yyyymm=request.args.get("month", ""),
+            service_name=request.args.get("service", ""),
+            item_attribute=request.args.get("attribute", ""),
+            limit=request.args.get("limit", ""),
+            cursor=request.args.get("cursor", ""),
+        )
+    )
+
+
+# 商品登録画面の入力補完（?q=商品名の先頭）
+@bp.route("/api/v1/items/autocomplete")
+def api_autocomplete():
+    return make_api_response(get_autocomplete(get_db(), request.args.get("q", "")))
+
+
+@bp.route("/api/v1/history")
+def api_history():
+    return make_api_response(get_history(get_db()))
+
+
+# {"action": "delete", "item_ids": [1, 2]} または {"action": "move", "item_ids": [...], "service_name": "固定費名"}
+# 全ての商品を1つのトランザクションで変更・削除する
+@bp.route("/api/v1/items/batch", methods=["POST"])
+def api_items_batch():
+    action, item_id_list, service_name = parse_item_batch(request.get_json(silent=True))
+    if action == "delete":
+        item_count = get_writer().submit(operations.delete_items, item_id_list)
+    else:
+        error_message = get_writer().submit(
+            operations.move_items_to_service, item_id_list, service_name
+        )
+        if error_message:
+            raise ApiError(error_message, 409)
+        item_count = len(item_id_list)
+    return jsonify(action=action, item_count=item_count)
+
+
+# {"service_name": "新しい固定費名"}（全ての月の固定費と商品の固定費名が変わる）
+@bp.route("/api/v1/services/<service_name>/rename", methods=["POST"])
+def api_rename_service(service_name):
+    body = request.get_json(silent=True) or {}
+    new_service_name = str(body.get("service_name", "")).strip()
+    if not new_service_name:
+        raise ApiError("service_nameを指定してください")
+    error_message = get_writer().submit(operations.rename_service, service_name, new_service_name)
+    if error_message:
+        raise ApiError(error_message, 409)
+    return jsonify(service_name=new_service_name)
+
+
+# 差分同期（changes.py）。?since=最後に受け取ったversion&limit=件数
+# has_moreがtrueの間は、返ってきたversionをsinceにして続きを受け取る。410が返ったら since=0 から同期し直す
+@bp.route("/api/v1/changes")
+def api_changes():
+    return make_api_response(
+        get_change_list(get_db(), request.args.get("since", ""), request.args.get("limit", ""))
+    )
+
+
+# オフラインの間に溜めた商品の変更をまとめて送る（1つのトランザクションで、1件ごとの結果を返す）
+# 送った後は GET /api/v1/changes で、サーバーで付いたidや他の端末の変更を受け取る
+@bp.route("/api/v1/changes", methods=["POST"])
+def api_upload_changes():
+    change_list = parse_item_changes(request.get_json(silent=True))
+    results = get_writer().submit(operations.apply_item_changes, change_list)
+    return jsonify(results=results)
+
+
+
+# ここからアプリの作成
+# configを渡すと、config.pyの値を上書きできる（ベンチマークなどで別のDBを使うとき）
+def create_app(config=None):
+    app = Flask(__name__)
+    app.config.from_object("config")
+    if config is not None:
+        app.config.update(config)
+    # JSONは空白を入れず、日本語もエスケープせずにそのまま返す（レスポンスを小さくするため）
+    app.json.compact = True
+    app.json.ensure_ascii = False
+    app.register_blueprint(bp)
+
+    # DBとの接続はここでは作らず、最初のリクエストで世帯のプールを開くときに作る
+    # pre-forkのサーバーでは、ワーカーがforkした後にcreate_appを呼ぶので、接続がプロセスをまたがない
+    app.extensions["kakeibo"] = {
+        "router": HouseholdRouter(
+            connect_db,
+            database=app.config["DATABASE"],
+            directory=app.config["HOUSEHOLD_DATABASE_DIRECTORY"],
+            max_households=app.config["HOUSEHOLD_POOL_CACHE_SIZE"],
+            max_live_event_connections=app.config["LIVE_EVENT_MAX_CONNECTIONS"],
+        ),
+        "page_cache": PageCache(
+            app.config["PAGE_CACHE_MAX_ENTRIES"], app.config["PAGE_CACHE_MAX_BYTES"]
+        ),
+        "metrics": MetricsRegistry(),
+        "range_indexes": RangeIndexCache(),
+        "snapshots": SnapshotCache(app.config["SNAPSHOT_SAVE_INTERVAL"]),
+        "asset_manifest": load_asset_manifest(),
+        "rolled_over_yyyymm": {},
+    }
+    before_render_template.connect(start_template_timer, app)
+    template_rendered.connect(stop_template_timer, app)
+
+    # flask --app app migrate でマイグレーションだけ行える
+    @app.cli.command("migrate")
+    def migrate_command():
+        init_database(app)
+
+    return app
+
+
+# スキーマの作成・更新（インデックスの追加など）はschema.pyのマイグレーションで行う
+# importのたびには行わず、起動するときに1回だけ呼ぶ（server.pyではワーカーをforkする前に呼ぶ）
+def init_database(app):
+    con = sqlite3.connect(app.config["DATABASE"])
+    migrate(con)
+    con.close()
+
+
+if __name__ == "__main__":
+    app = create_app()
+    init_database(app)
+    app.run(debug=True)  # debug=Trueでリロードすればコードの変更が反映される
@@ -0,0 +1,321 @@
+import contextlib
+import datetime
+import os
+import sqlite3
+
+from config import ARCHIVE_OPEN_MONTHS
+from page_cache import bump_month_versions
+from util import add_months, get_current_yyyymm, get_month_date_range, get_next_yyyymm
+
+# 締めた月のアーカイブ
+# 商品・固定費を書き換えるのはほぼ直近の月だけなので、古い月の item・service の行は年ごとのアーカイブ
+# （DBファイルの隣の「<DB>.archive/YYYY.db」）に移し、item・service とそのインデックスを小さく保つ
+#   - アーカイブに移す月は「ある月より前の全ての月」（締めた月）で、締めた月には登録・編集・削除できない
+#   - 集計テーブル（month_service_totals・spending_cube・day_totals）の行はそのまま残し、以後は書き換えない
+#     （履歴・内訳・期間の集計は、アーカイブを開かずにこれまで通り集計テーブルから読む。
+#       締めた月の上限金額の合計は archived_months に記録しておく）
+#   - 締めた月の商品一覧・書き出し・APIは、その年のアーカイブをアタッチして読む（read_ledger・open_month）
+#   - 商品の検索（search.py）は、アーカイブに移していない月だけが対象になる
+# アーカイブへの書き込みは別の接続で先にコミットし、その後で元のDBから消す
+# 途中で止まっても、アーカイブに同じ行が残るだけで商品が消えることはない（もう一度実行すればよい）
+
+ARCHIVE_DIRECTORY_EXTENSION = ".archive"
+ARCHIVE_SCHEMA_PREFIX = "archive_"
+
+# アーカイブのテーブル（item・serviceと同じ列。インデックスは読むときに使うものだけ）
+ARCHIVE_SCHEMA = [
+    "create table if not exists item(item_id integer primary key, purchase_date text not null, service_name text not null, item_name text not null, item_price integer not null, item_attribute text not null)",
+    "create index if not exists idx_item_purchase_date_service_name on item(purchase_date, service_name)",
+    "create index if not exists idx_item_service_name_purchase_date on item(service_name, purchase_date)",
+    "create table if not exists service(service_id integer primary key, year_month text not null, service_name text not null, upper_limit integer not null)",
+    "create unique index if not exists idx_service_year_month_service_name on service(year_month, service_name)",
+]
+ITEM_COLUMNS = "item_id, purchase_date, service_name, item_name, item_price, item_attribute"
+SERVICE_COLUMNS = "service_id, year_month, service_name, upper_limit"
+
+
+def get_archive_directory(db: sqlite3.Connection) -> str:
+    for _, name, path in db.execute("pragma database_list"):
+        if name == "main":
+            return path + ARCHIVE_DIRECTORY_EXTENSION
+    return ""
+
+
+def get_archive_path(db: sqlite3.Connection, year: str) -> str:
+    return os.path.join(get_archive_directory(db), f"{year}.db")
+
+
+def get_last_archived_yyyymm(db: sqlite3.Connection) -> str:
+    # 締めた最後の月（まだ何も締めていなければ空文字列）。この月とそれより前の月には書き込めない
+    return db.execute("select coalesce(max(year_month), '') from archived_months").fetchone()[0]
+
+
+def is_archived_month(db: sqlite3.Connection, yyyymm: str) -> bool:
+    return yyyymm <= get_last_archived_yyyymm(db)
+
+
+def is_archived_item_name(db: sqlite3.Connection, service_name: str, item_name: str) -> bool:
+    # アーカイブに移した商品と同じ (固定費名, 商品名) か（item の一意インデックスでは判定できない）
+    return (
+        db.execute(
+            "select 1 from archived_item_names where service_name = ? and item_name = ?",
+            [service_name, item_name],
+        ).fetchone()
+        is not None
+    )
+
+
+def get_archived_month_message(yyyymm: str) -> str:
+    return f"{yyyymm[:4]}年{yyyymm[5:7]}月は締められているので、商品を登録・変更できません"
+
+
+def get_first_open_date(db: sqlite3.Connection) -> str:
+    # 締めていない最初の月の1日（何も締めていなければ空文字列なので、purchase_date >= ? は全ての商品に当てはまる）
+    last_archived_yyyymm = get_last_archived_yyyymm(db)
+    return get_next_yyyymm(last_archived_yyyymm) + "-01" if last_archived_yyyymm else ""
+
+
+def get_archive_year_list(db: sqlite3.Connection, first_yyyymm: str = "", last_yyyymm: str = "") -> list[str]:
+    # 期間 [first_yyyymm, last_yyyymm] に商品・固定費をアーカイブに移した月がある年（古い順）
+    return [
+        row[0]
+        for row in db.execute(
+            "select distinct archive_year from archived_months "
+            "where year_month >= ? and (? = '' or year_month <= ?) order by archive_year",
+            [first_yyyymm, last_yyyymm, last_yyyymm],
+        )
+    ]
+
+
+class MissingArchiveError(Exception):
+    # archived_months に記録した年のアーカイブのファイルがない（消した・書き戻し忘れなど）
+    pass
+
+
+@contextlib.contextmanager
+def attached_archive(db: sqlite3.Connection, year: str):
+    # その年のアーカイブを読み込み用にアタッチし、スキーマ名を返す（抜けるときにデタッチする）
+    # 同時にアタッチできる数には上限があるので、アタッチしたままにはしない
+    # ないファイルをアタッチするとSQLiteが空のファイルを作ってしまうので、先に確かめる
+    path = get_archive_path(db, year)
+    if not os.path.exists(path):
+        raise MissingArchiveError(
+            f"{year}年のアーカイブがありません：{path}（python archive.py verify で確かめてください）"
+        )
+    schema = ARCHIVE_SCHEMA_PREFIX + year
+    db.execute(f"attach database ? as {schema}", [path])
+    try:
+        yield schema
+    finally:
+        db.execute(f"detach database {schema}")
+
+
+@contextlib.contextmanager
+def open_month(db: sqlite3.Connection, yyyymm: str):
+    # その月の item・service を読むときのスキーマ名（アーカイブに移した月ならアタッチしたアーカイブ）を返す
+    row = db.execute(
+        "select archive_year from archived_months where year_month = ?", [yyyymm]
+    ).fetchone()
+    if row is None:
+        yield "main"
+        return
+    with attached_archive(db, row[0]) as schema:
+        yield schema
+
+
+def read_ledger(
+    db: sqlite3.Connection,
+    statement: str,
+    parameters=(),
+    first_yyyymm: str = "",
+    last_yyyymm: str = "",
+    batch_size: int = 500,
+):
+    # statement（{schema}.item のように書く）を古い年のアーカイブから順に実行し、最後に元のDBで実行した行を返す
+    # 締めた月はどれも締めていない月より前なので、購入日の順に並べるクエリならつなげても購入日の順になる
+    # 期間 [first_yyyymm, last_yyyymm] を渡すと、期間に重ならないアーカイブは開かない
+    for year in get_archive_year_list(db, first_yyyymm, last_yyyymm):
+        with attached_archive(db, year) as schema:
+            yield from _read_cursor(db.execute(statement.format(schema=schema), parameters), batch_size)
+    if not last_yyyymm or not is_archived_month(db, last_yyyymm):
+        yield from _read_cursor(db.execute(statement.format(schema="main"), parameters), batch_size)
+
+
+def _read_cursor(cursor: sqlite3.Cursor, batch_size: int):
+    # 途中で読むのをやめても、デタッチする前にカーソルを閉じる
+    try:
+        while True:
+            row_list = cursor.fetchmany(batch_size)
+            if not row_list:
+                break
+            yield from row_list
+    finally:
+        cursor.close()
+
+
+def get_archive_cutoff(db: sqlite3.Connection, yyyymm: str, open_months: int = ARCHIVE_OPEN_MONTHS) -> str:
+    # yyyymm（今月）から数えて open_months か月より前の月を締める
+    # 新しい月に固定費をコピーする元（rollover.py）になるので、今月より前で固定費を最後に登録した月は残す
+    cutoff_yyyymm = add_months(yyyymm, -(max(open_months, 1) - 1))
+    latest_service_yyyymm = db.execute(
+        "select max(year_month) from service where year_month < ?", [yyyymm]
+    ).fetchone()[0]
+    if latest_service_yyyymm is not None:
+        cutoff_yyyymm = min(cutoff_yyyymm, latest_service_yyyymm)
+    return cutoff_yyyymm
+
+
+def get_months_to_archive(db: sqlite3.Connection, cutoff_yyyymm: str) -> list[str]:
+    # cutoff_yyyymm より前で、まだ元のDBに商品・固定費が残っている月（古い順）
+    return [
+        row[0]
+        for row in db.execute(
+            "select year_month from service where year_month < ? "
+            "union select substr(purchase_date, 1, 7) from item where purchase_date < ? "
+            "order by 1",
+            [cutoff_yyyymm, cutoff_yyyymm + "-01"],
+        )
+    ]
+
+
+def archive_month(db: sqlite3.Connection, yyyymm: str) -> dict:
+    # 1つの月をアーカイブに移す。dbは元のDBへの接続（コミットはここで行う）
+    year = yyyymm[:4]
+    first_date, next_first_date = get_month_date_range(yyyymm)
+    path = get_archive_path(db, year)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if db.in_transaction:
+        db.commit()
+    # 先に書き込みのロックを取り、移している間にその月の商品が増えないようにする
+    db.execute("begin immediate")
+    try:
+        item_list = db.execute(
+            f"select {ITEM_COLUMNS} from item where purchase_date >= ? and purchase_date < ?",
+            [first_date, next_first_date],
+        ).fetchall()
+        service_list = db.execute(
+            f"select {SERVICE_COLUMNS} from service where year_month = ?", [yyyymm]
+        ).fetchall()
+        # 1. アーカイブに書き込んでコミットする（同じ行があれば上書きするので、何度実行してもよい）
+        archive = sqlite3.connect(path)
+        try:
+            with archive:
+                for statement in ARCHIVE_SCHEMA:
+                    archive.execute(statement)
+                archive.executemany(
+                    f"insert or replace into item ({ITEM_COLUMNS}) values (?, ?, ?, ?, ?, ?)",
+                    [tuple(item) for item in item_list],
+                )
+                archive.execute("delete from service where year_month = ?", [yyyymm])
+                archive.executemany(
+                    f"insert into service ({SERVICE_COLUMNS}) values (?, ?, ?, ?)",
+                    [tuple(service) for service in service_list],
+                )
+        finally:
+            archive.close()
+        # 2. 締めた月として記録してから、元のDBから消す（先に記録するので、入力補完の購入回数は減らない）
+        # 履歴画面の上限金額の合計は、締めた月の分をここから読む（aggregate.py）
+        total_usage = sum(item[4] for item in item_list)
+        total_upper_limit = sum(service[3] for service in service_list)
+        db.execute(
+            "insert or replace into archived_months "
+            "(year_month, archive_year, item_count, total_usage, service_count, total_upper_limit, archived_at) "
+            "values (?, ?, ?, ?, ?, ?, ?)",
+            [
+                yyyymm,
+                year,
+                len(item_list),
+                total_usage,
+                len(service_list),
+                total_upper_limit,
+                datetime.datetime.now().isoformat(timespec="seconds"),
+            ],
+        )
+        db.executemany(
+            "insert or ignore into archived_item_names (service_name, item_name) values (?, ?)",
+            [(item[2], item[3]) for item in item_list],
+        )
+        db.execute(
+            "delete from item where purchase_date >= ? and purchase_date < ?",
+            [first_date, next_first_date],
+        )
+        db.execute("delete from service where year_month = ?", [yyyymm])
+        bump_month_versions(db, [yyyymm])
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return {
+        "year_month": yyyymm,
+        "archive_year": year,
+        "item_count": len(item_list),
+        "total_usage": total_usage,
+        "service_count": len(service_list),
+    }
+
+
+def archive_closed_months(db: sqlite3.Connection, yyyymm: str = "", open_months: int = ARCHIVE_OPEN_MONTHS) -> list[dict]:
+    # 締めた月を古い順に1か月ずつアーカイブに移し、年ごとのアーカイブを最後にVACUUMで詰める
+    cutoff_yyyymm = get_archive_cutoff(db, yyyymm or get_current_yyyymm(), open_months)
+    result_list = [archive_month(db, month) for month in get_months_to_archive(db, cutoff_yyyymm)]
+    for year in sorted({result["archive_year"] for result in result_list}):
+        archive = sqlite3.connect(get_archive_path(db, year))
+        archive.execute("vacuum")
+        archive.close()
+    return result_list
+
+
+def verify_archive(db: sqlite3.Connection) -> list[str]:
+    # アーカイブの件数・合計が、移したときに記録したものと合っているかを確かめる（問題がなければ空のリスト）
+    problem_list = []
+    archived_month_list = db.execute(
+        "select year_month, archive_year, item_count, total_usage from archived_months order by year_month"
+    ).fetchall()
+    for year in sorted({row[1] for row in archived_month_list}):
+        if not os.path.exists(get_archive_path(db, year)):
+            problem_list.append(f"{get_archive_path(db, year)} がありません")
+            continue
+        with attached_archive(db, year) as schema:
+            for yyyymm, archive_year, item_count, total_usage in archived_month_list:
+                if archive_year != year:
+                    continue
+                recorded = db.execute(
+                    f"select count(*), coalesce(sum(item_price), 0) from {schema}.item "
+                    "where purchase_date >= ? and purchase_date < ?",
+                    get_month_date_range(yyyymm),
+                ).fetchone()
+                if tuple(recorded) != (item_count, total_usage):
+                    problem_list.append(
+                        f"{yyyymm}: 記録={item_count}件/{total_usage}円, アーカイブ={recorded[0]}件/{recorded[1]}円"
+                    )
+    return problem_list
+
+
+if __name__ == "__main__":
+    import sys
+
+    from config import DATABASE
+    from database import apply_pragmas
+    from schema import migrate
+
+    # 使い方: python archive.py run [YYYY-MM] | verify（cronなどで毎月1日に実行する）
+    # run は YYYY-MM（省略すると今月）から数えて ARCHIVE_OPEN_MONTHS か月より前の月をアーカイブに移す
+    command = sys.argv[1] if len(sys.argv) > 1 else "verify"
+    con = sqlite3.connect(DATABASE)
+    apply_pragmas(con)
+    migrate(con)
+    if command == "run":
+        for result in archive_closed_months(con, sys.argv[2] if len(sys.argv) > 2 else ""):
+            print(
+                f"{result['year_month']} → {result['archive_year']}.db: "
+                f"商品{result['item_count']}件（{result['total_usage']}円）・固定費{result['service_count']}件"
+            )
+        print(f"{get_last_archived_yyyymm(con) or 'なし'}までの月を締めました")
+        con.close()
+    else:
+        problem_list = verify_archive(con)
+        for problem in problem_list:
+            print(problem)
+        print(f"{len(problem_list)}件の問題")
+        con.close()
+        sys.exit(1 if problem_list else 0)
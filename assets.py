@@ -0,0 +1,180 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import shutil
+
+# 画面で使うCSS・JSの静的ファイル
+# CDNから読み込むのをやめ、static/vendor に置いたライブラリを1つの組み合わせに揃えて、自分のサーバーから返す
+#   Bootstrap 5.3.8（CSS・JS）、Popper 2.11.8、Chart.js 4.4.0、Font Awesome Free 6.6.0（solidのみ）
+#
+# python assets.py で static/dist を作り直す（ライブラリやstatic/cssを変えたらコミットする前に実行すること）
+#   1. バンドルごとにファイルを連結し、minifyされていないCSSはminifyする
+#   2. ファイル名に内容のハッシュを付ける（内容が変わればURLも変わるので、ブラウザには1年間キャッシュさせてよい）
+#   3. gzipとbrotliで圧縮したファイルも作っておく（リクエストのたびには圧縮しない）
+#   4. バンドル名と実際のファイル名の対応を manifest.json に書き出す
+
+STATIC_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+ASSET_DIST_DIRECTORY = os.path.join(STATIC_DIRECTORY, "dist")
+ASSET_MANIFEST_FILENAME = "manifest.json"
+
+# バンドル名と、連結するファイル（STATIC_DIRECTORYからのパス）
+ASSET_BUNDLES = {
+    "app.css": [
+        "vendor/bootstrap/bootstrap.min.css",
+        "vendor/fontawesome/css/fontawesome.min.css",
+        "vendor/fontawesome/css/solid.min.css",
+        "css/app.css",
+    ],
+    "app.js": [
+        "vendor/popper/popper.min.js",
+        "vendor/bootstrap/bootstrap.min.js",
+    ],
+    "chart.js": [
+        "vendor/chart.js/chart.umd.min.js",
+    ],
+    "live.js": [
+        "js/live.js",
+    ],
+}
+
+# 圧縮しても小さくならない形式（woff2は既に圧縮されている）
+UNCOMPRESSED_EXTENSION_LIST = [".woff2", ".png", ".jpg", ".gif"]
+
+# mimetypesが知らない形式
+ASSET_MIMETYPES = {
+    ".woff2": "font/woff2",
+    ".ttf": "font/ttf",
+}
+
+CSS_URL_PATTERN = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+
+
+class AssetManifestError(Exception):
+    # static/dist が作られていない
+    pass
+
+
+def minify_css(css: str) -> str:
+    # コメント（/*! で始まるライセンス表記は残す）と余分な空白を取り除く
+    css = re.sub(r"/\*(?!!).*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{};:,>])\s*", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+
+def get_fingerprinted_filename(filename: str, content: bytes) -> str:
+    # app.css → app.1a2b3c4d5e6f7a8b.css
+    name, extension = os.path.splitext(filename)
+    return f"{name}.{hashlib.sha256(content).hexdigest()[:16]}{extension}"
+
+
+def write_asset(filename: str, content: bytes, files: dict):
+    # ハッシュ付きのファイルと、小さくなる場合はその圧縮版を書き出す
+    fingerprinted_filename = get_fingerprinted_filename(filename, content)
+    path = os.path.join(ASSET_DIST_DIRECTORY, fingerprinted_filename)
+    with open(path, "wb") as file:
+        file.write(content)
+    encoding_list = []
+    if os.path.splitext(filename)[1] not in UNCOMPRESSED_EXTENSION_LIST:
+        # mtime=0にすると、同じ内容からは毎回同じ.gzができる
+        for encoding, extension, compressed in [
+            ("br", ".br", compress_brotli(content)),
+            ("gzip", ".gz", gzip.compress(content, 9, mtime=0)),
+        ]:
+            if compressed is not None and len(compressed) < len(content):
+                with open(path + extension, "wb") as file:
+                    file.write(compressed)
+                encoding_list.append(encoding)
+    files[fingerprinted_filename] = encoding_list
+    return fingerprinted_filename
+
+
+def compress_brotli(content: bytes):
+    # brotliは必須ではない（入っていなければ.brを作らず、gzipだけにする）
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli.compress(content, quality=11)
+
+
+def rewrite_css_urls(css: str, source_path: str, files: dict) -> str:
+    # CSSから参照しているフォントなども、ハッシュ付きのファイル名でdistに置いてURLを書き換える
+    def replace_url(match):
+        url = match.group(2)
+        if url.startswith(("data:", "http:", "https:", "/", "#")):
+            return match.group(0)
+        path = os.path.normpath(
+            os.path.join(os.path.dirname(source_path), url.split("?")[0].split("#")[0])
+        )
+        with open(path, "rb") as file:
+            fingerprinted_filename = write_asset(os.path.basename(path), file.read(), files)
+        return f"url({fingerprinted_filename})"
+
+    return CSS_URL_PATTERN.sub(replace_url, css)
+
+
+def build_assets() -> dict:
+    if os.path.isdir(ASSET_DIST_DIRECTORY):
+        shutil.rmtree(ASSET_DIST_DIRECTORY)
+    os.makedirs(ASSET_DIST_DIRECTORY)
+    files = {}
+    bundles = {}
+    for bundle_name, source_list in ASSET_BUNDLES.items():
+        chunk_list = []
+        for source in source_list:
+            source_path = os.path.join(STATIC_DIRECTORY, source)
+            with open(source_path, encoding="utf-8") as file:
+                text = file.read()
+            if bundle_name.endswith(".css"):
+                if ".min." not in source:
+                    text = minify_css(text)
+                # 連結すると@charsetが途中に来てしまうので取り除く（UTF-8として返す）
+                text = text.replace('@charset "UTF-8";', "")
+                text = rewrite_css_urls(text, source_path, files)
+            else:
+                # 前のファイルが;で終わっていなくても壊れないようにする
+                text = text.rstrip() + ";"
+            chunk_list.append(text)
+        content = "\n".join(chunk_list).encode("utf-8")
+        bundles[bundle_name] = write_asset(bundle_name, content, files)
+    manifest = {"bundles": bundles, "files": files}
+    with open(os.path.join(ASSET_DIST_DIRECTORY, ASSET_MANIFEST_FILENAME), "w") as file:
+        json.dump(manifest, file, indent=2, sort_keys=True)
+    return manifest
+
+
+def load_asset_manifest(directory: str = ASSET_DIST_DIRECTORY) -> dict:
+    try:
+        with open(os.path.join(directory, ASSET_MANIFEST_FILENAME)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        raise AssetManifestError(f"{directory} がありません。python assets.py を実行してください")
+
+
+def get_asset_mimetype(filename: str) -> str:
+    extension = os.path.splitext(filename)[1]
+    return ASSET_MIMETYPES.get(extension) or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+def choose_asset_encoding(encoding_list: list[str], accept_encodings) -> str:
+    # ブラウザが受け取れる形式のうち、最も小さいもの（brotli → gzip）を選ぶ。どちらもだめなら圧縮しない
+    for encoding in encoding_list:
+        if accept_encodings[encoding]:
+            return encoding
+    return ""
+
+
+if __name__ == "__main__":
+    manifest = build_assets()
+    for bundle_name, filename in manifest["bundles"].items():
+        path = os.path.join(ASSET_DIST_DIRECTORY, filename)
+        sizes = [f"{os.path.getsize(path)}B"] + [
+            f"{encoding} {os.path.getsize(path + extension)}B"
+            for encoding, extension in [("br", ".br"), ("gzip", ".gz")]
+            if encoding in manifest["files"][filename]
+        ]
+        print(f"{bundle_name} → {filename} ({', '.join(sizes)})")
@@ -0,0 +1,351 @@
+import datetime
+import gzip
+import os
+import shutil
+import sqlite3
+import time
+import zlib
+
+from config import (
+    BACKUP_COMPRESS,
+    BACKUP_DIRECTORY,
+    BACKUP_MAX_RESTARTS,
+    BACKUP_PAGES_PER_STEP,
+    BACKUP_RETENTION,
+    BACKUP_STEP_INTERVAL,
+    DATABASE_BUSY_TIMEOUT_MS,
+)
+from schema import SCHEMA_VERSION
+from snapshot import SNAPSHOT_EXTENSION
+
+# 動いているアプリを止めずに取るDBのバックアップ（スナップショット）
+# ファイルをそのままコピーすると、書き込みの途中の壊れたコピーになることがあるので、SQLiteのオンラインバックアップを使う
+#   - BACKUP_PAGES_PER_STEP ページずつコピーし、ステップの間に BACKUP_STEP_INTERVAL 秒休む
+#     （WALモードでは1ステップの間だけ読み込みのトランザクションを開くので、書き込みは止まらない。休むのはディスクを使い切らないため）
+#   - コピーしている間に他の接続が書き込むと、SQLiteは最初からコピーし直す。BACKUP_MAX_RESTARTS 回やり直したら、
+#     残りを1ステップでコピーする（1つの読み込みのトランザクションになるが、WALモードなので書き込みは止まらない）
+#   - 一時ファイルにコピーし、integrity_checkで確かめてから（BACKUP_COMPRESSならgzipで圧縮してから）名前を変える
+#     （途中で止まっても、壊れたスナップショットが残ることはない）
+# 締めた月のアーカイブ（archive.py の <DB>.archive/YYYY.db）も、スナップショットの隣の <スナップショット>.archive/ にコピーする
+# アーカイブへの書き込みは元のDBより先にコミットされるので、元のDBの後にコピーすれば、元のDBで締めた月は必ずアーカイブにある
+# スナップショットはDBごとのディレクトリに「日時.db」（圧縮したら「日時.db.gz」）で保存し、新しい BACKUP_RETENTION 個だけ残す
+
+BACKUP_TIMESTAMP_FORMAT = "%Y%m%d-%H%M%S"
+ARCHIVE_DIRECTORY_EXTENSION = ".archive"
+COMPRESSED_EXTENSION = ".gz"
+COPY_CHUNK_SIZE = 1024 * 1024
+# gzipの圧縮レベル（9にしても小さくなるのは数%で、時間は何倍もかかる）
+COMPRESS_LEVEL = 6
+
+
+class BackupError(Exception):
+    # バックアップ・復元に使うスナップショットが壊れている、または見つからない
+    pass
+
+
+class BackupRestartedError(Exception):
+    # コピーしている間の書き込みで、BACKUP_MAX_RESTARTS 回やり直した（残りを1ステップでコピーし直す）
+    pass
+
+
+def connect_for_backup(path: str) -> sqlite3.Connection:
+    # スナップショットを取る・書き込むための接続（元のDBのジャーナルモードは変えない）
+    con = sqlite3.connect(path)
+    con.execute(f"pragma busy_timeout = {DATABASE_BUSY_TIMEOUT_MS}")
+    return con
+
+
+def copy_database(
+    source_path: str,
+    target_path: str,
+    pages_per_step: int = BACKUP_PAGES_PER_STEP,
+    step_interval: float = BACKUP_STEP_INTERVAL,
+    max_restarts: int = BACKUP_MAX_RESTARTS,
+) -> dict:
+    # source_pathのDBをtarget_pathに少しずつコピーする。コピーしたページ数とやり直した回数を返す
+    progress = {"pages": 0, "steps": 0, "restarts": 0, "remaining": None}
+
+    def on_progress(status, remaining, total):
+        # 残りのページ数が増えたら、書き込みがあって最初からやり直している
+        if progress["remaining"] is not None and remaining > progress["remaining"]:
+            progress["restarts"] += 1
+            if progress["restarts"] > max_restarts:
+                raise BackupRestartedError()
+        progress["remaining"] = remaining
+        progress["pages"] = total
+        progress["steps"] += 1
+        if step_interval > 0 and remaining > 0:
+            time.sleep(step_interval)
+
+    source = connect_for_backup(source_path)
+    target = connect_for_backup(target_path)
+    try:
+        try:
+            source.backup(target, pages=pages_per_step, progress=on_progress)
+        except BackupRestartedError:
+            source.backup(target, pages=-1)
+        # 元のDBがWALモードでも、スナップショットは1つのファイルで開けるようにする
+        target.execute("pragma journal_mode = delete")
+    finally:
+        target.close()
+        source.close()
+    return {"pages": progress["pages"], "steps": progress["steps"], "restarts": progress["restarts"]}
+
+
+def check_database(path: str, expect_schema: bool = True) -> list[str]:
+    # スナップショットの中身を確かめる（問題がなければ空のリスト）
+    # expect_schemaがTrueなら家計簿のDBとして、新しいアプリで作ったものでないかも確かめる（古いものは起動時にマイグレーションされる）
+    try:
+        con = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        try:
+            problem_list = [
+                row[0] for row in con.execute("pragma integrity_check") if row[0] != "ok"
+            ]
+            schema_version = con.execute("pragma user_version").fetchone()[0]
+        finally:
+            con.close()
+    except sqlite3.DatabaseError as e:
+        return [f"{path}: {e}"]
+    if expect_schema and schema_version > SCHEMA_VERSION:
+        problem_list.append(f"スキーマのバージョン{schema_version}は、このバージョンのアプリでは読めません")
+    return [f"{path}: {problem}" for problem in problem_list]
+
+
+def compress_file(path: str) -> str:
+    # pathをgzipで圧縮したファイルにし、元のファイルを消す
+    compressed_path = path + COMPRESSED_EXTENSION
+    with open(path, "rb") as source, gzip.open(compressed_path + ".tmp", "wb", COMPRESS_LEVEL) as target:
+        shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+    os.replace(compressed_path + ".tmp", compressed_path)
+    os.remove(path)
+    return compressed_path
+
+
+def decompress_file(path: str, target_path: str):
+    with gzip.open(path, "rb") as source, open(target_path, "wb") as target:
+        shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+
+
+def take_snapshot(source_path: str, target_path: str, compress: bool, expect_schema: bool = True) -> dict:
+    # 一時ファイルにコピーし、確かめて（圧縮して）から target_path（圧縮したら target_path.gz）にする
+    temporary_path = target_path + ".tmp"
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    try:
+        result = copy_database(source_path, temporary_path)
+        problem_list = check_database(temporary_path, expect_schema)
+        if problem_list:
+            raise BackupError("\n".join(problem_list))
+        os.replace(temporary_path, target_path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    if compress:
+        target_path = compress_file(target_path)
+    return {**result, "path": target_path, "size": os.path.getsize(target_path)}
+
+
+def backup_database(
+    database_path: str,
+    directory: str,
+    compress: bool = BACKUP_COMPRESS,
+    retention: int = BACKUP_RETENTION,
+) -> dict:
+    # database_pathのスナップショットをdirectoryに取り、古いスナップショットを消す
+    if not os.path.exists(database_path):
+        raise BackupError(f"DBがありません：{database_path}")
+    os.makedirs(directory, exist_ok=True)
+    started_at = time.perf_counter()
+    snapshot_path = os.path.join(
+        directory, datetime.datetime.now().strftime(BACKUP_TIMESTAMP_FORMAT) + ".db"
+    )
+    if get_backup_path(snapshot_path) != "":
+        raise BackupError(f"同じ時刻のスナップショットがあります：{snapshot_path}")
+    result = take_snapshot(database_path, snapshot_path, compress)
+    # 締めた月のアーカイブは、元のDBの後にコピーする
+    archive_directory = database_path + ARCHIVE_DIRECTORY_EXTENSION
+    archive_result_list = []
+    if os.path.isdir(archive_directory):
+        snapshot_archive_directory = snapshot_path + ARCHIVE_DIRECTORY_EXTENSION
+        os.makedirs(snapshot_archive_directory, exist_ok=True)
+        for filename in sorted(os.listdir(archive_directory)):
+            if filename.endswith(".db"):
+                archive_result_list.append(
+                    take_snapshot(
+                        os.path.join(archive_directory, filename),
+                        os.path.join(snapshot_archive_directory, filename),
+                        compress,
+                        expect_schema=False,
+                    )
+                )
+    removed_list = remove_old_backups(directory, retention)
+    return {
+        **result,
+        "archives": len(archive_result_list),
+        "archive_size": sum(archive_result["size"] for archive_result in archive_result_list),
+        "seconds": round(time.perf_counter() - started_at, 3),
+        "removed": removed_list,
+    }
+
+
+def get_backup_path(snapshot_path: str) -> str:
+    # 「日時.db」のスナップショット（圧縮したものも含む）があればそのパスを、なければ空文字列を返す
+    for path in (snapshot_path, snapshot_path + COMPRESSED_EXTENSION):
+        if os.path.exists(path):
+            return path
+    return ""
+
+
+def list_backups(directory: str) -> list[str]:
+    # directoryのスナップショット（「日時.db」または「日時.db.gz」）を古い順に返す
+    if not os.path.isdir(directory):
+        return []
+    path_list = []
+    for filename in os.listdir(directory):
+        name = filename.removesuffix(COMPRESSED_EXTENSION)
+        if not name.endswith(".db"):
+            continue
+        try:
+            datetime.datetime.strptime(name[:-3], BACKUP_TIMESTAMP_FORMAT)
+        except ValueError:
+            continue
+        path_list.append(os.path.join(directory, filename))
+    return sorted(path_list)
+
+
+def remove_old_backups(directory: str, retention: int = BACKUP_RETENTION) -> list[str]:
+    # 新しいretention個を残して、古いスナップショットとそのアーカイブを消す。消したスナップショットを返す
+    path_list = list_backups(directory)
+    removed_list = path_list[: max(len(path_list) - retention, 0)]
+    for path in removed_list:
+        os.remove(path)
+        archive_directory = path.removesuffix(COMPRESSED_EXTENSION) + ARCHIVE_DIRECTORY_EXTENSION
+        if os.path.isdir(archive_directory):
+            shutil.rmtree(archive_directory)
+    return removed_list
+
+
+def open_snapshot(path: str, temporary_path: str) -> str:
+    # 圧縮されたスナップショットはtemporary_pathに展開し、読めるDBファイルのパスを返す
+    if not os.path.exists(path):
+        raise BackupError(f"スナップショットがありません：{path}")
+    if not path.endswith(COMPRESSED_EXTENSION):
+        return path
+    decompress_file(path, temporary_path)
+    return temporary_path
+
+
+def verify_backup(path: str) -> list[str]:
+    # スナップショットとそのアーカイブが壊れていないかを確かめる（問題がなければ空のリスト）
+    snapshot_path = path.removesuffix(COMPRESSED_EXTENSION)
+    temporary_path = snapshot_path + ".verify.tmp"
+    archive_directory = snapshot_path + ARCHIVE_DIRECTORY_EXTENSION
+    target_list = [(path, True)]
+    if os.path.isdir(archive_directory):
+        target_list += [
+            (os.path.join(archive_directory, filename), False)
+            for filename in sorted(os.listdir(archive_directory))
+            if filename.removesuffix(COMPRESSED_EXTENSION).endswith(".db")
+        ]
+    problem_list = []
+    for target_path, expect_schema in target_list:
+        try:
+            problem_list += check_database(open_snapshot(target_path, temporary_path), expect_schema)
+        except (BackupError, OSError, EOFError, zlib.error) as e:
+            # 途中で切れた・壊れたgzipは、展開できないスナップショットとして扱う
+            problem_list.append(f"{target_path}: {e}")
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+    return problem_list
+
+
+def restore_backup(path: str, database_path: str) -> dict:
+    # スナップショットを確かめてから、database_pathに書き戻す（アーカイブも <database_path>.archive/ に書き戻す）
+    # 書き戻しもオンラインバックアップで行うので、database_pathが開かれていても壊れない（アプリは止めておくこと）
+    problem_list = verify_backup(path)
+    if problem_list:
+        raise BackupError("\n".join(problem_list))
+    snapshot_path = path.removesuffix(COMPRESSED_EXTENSION)
+    temporary_path = database_path + ".restore.tmp"
+    # 書き戻す先に残っている集計用のスナップショット（snapshot.py）と、バックアップを取った後に締めた年のアーカイブは、
+    # 書き戻したDBと食い違うので先に消す（アーカイブはスナップショットにあるものだけを書き戻す）
+    if os.path.exists(database_path + SNAPSHOT_EXTENSION):
+        os.remove(database_path + SNAPSHOT_EXTENSION)
+    if os.path.isdir(database_path + ARCHIVE_DIRECTORY_EXTENSION):
+        shutil.rmtree(database_path + ARCHIVE_DIRECTORY_EXTENSION)
+    target_list = [(path, database_path)]
+    archive_directory = snapshot_path + ARCHIVE_DIRECTORY_EXTENSION
+    if os.path.isdir(archive_directory):
+        os.makedirs(database_path + ARCHIVE_DIRECTORY_EXTENSION, exist_ok=True)
+        target_list += [
+            (
+                os.path.join(archive_directory, filename),
+                os.path.join(
+                    database_path + ARCHIVE_DIRECTORY_EXTENSION,
+                    filename.removesuffix(COMPRESSED_EXTENSION),
+                ),
+            )
+            for filename in sorted(os.listdir(archive_directory))
+            if filename.removesuffix(COMPRESSED_EXTENSION).endswith(".db")
+        ]
+    for source_path, target_path in target_list:
+        try:
+            source = connect_for_backup(open_snapshot(source_path, temporary_path))
+            target = connect_for_backup(target_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+    return {"path": database_path, "archives": len(target_list) - 1}
+
+
+def get_backup_directory(household_id: str = "", directory: str = BACKUP_DIRECTORY) -> str:
+    # 世帯ごとのDB（households.py）は、世帯ごとのディレクトリにスナップショットを取る
+    if household_id:
+        return os.path.join(directory, "households", household_id)
+    return os.path.join(directory, "default")
+
+
+if __name__ == "__main__":
+    import sys
+
+    from config import DATABASE, HOUSEHOLD_DATABASE_DIRECTORY
+    from households import list_households
+
+    # 使い方: python backup.py run [--gzip] | list | verify スナップショット | restore スナップショット 書き戻すDB
+    # run はcronなどで毎晩実行する。DATABASEと全ての世帯のDBのスナップショットを取り、古いものを消す
+    command = sys.argv[1] if len(sys.argv) > 1 else "list"
+    target_list = [("", DATABASE)] + [
+        (household_id, os.path.join(HOUSEHOLD_DATABASE_DIRECTORY, household_id + ".db"))
+        for household_id in list_households()
+    ]
+    if command == "run":
+        compress = BACKUP_COMPRESS or "--gzip" in sys.argv[2:]
+        for household_id, database_path in target_list:
+            result = backup_database(database_path, get_backup_directory(household_id), compress)
+            print(
+                f"{database_path} → {result['path']}: {result['pages']}ページ・{result['size']}バイト"
+                f"（アーカイブ{result['archives']}件・やり直し{result['restarts']}回・{result['seconds']}秒）"
+            )
+            for removed_path in result["removed"]:
+                print(f"古いスナップショットを消しました：{removed_path}")
+    elif command == "list":
+        for household_id, database_path in target_list:
+            for path in list_backups(get_backup_directory(household_id)):
+                print(f"{database_path}: {path}（{os.path.getsize(path)}バイト）")
+    elif command == "verify":
+        problem_list = verify_backup(sys.argv[2])
+        for problem in problem_list:
+            print(problem)
+        print(f"{len(problem_list)}件の問題")
+        sys.exit(1 if problem_list else 0)
+    elif command == "restore":
+        # 書き戻す先は省略できない（動いているDBを誤って上書きしないため）
+        result = restore_backup(sys.argv[2], sys.argv[3])
+        print(f"{sys.argv[2]}を{result['path']}に書き戻しました（アーカイブ{result['archives']}件）")
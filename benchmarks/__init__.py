@@ -0,0 +1,4 @@
+# app.pyの各画面の速さを測るためのベンチマーク（リポジトリの直下で実行する）
+#   python -m benchmarks.generate --output bench.db           # 試験用の家計簿を作る
+#   python -m benchmarks.run --database bench.db --output result.json
+#   python -m benchmarks.compare baseline.json result.json    # 基準の結果と比べる
@@ -0,0 +1,55 @@
+import argparse
+import json
+import sys
+
+# p95のレイテンシがこの割合より遅くなったら、または1リクエストのSQLの回数が増えたら退行とみなす
+DEFAULT_LATENCY_TOLERANCE = 0.2
+
+
+def compare(baseline: dict, result: dict, tolerance: float = DEFAULT_LATENCY_TOLERANCE) -> list[str]:
+    # 退行した画面の説明を返す。空のリストなら退行はない
+    regression_list = []
+    for name, baseline_route in baseline["routes"].items():
+        route = result["routes"].get(name)
+        if route is None:
+            continue
+        if route["p95_ms"] > baseline_route["p95_ms"] * (1 + tolerance):
+            regression_list.append(
+                f"{name}: p95 {baseline_route['p95_ms']:.2f}ms -> {route['p95_ms']:.2f}ms"
+            )
+        if route["queries_per_request"] > baseline_route["queries_per_request"]:
+            regression_list.append(
+                f"{name}: queries {baseline_route['queries_per_request']} -> {route['queries_per_request']}"
+            )
+        if route["status_codes"] != baseline_route["status_codes"]:
+            regression_list.append(
+                f"{name}: status {baseline_route['status_codes']} -> {route['status_codes']}"
+            )
+    return regression_list
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ベンチマークの結果を基準の結果と比べる")
+    parser.add_argument("baseline")
+    parser.add_argument("result")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_LATENCY_TOLERANCE)
+    args = parser.parse_args(argv)
+    with open(args.baseline, encoding="utf-8") as file:
+        baseline = json.load(file)
+    with open(args.result, encoding="utf-8") as file:
+        result = json.load(file)
+    for name, route in result["routes"].items():
+        baseline_route = baseline["routes"].get(name)
+        if baseline_route is None:
+            print(f"{name:40} (新規) p95 {route['p95_ms']:.2f}ms")
+            continue
+        change = (route["p95_ms"] - baseline_route["p95_ms"]) / baseline_route["p95_ms"] * 100 if baseline_route["p95_ms"] else 0.0
+        print(f"{name:40} p95 {baseline_route['p95_ms']:>9.2f}ms -> {route['p95_ms']:>9.2f}ms ({change:+.1f}%)")
+    regression_list = compare(baseline, result, args.tolerance)
+    for regression in regression_list:
+        print(f"退行: {regression}")
+    sys.exit(1 if regression_list else 0)
+
+
+if __name__ == "__main__":
+    main()
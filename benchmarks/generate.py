@@ -0,0 +1,100 @@
+import argparse
+import os
+import random
+import sqlite3
+import time
+
+from config import ITEM_ATTRIBUTE_LIST
+from cube import rebuild_spending_cube
+from rollup import rebuild_month_service_totals
+from schema import migrate
+from util import get_current_yyyymm
+
+GENERATE_BATCH_SIZE = 10000
+
+
+def get_year_month_list(years: int, last_yyyymm: str) -> list[str]:
+    # last_yyyymm までの years 年分の年月を古い順に返す
+    year = int(last_yyyymm[:4])
+    month = int(last_yyyymm[5:])
+    year_month_list = []
+    for _ in range(years * 12):
+        year_month_list.append(f"{year}-{month:02}")
+        month -= 1
+        if month == 0:
+            year -= 1
+            month = 12
+    return year_month_list[::-1]
+
+
+def iter_items(rng: random.Random, year_month_list: list[str], service_name_list: list[str], items: int):
+    # 同じ固定費で同じ名前の商品は登録できないので、商品名には通し番号を付ける
+    for item_number in range(items):
+        year_month = rng.choice(year_month_list)
+        yield (
+            f"{year_month}-{rng.randint(1, 28):02}",
+            rng.choice(service_name_list),
+            f"商品{item_number}",
+            rng.randint(100, 5000),
+            rng.choice(ITEM_ATTRIBUTE_LIST),
+        )
+
+
+def generate(path: str, years: int, services: int, items: int, seed: int = 0, last_yyyymm: str = "") -> dict:
+    # 同じ引数なら毎回同じ内容の家計簿を作る
+    rng = random.Random(seed)
+    year_month_list = get_year_month_list(years, last_yyyymm or get_current_yyyymm())
+    service_name_list = [f"固定費{service_number}" for service_number in range(services)]
+    upper_limit_list = [rng.randint(10, 100) * 1000 for _ in service_name_list]
+
+    if os.path.exists(path):
+        os.remove(path)
+    con = sqlite3.connect(path)
+    migrate(con)
+    started_at = time.perf_counter()
+    with con:
+        con.executemany(
+            "insert into service (year_month, service_name, upper_limit) values (?, ?, ?)",
+            [
+                (year_month, service_name, upper_limit)
+                for year_month in year_month_list
+                for service_name, upper_limit in zip(service_name_list, upper_limit_list)
+            ],
+        )
+        item_iter = iter_items(rng, year_month_list, service_name_list, items)
+        while True:
+            batch = [item for _, item in zip(range(GENERATE_BATCH_SIZE), item_iter)]
+            if not batch:
+                break
+            con.executemany(
+                "insert into item (purchase_date, service_name, item_name, item_price, item_attribute) values (?, ?, ?, ?, ?)",
+                batch,
+            )
+    rebuild_month_service_totals(con)
+    rebuild_spending_cube(con)
+    con.execute("analyze")
+    con.close()
+    return {
+        "path": path,
+        "months": len(year_month_list),
+        "services": services,
+        "items": items,
+        "seed": seed,
+        "seconds": round(time.perf_counter() - started_at, 2),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ベンチマーク用の家計簿を作る")
+    parser.add_argument("--output", default="bench.db")
+    parser.add_argument("--years", type=int, default=5)
+    parser.add_argument("--services", type=int, default=30)
+    parser.add_argument("--items", type=int, default=1000000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--last-month", default="", help="最後の月（YYYY-MM）。省略すると今月")
+    args = parser.parse_args(argv)
+    print(generate(args.output, args.years, args.services, args.items, args.seed, args.last_month))
+
+
+if __name__ == "__main__":
+    main()
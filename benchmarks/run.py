@@ -0,0 +1,273 @@
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+MEMORY_ITERATIONS = 3
+
+
+def percentile(sorted_value_list: list[float], percent: float) -> float:
+    # 最近傍順位法でパーセンタイルを求める
+    if not sorted_value_list:
+        return 0.0
+    rank = max(0, min(len(sorted_value_list) - 1, round(percent / 100 * len(sorted_value_list) + 0.5) - 1))
+    return sorted_value_list[rank]
+
+
+def load_app(database: str):
+    # create_appにDBのパスを渡して、ベンチマーク用のDBを使うアプリを作る
+    from app import connect_db, create_app, init_database
+    from households import HouseholdRouter
+
+    app = create_app({"DATABASE": database})
+    init_database(app)
+
+    # 1リクエストで何回SQLを実行したかを数えるため、接続ごとにトレースを設定する
+    query_counter = {"count": 0}
+
+    def connect_db_with_trace(path):
+        con = connect_db(path)
+
+        def count_query(statement):
+            query_counter["count"] += 1
+
+        con.set_trace_callback(count_query)
+        return con
+
+    app.extensions["kakeibo"]["router"] = HouseholdRouter(connect_db_with_trace, database=database)
+    return app, query_counter
+
+
+def get_route_list(database: str, yyyymm: str) -> list[dict]:
+    # app.pyの全ての画面について、リクエストの作り方を決める
+    # writeがTrueのものはDBを書き換える（ベンチマークはDBのコピーに対して行う）
+    con = sqlite3.connect(database)
+    service_name = con.execute(
+        "select service_name from service where year_month = ? order by service_id", [yyyymm]
+    ).fetchone()[0]
+    item_id = con.execute(
+        "select max(item_id) from item where service_name = ?", [service_name]
+    ).fetchone()[0]
+    past_yyyymm = con.execute(
+        "select min(year_month) from service"
+    ).fetchone()[0]
+    con.close()
+
+    def register_item(iteration):
+        return {
+            "purchase_date": f"{yyyymm}-01",
+            "service_name": service_name,
+            "item_name": f"ベンチマーク{iteration}",
+            "item_price": "1000",
+            "item_attribute": "夫",
+        }
+
+    def import_items(iteration):
+        rows = ["購入日,カテゴリ,商品名,値段,購入者"] + [
+            f"{yyyymm}-02,{service_name},一括{iteration}_{row_number},500,妻"
+            for row_number in range(100)
+        ]
+        return {"file": (io.BytesIO("\n".join(rows).encode()), "bench.csv")}
+
+    return [
+        {"name": "GET /", "url": lambda i: "/"},
+        {"name": "GET /service_detail", "url": lambda i: "/service_detail"},
+        {"name": "GET /history", "url": lambda i: "/history"},
+        {"name": "GET item_detail (今月)", "url": lambda i: f"/{service_name}/{yyyymm}/item_detail"},
+        {"name": "GET item_detail (過去の月)", "url": lambda i: f"/{service_name}/{past_yyyymm}/item_detail"},
+        {"name": "GET /item_register", "url": lambda i: "/item_register"},
+        {"name": "GET /service_register", "url": lambda i: "/service_register"},
+        {"name": "GET /item_import", "url": lambda i: "/item_import"},
+        {"name": "GET service_edit", "url": lambda i: f"/{service_name}/service_edit"},
+        {"name": "GET service_delete", "url": lambda i: f"/{service_name}/service_delete"},
+        {"name": "GET item_edit", "url": lambda i: f"/{service_name}/item_edit/{item_id}"},
+        {"name": "GET item_delete", "url": lambda i: f"/{service_name}/item_delete/{item_id}"},
+        {"name": "GET /export/items.csv (今月)", "url": lambda i: f"/export/items.csv?month={yyyymm}"},
+        {"name": "GET /export/history.json", "url": lambda i: "/export/history.json"},
+        {"name": "GET /api/v1/months/summary", "url": lambda i: f"/api/v1/months/{yyyymm}/summary"},
+        {"name": "GET /api/v1/services/items", "url": lambda i: f"/api/v1/services/{service_name}/items"},
+        {"name": "GET /api/v1/history", "url": lambda i: "/api/v1/history"},
+        {"name": "GET /spending", "url": lambda i: "/spending"},
+        {"name": "GET /spending (今月)", "url": lambda i: f"/spending?month={yyyymm}"},
+        {"name": "GET /spending (固定費)", "url": lambda i: f"/spending?service={service_name}"},
+        {"name": "GET /api/v1/range", "url": lambda i: f"/api/v1/range?from={past_yyyymm}&to={yyyymm}"},
+        {
+            "name": "GET /api/v1/range (固定費・購入者)",
+            "url": lambda i: f"/api/v1/range?from={past_yyyymm}-15&to={yyyymm}-10&service={service_name}&attribute=妻",
+        },
+        {"name": "GET /api/v1/spending", "url": lambda i: "/api/v1/spending?group_by=month,attribute"},
+        {"name": "GET /api/v1/items/search", "url": lambda i: f"/api/v1/items/search?q=商品{i}"},
+        {"name": "GET /api/v1/items/search (2文字)", "url": lambda i: f"/api/v1/items/search?q=商品&month={yyyymm}"},
+        {"name": "GET /api/v1/items/autocomplete", "url": lambda i: f"/api/v1/items/autocomplete?q=商品{i % 10}"},
+        {"name": "GET /health", "url": lambda i: "/health"},
+        {
+            "name": "POST /item_register",
+            "method": "POST",
+            "url": lambda i: "/item_register",
+            "data": register_item,
+            "write": True,
+        },
+        {
+            "name": "POST item_edit",
+            "method": "POST",
+            "url": lambda i: f"/{service_name}/item_edit/{item_id}",
+            "data": lambda i: {
+                "purchase_date": f"{yyyymm}-03",
+                "service_name": service_name,
+                "item_name": f"ベンチマーク編集{i}",
+                "item_price": str(1000 + i),
+                "item_attribute": "妻",
+            },
+            "write": True,
+        },
+        {
+            "name": "POST service_edit",
+            "method": "POST",
+            "url": lambda i: f"/{service_name}/service_edit",
+            "data": lambda i: {"service_name": service_name, "upper_limit": str(50000 + i)},
+            "write": True,
+        },
+        {
+            "name": "POST /service_register",
+            "method": "POST",
+            "url": lambda i: "/service_register",
+            "data": lambda i: {"service_name": f"ベンチマーク固定費{i}", "upper_limit": "1000"},
+            "write": True,
+        },
+        {
+            "name": "POST service_delete",
+            "method": "POST",
+            "url": lambda i: f"/ベンチマーク固定費{i}/service_delete",
+            "data": lambda i: {"service_name": f"ベンチマーク固定費{i}"},
+            "write": True,
+        },
+        {
+            "name": "POST /item_import (100行)",
+            "method": "POST",
+            "url": lambda i: "/item_import",
+            "data": import_items,
+            "write": True,
+        },
+    ]
+
+
+def request_route(client, route: dict, iteration: int):
+    method = route.get("method", "GET")
+    data = route["data"](iteration) if "data" in route else None
+    response = client.open(route["url"](iteration), method=method, data=data)
+    # ストリーミングのレスポンスも最後まで読む
+    response.get_data()
+    response.close()
+    return response.status_code
+
+
+def measure_route(app, query_counter, route: dict, iterations: int, warmup: int, warm_cache: bool) -> dict:
+    client = app.test_client()
+    for iteration in range(warmup):
+        request_route(client, route, -1 - iteration)
+
+    duration_list = []
+    query_count_list = []
+    status_code_set = set()
+    for iteration in range(iterations):
+        # 既定では画面のキャッシュを使わずに、毎回描画する時間を測る
+        if not warm_cache:
+            app.extensions["kakeibo"]["page_cache"].clear()
+        query_count_before = query_counter["count"]
+        started_at = time.perf_counter()
+        status_code_set.add(request_route(client, route, iteration))
+        duration_list.append((time.perf_counter() - started_at) * 1000)
+        query_count_list.append(query_counter["count"] - query_count_before)
+
+    # tracemallocを動かすと遅くなるので、メモリは別に少ない回数で測る
+    if not warm_cache:
+        app.extensions["kakeibo"]["page_cache"].clear()
+    tracemalloc.start()
+    for iteration in range(MEMORY_ITERATIONS):
+        request_route(client, route, iterations + iteration)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    duration_list.sort()
+    return {
+        "iterations": iterations,
+        "status_codes": sorted(status_code_set),
+        "p50_ms": round(percentile(duration_list, 50), 3),
+        "p95_ms": round(percentile(duration_list, 95), 3),
+        "p99_ms": round(percentile(duration_list, 99), 3),
+        "mean_ms": round(sum(duration_list) / len(duration_list), 3),
+        "queries_per_request": round(sum(query_count_list) / len(query_count_list), 2),
+        "peak_memory_kib": round(peak_memory / 1024, 1),
+    }
+
+
+def run(database: str, iterations: int = 50, warmup: int = 3, warm_cache: bool = False, route_filter: str = "") -> dict:
+    from util import get_current_yyyymm
+
+    # 書き込みのベンチマークで元のDBが変わらないように、コピーに対して実行する
+    work_directory = tempfile.mkdtemp(prefix="kakeibo_bench_")
+    work_database = os.path.join(work_directory, "bench.db")
+    shutil.copyfile(database, work_database)
+    try:
+        app, query_counter = load_app(work_database)
+        yyyymm = get_current_yyyymm()
+        result_list = {}
+        for route in get_route_list(work_database, yyyymm):
+            if route_filter and route_filter not in route["name"]:
+                continue
+            result_list[route["name"]] = measure_route(
+                app, query_counter, route, iterations, warmup, warm_cache
+            )
+        app.extensions["kakeibo"]["router"].close()
+    finally:
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    con = sqlite3.connect(database)
+    meta = {
+        "database": os.path.basename(database),
+        "items": con.execute("select count(*) from item").fetchone()[0],
+        "services": con.execute("select count(*) from service").fetchone()[0],
+        "iterations": iterations,
+        "warm_cache": warm_cache,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.machine(),
+    }
+    con.close()
+    return {"meta": meta, "routes": result_list}
+
+
+def print_result(result: dict):
+    print(f"{'route':40} {'p50':>9} {'p95':>9} {'p99':>9} {'queries':>8} {'peak KiB':>10}")
+    for name, route_result in result["routes"].items():
+        print(
+            f"{name:40} {route_result['p50_ms']:>9.2f} {route_result['p95_ms']:>9.2f} "
+            f"{route_result['p99_ms']:>9.2f} {route_result['queries_per_request']:>8.1f} "
+            f"{route_result['peak_memory_kib']:>10.1f}"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="app.pyの各画面のレイテンシを測る")
+    parser.add_argument("--database", default="bench.db")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--warm-cache", action="store_true", help="画面のキャッシュを有効にしたまま測る")
+    parser.add_argument("--route", default="", help="名前にこの文字列を含む画面だけ測る")
+    parser.add_argument("--output", default="", help="結果をJSONで保存するファイル")
+    args = parser.parse_args(argv)
+    result = run(args.database, args.iterations, args.warmup, args.warm_cache, args.route)
+    print_result(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(result, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+import sqlite3
+
+from config import CHANGE_LOG_TOMBSTONE_RETENTION_DAYS
+
+# 差分同期（手元に家計簿のコピーを持つクライアントが、変わった行の分だけを受け取って更新する）
+# change_log は schema.py のマイグレーション12のトリガーが、item・serviceの書き込みと同じトランザクションで記録する
+# 行ごとに最新の変更だけが残るので（ログのコンパクション）、受け取る量は変わった行の数に比例し、家計簿の大きさにはよらない
+# クライアントは最後に受け取った版数を覚えておき、GET /api/v1/changes?since=版数 でそれより後の変更だけを受け取る
+#   - upsert はその行の今の内容、delete はidだけ（削除の記録＝トゥームストーン）
+#   - トゥームストーンは CHANGE_LOG_TOMBSTONE_RETENTION_DAYS 日たったら compact_change_log で消し、消した中で最大の版数を
+#     horizon として記録する。since が horizon より前のクライアントは、削除を受け取れないので since=0 から取り直す
+# 締めた月（archive.py）の行は同期の対象外で、変更履歴からも消える（書き出し・APIで読む）
+
+CHANGES_QUERY = """
+select c.version, c.entity, c.entity_id, c.operation,
+    i.purchase_date, i.service_name as item_service_name, i.item_name, i.item_price, i.item_attribute,
+    s.year_month, s.service_name, s.upper_limit
+from change_log c
+left join item i on c.entity = 'item' and c.operation = 'upsert' and i.item_id = c.entity_id
+left join service s on c.entity = 'service' and c.operation = 'upsert' and s.service_id = c.entity_id
+where c.version > ?
+order by c.version
+limit ?
+"""
+
+
+class ChangeLogExpiredError(Exception):
+    # sinceより後のトゥームストーンを消してしまったので、差分では同期できない
+    pass
+
+
+def get_change_log_version(db: sqlite3.Connection) -> int:
+    # 最後に記録した変更の版数（行を消しても小さくならない）
+    row = db.execute("select seq from sqlite_sequence where name = 'change_log'").fetchone()
+    return row[0] if row is not None else 0
+
+
+def get_change_log_horizon(db: sqlite3.Connection) -> int:
+    return db.execute("select value from change_log_state where name = 'horizon'").fetchone()[0]
+
+
+def format_change(row) -> dict:
+    change = {
+        "version": row["version"],
+        "entity": row["entity"],
+        "id": row["entity_id"],
+        "operation": row["operation"],
+    }
+    if row["operation"] == "upsert" and row["entity"] == "item":
+        change["data"] = {
+            "purchase_date": row["purchase_date"],
+            "service_name": row["item_service_name"],
+            "item_name": row["item_name"],
+            "item_price": row["item_price"],
+            "item_attribute": row["item_attribute"],
+        }
+    elif row["operation"] == "upsert":
+        change["data"] = {
+            "year_month": row["year_month"],
+            "service_name": row["service_name"],
+            "upper_limit": row["upper_limit"],
+        }
+    return change
+
+
+def get_changes(db: sqlite3.Connection, since: int, limit: int) -> tuple[list[dict], int, bool]:
+    # sinceより後の変更を版数の順に limit 件まで返す（変更のリスト, 次のsince, まだ続きがあるか）
+    # 1つのSELECT文で変更履歴と行の今の内容を読むので、途中で書き込まれても食い違わない
+    if 0 < since < get_change_log_horizon(db):
+        raise ChangeLogExpiredError(
+            f"版数{since}より後の削除の記録は残っていません。since=0から同期し直してください"
+        )
+    row_list = db.execute(CHANGES_QUERY, [since, limit + 1]).fetchall()
+    has_more = len(row_list) > limit
+    change_list = [format_change(row) for row in row_list[:limit]]
+    return change_list, change_list[-1]["version"] if change_list else since, has_more
+
+
+def compact_change_log(
+    db: sqlite3.Connection, retention_days: int = CHANGE_LOG_TOMBSTONE_RETENTION_DAYS
+) -> int:
+    # retention_days日より前のトゥームストーンを消し、horizonを進める。消した件数を返す
+    with db:
+        version, count = db.execute(
+            "select max(version), count(*) from change_log "
+            "where operation = 'delete' and changed_at < datetime('now', ?)",
+            [f"-{retention_days} days"],
+        ).fetchone()
+        if count == 0:
+            return 0
+        db.execute(
+            "delete from change_log where operation = 'delete' and version <= ?", [version]
+        )
+        db.execute(
+            "update change_log_state set value = max(value, ?) where name = 'horizon'", [version]
+        )
+    return count
+
+
+def get_change_log_stats(db: sqlite3.Connection) -> dict:
+    upsert_count, delete_count = db.execute(
+        "select count(*) filter (where operation = 'upsert'), count(*) filter (where operation = 'delete') "
+        "from change_log"
+    ).fetchone()
+    return {
+        "version": get_change_log_version(db),
+        "horizon": get_change_log_horizon(db),
+        "upserts": upsert_count,
+        "tombstones": delete_count,
+    }
+
+
+if __name__ == "__main__":
+    import sys
+
+    from config import DATABASE
+    from database import apply_pragmas
+    from schema import migrate
+
+    # 使い方: python changes.py compact [日数] | stats（compactはcronなどで毎日実行する）
+    command = sys.argv[1] if len(sys.argv) > 1 else "stats"
+    con = sqlite3.connect(DATABASE)
+    con.row_factory = sqlite3.Row
+    apply_pragmas(con)
+    migrate(con)
+    if command == "compact":
+        retention_days = int(sys.argv[2]) if len(sys.argv) > 2 else CHANGE_LOG_TOMBSTONE_RETENTION_DAYS
+        print(f"{compact_change_log(con, retention_days)}件の削除の記録を消しました")
+    for name, value in get_change_log_stats(con).items():
+        print(f"{name}: {value}")
+    con.close()
@@ -1,2 +1,68 @@
-DATABASE = "kakeibo.db"
+import os
+
+# 環境変数KAKEIBO_DATABASEで別のDBファイルを使える（ベンチマークなど）
+DATABASE = os.environ.get("KAKEIBO_DATABASE", "kakeibo.db")
 ITEM_ATTRIBUTE_LIST = ["夫", "妻"]
+
+# DBとの接続の設定
+DATABASE_POOL_SIZE = 8  # 1プロセスで同時に使う接続の最大数
+DATABASE_POOL_TIMEOUT = 10  # 接続が空くのを待つ秒数
+DATABASE_BUSY_TIMEOUT_MS = 5000  # 他の接続が書き込み中のときに待つミリ秒数
+DATABASE_CACHE_SIZE_KIB = 16384  # 接続ごとのページキャッシュ（KiB）
+DATABASE_MMAP_SIZE = 256 * 1024 * 1024  # メモリマップで読み込む最大バイト数
+
+# 描画済みの画面のキャッシュの上限
+PAGE_CACHE_MAX_ENTRIES = 512
+PAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# プロファイル（?profile=cprofile または ?profile=sample）を有効にするか
+# 有効にすると誰でもプロファイルを取れるので、本番では環境変数で必要なときだけ有効にする
+PROFILING_ENABLED = os.environ.get("KAKEIBO_PROFILING", "") == "1"
+PROFILE_DIRECTORY = os.environ.get("KAKEIBO_PROFILE_DIRECTORY", "profiles")
+PROFILE_SAMPLE_INTERVAL = 0.001  # サンプリングの間隔（秒）
+
+# 世帯ごとのDB（households.py）
+DEFAULT_HOUSEHOLD = ""  # X-Householdヘッダーがないときの世帯。DATABASEを使う
+HOUSEHOLD_HEADER = "X-Household"
+HOUSEHOLD_DATABASE_DIRECTORY = os.environ.get("KAKEIBO_HOUSEHOLD_DIRECTORY", "households")
+HOUSEHOLD_POOL_CACHE_SIZE = 64  # 1プロセスで同時に開いておく世帯のDBの数
+
+# 書き込み用のスレッド（writer.py）が1回のトランザクションでまとめて実行する処理の最大数
+WRITER_MAX_BATCH_SIZE = 64
+
+# 本番用のサーバー（server.py）
+SERVER_HOST = os.environ.get("KAKEIBO_HOST", "127.0.0.1")
+SERVER_PORT = int(os.environ.get("KAKEIBO_PORT", "8000"))
+SERVER_WORKERS = int(os.environ.get("KAKEIBO_WORKERS", str(os.cpu_count() or 1)))
+SERVER_BACKLOG = 128  # acceptされるのを待つ接続の数
+
+# ファイル名に内容のハッシュが付いた静的ファイル（assets.py）をブラウザにキャッシュさせる秒数
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+# 商品の列ごとのスナップショット（snapshot.py）をファイルに保存する間隔（秒）
+SNAPSHOT_SAVE_INTERVAL = 60
+
+# 締めた月のアーカイブ（archive.py）。今月を含めて直近の何か月を、アーカイブに移さずに残すか
+ARCHIVE_OPEN_MONTHS = 3
+
+# ライブ更新（events.py）
+LIVE_EVENT_MAX_CONNECTIONS = 32  # 1プロセスで同時に開いておくSSEの接続の最大数（全ての世帯の合計）
+LIVE_EVENT_POLL_INTERVAL = 0.5  # 世帯ごとのスレッドが live_events の新しい行を読む間隔（秒）
+LIVE_EVENT_HEARTBEAT_INTERVAL = 15  # イベントがないときに空のコメントを送る間隔（秒）
+LIVE_EVENT_STREAM_MAX_AGE = 300  # 1つの接続を開いておく最長の秒数（過ぎたらブラウザに繋ぎ直させる）
+LIVE_EVENT_RETRY_MS = 3000  # 接続が切れてからブラウザが繋ぎ直すまでのミリ秒数
+LIVE_EVENT_SUBSCRIBER_QUEUE_SIZE = 64  # 1つの接続に溜めておけるイベントの数（超えたら接続を閉じる）
+LIVE_EVENT_REPLAY_SIZE = 64  # 繋ぎ直した接続に送り直せる直近のイベントの数
+LIVE_EVENT_RETENTION = 1000  # live_events に残しておくイベントの数
+LIVE_EVENT_MAX_SUMMARY_MONTHS = 12  # これより多くの月が変わったイベントでは、月ごとの使用額を送らない
+
+# 差分同期の変更履歴（changes.py）。削除の記録を残しておく日数（これより長く同期しなかったクライアントは取り直す）
+CHANGE_LOG_TOMBSTONE_RETENTION_DAYS = 90
+
+# オンラインバックアップ（backup.py）
+BACKUP_DIRECTORY = os.environ.get("KAKEIBO_BACKUP_DIRECTORY", "backups")
+BACKUP_PAGES_PER_STEP = 1024  # 1ステップでコピーするページ数（4KiBのページなら4MiB）
+BACKUP_STEP_INTERVAL = 0.01  # ステップの間に休む秒数
+BACKUP_MAX_RESTARTS = 3  # コピー中の書き込みでやり直す回数の上限（超えたら残りを1ステップでコピーする）
+BACKUP_RETENTION = 7  # DBごとに残しておくスナップショットの数
+BACKUP_COMPRESS = os.environ.get("KAKEIBO_BACKUP_COMPRESS", "") == "1"  # スナップショットをgzipで圧縮するか
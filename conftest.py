@@ -0,0 +1,71 @@
+import sqlite3
+
+import pytest
+
+from database import apply_pragmas
+from schema import migrate
+
+# テスト（tests/）で使うフィクスチャ。リポジトリの直下に置くので、テストからも app.py などをそのままimportできる
+
+
+def connect(path) -> sqlite3.Connection:
+    # アプリと同じ設定の接続（行は sqlite3.Row で返す）
+    con = sqlite3.connect(path, check_same_thread=False)
+    con.row_factory = sqlite3.Row
+    apply_pragmas(con)
+    return con
+
+
+@pytest.fixture
+def database_path(tmp_path):
+    # マイグレーション済みの空の家計簿
+    path = str(tmp_path / "kakeibo.db")
+    con = sqlite3.connect(path)
+    migrate(con)
+    con.close()
+    return path
+
+
+@pytest.fixture
+def db(database_path):
+    con = connect(database_path)
+    yield con
+    con.close()
+
+
+@pytest.fixture
+def app(database_path, tmp_path):
+    from app import create_app
+
+    app = create_app(
+        {
+            "DATABASE": database_path,
+            "HOUSEHOLD_DATABASE_DIRECTORY": str(tmp_path / "households"),
+            "TESTING": True,
+        }
+    )
+    yield app
+    app.extensions["kakeibo"]["router"].close()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def add_service(db: sqlite3.Connection, year_month: str, service_name: str, upper_limit: int = 10000):
+    db.execute(
+        "insert into service (year_month, service_name, upper_limit) values (?, ?, ?)",
+        [year_month, service_name, upper_limit],
+    )
+    db.commit()
+
+
+def make_item(purchase_date, service_name, item_name, item_price, item_attribute="夫") -> dict:
+    return {
+        "purchase_date": purchase_date,
+        "service_name": service_name,
+        "item_name": item_name,
+        "item_price": item_price,
+        "item_attribute": item_attribute,
+    }
@@ -0,0 +1,266 @@
+import itertools
+import sqlite3
+
+from archive import get_first_open_date
+
+# spending_cube は item テーブルを (年月, 固定費名, 購入者) の全ての組み合わせで集計したもの
+# それぞれの次元には "*"（その次元の合計）の行もあるので、1つの商品は 2×2×2 = 8 個のセルに足される
+# 例: ("2024-06", "*", "夫") は2024年6月に夫が使った額、("*", "食費", "*") は食費の全期間の合計
+# どの切り口の集計も、結果の行だけをインデックスで読めばよい（item を走査しない）
+# 商品を登録・編集・削除するときは、同じトランザクションの中でここの関数を呼んで集計を更新する
+# コミットは呼び出し側で行う
+
+ALL = "*"
+SPENDING_CUBE_DIMENSION_LIST = ["year_month", "service_name", "item_attribute"]
+
+# item テーブルから集計し直すときのSELECT文（結果はマイグレーション7と同じ）
+# アーカイブに移した月（archive.py）の行は固定し、item テーブルからは集計し直さない
+# 締めていない月（購入日が :first_open_date 以降）の行は item から、masksのビットが立っている次元を "*" にして
+# 4通りの組み合わせを1回の走査で集計する。全期間（年月が "*"）の行は月ごとの行を足して求める
+# 何も締めていなければ :first_open_date は空文字列で、全ての商品を item から集計する
+SPENDING_CUBE_OPEN_MONTH_SELECT = """
+with masks(mask) as (values (0), (1), (2), (3))
+select
+    substr(purchase_date, 1, 7) as year_month,
+    case when mask & 1 then '*' else service_name end as service_name,
+    case when mask & 2 then '*' else item_attribute end as item_attribute,
+    sum(item_price) as total_usage, count(*) as item_count
+from item, masks
+where purchase_date >= :first_open_date
+group by 1, 2, 3
+"""
+SPENDING_CUBE_ALL_MONTHS_SELECT = """
+select '*', service_name, item_attribute, sum(total_usage), sum(item_count)
+from month_cells group by service_name, item_attribute
+"""
+SPENDING_CUBE_EXPECTED_SELECT = f"""
+with month_cells as (
+    {SPENDING_CUBE_OPEN_MONTH_SELECT}
+    union all
+    select year_month, service_name, item_attribute, total_usage, item_count from spending_cube
+    where year_month != '*' and year_month < substr(:first_open_date, 1, 7)
+)
+select * from month_cells
+union all
+{SPENDING_CUBE_ALL_MONTHS_SELECT}
+"""
+
+
+def get_spending_cube_cells(item: dict) -> list[tuple]:
+    # 1つの商品が足される8個のセル
+    return list(
+        itertools.product(
+            [item["purchase_date"][:7], ALL],
+            [item["service_name"], ALL],
+            [item["item_attribute"], ALL],
+        )
+    )
+
+
+def _apply_items_to_spending_cube(db: sqlite3.Connection, item_list: list, sign: int):
+    # セルごとに集計してから1回で更新する（sign=-1なら引く）
+    totals = {}
+    for item in item_list:
+        for cell in get_spending_cube_cells(item):
+            total_usage, item_count = totals.get(cell, (0, 0))
+            totals[cell] = (total_usage + sign * int(item["item_price"]), item_count + sign)
+    db.executemany(
+        "insert into spending_cube (year_month, service_name, item_attribute, total_usage, item_count) values (?, ?, ?, ?, ?) "
+        "on conflict (year_month, service_name, item_attribute) do update set "
+        "total_usage = total_usage + excluded.total_usage, item_count = item_count + excluded.item_count",
+        [[*cell, total_usage, item_count] for cell, (total_usage, item_count) in totals.items()],
+    )
+    if sign < 0:
+        # 商品が1つもなくなったセルは消しておく
+        db.executemany(
+            "delete from spending_cube where year_month = ? and service_name = ? and item_attribute = ? and item_count <= 0",
+            list(totals.keys()),
+        )
+
+
+def add_items_to_spending_cube(db: sqlite3.Connection, item_list: list):
+    _apply_items_to_spending_cube(db, item_list, 1)
+
+
+def remove_items_from_spending_cube(db: sqlite3.Connection, item_list: list):
+    _apply_items_to_spending_cube(db, item_list, -1)
+
+
+def replace_item_in_spending_cube(db: sqlite3.Connection, old_item: sqlite3.Row, new_item: dict):
+    # 商品の編集で月・固定費・購入者が変わった場合も、古いセルから引いて新しいセルに足せばよい
+    remove_items_from_spending_cube(db, [old_item])
+    add_items_to_spending_cube(db, [new_item])
+
+
+def rename_service_in_spending_cube(
+    db: sqlite3.Connection, service_name: str, new_service_name: str, first_open_date: str
+):
+    # 締めていない月の行だけ固定費名を変える（締めた月の行は固定しているので、元の名前のまま残す）
+    # 全期間（年月が "*"）の行は、2つの名前それぞれの月ごとの行を足して求め直す
+    parameters = {
+        "service_name": service_name,
+        "new_service_name": new_service_name,
+        "first_open_date": first_open_date,
+    }
+    db.execute(
+        "update spending_cube set service_name = :new_service_name "
+        "where service_name = :service_name and year_month != '*' and year_month >= substr(:first_open_date, 1, 7)",
+        parameters,
+    )
+    db.execute(
+        "delete from spending_cube where year_month = '*' and service_name in (:service_name, :new_service_name)",
+        parameters,
+    )
+    db.execute(
+        "insert into spending_cube (year_month, service_name, item_attribute, total_usage, item_count) "
+        "with month_cells as (select * from spending_cube "
+        "where year_month != '*' and service_name in (:service_name, :new_service_name)) "
+        + SPENDING_CUBE_ALL_MONTHS_SELECT,
+        parameters,
+    )
+
+
+def get_spending_cube(
+    db: sqlite3.Connection,
+    year_month=ALL,
+    service_name=ALL,
+    item_attribute=ALL,
+    year: str = "",
+) -> list[dict]:
+    # それぞれの次元には、値（"*"なら合計）またはNone（その次元の値ごと。合計の"*"の行も含む）を渡す
+    # yearを渡すと、その年の月だけに絞り込む（"*"の行は含まない）
+    condition_list = []
+    parameter_list = []
+    for column, value in zip(SPENDING_CUBE_DIMENSION_LIST, [year_month, service_name, item_attribute]):
+        if value is not None:
+            condition_list.append(f"{column} = ?")
+            parameter_list.append(value)
+    if year:
+        condition_list.append("year_month >= ? and year_month < ?")
+        parameter_list.extend([f"{year}-01", f"{int(year) + 1}-01"])
+    return [
+        {
+            "year_month": row[0],
+            "service_name": row[1],
+            "item_attribute": row[2],
+            "total_usage": row[3],
+            "item_count": row[4],
+        }
+        for row in db.execute(
+            "select year_month, service_name, item_attribute, total_usage, item_count from spending_cube"
+            + (" where " + " and ".join(condition_list) if condition_list else "")
+            + " order by year_month, service_name, item_attribute",
+            parameter_list,
+        )
+    ]
+
+
+def get_spending_table(
+    db: sqlite3.Connection,
+    row_column: str,
+    year_month=ALL,
+    service_name=ALL,
+    year: str = "",
+) -> tuple[list[dict], dict]:
+    # 画面の表のように、row_columnの値ごとに購入者別の使用額と合計を並べる
+    # row_columnの"*"の行（全体の合計）は最後の行として別に返す
+    dimension_values = {"year_month": year_month, "service_name": service_name}
+    dimension_values[row_column] = None
+    row_by_key = {}
+    for cell in get_spending_cube(
+        db, dimension_values["year_month"], dimension_values["service_name"], None, year
+    ):
+        row = row_by_key.setdefault(
+            cell[row_column], {"key": cell[row_column], "usages": {}, "total": 0}
+        )
+        if cell["item_attribute"] == ALL:
+            row["total"] = cell["total_usage"]
+        else:
+            row["usages"][cell["item_attribute"]] = cell["total_usage"]
+    total_row = row_by_key.pop(ALL, None)
+    row_list = list(row_by_key.values())
+    if total_row is None:
+        # 年で絞り込んだときは"*"の行がないので、行を足して合計を出す
+        total_row = {"key": ALL, "usages": {}, "total": sum(row["total"] for row in row_list)}
+        for row in row_list:
+            for item_attribute, usage in row["usages"].items():
+                total_row["usages"][item_attribute] = total_row["usages"].get(item_attribute, 0) + usage
+    return row_list, total_row
+
+
+# item テーブルから集計し直した結果と、spending_cube の差分を求めるクエリ
+CUBE_DRIFT_QUERY = f"""
+with expected as ({SPENDING_CUBE_EXPECTED_SELECT})
+select e.year_month, e.service_name, e.item_attribute, e.total_usage, e.item_count, c.total_usage, c.item_count
+from expected e left join spending_cube c
+    on c.year_month = e.year_month and c.service_name = e.service_name and c.item_attribute = e.item_attribute
+where c.total_usage is not e.total_usage or c.item_count is not e.item_count
+union all
+select c.year_month, c.service_name, c.item_attribute, null, null, c.total_usage, c.item_count
+from spending_cube c left join expected e
+    on e.year_month = c.year_month and e.service_name = c.service_name and e.item_attribute = c.item_attribute
+where e.year_month is null
+"""
+
+
+def verify_spending_cube(db: sqlite3.Connection) -> list[dict]:
+    # 集計がずれているセルを列挙する。空のリストならずれはない
+    return [
+        {
+            "year_month": row[0],
+            "service_name": row[1],
+            "item_attribute": row[2],
+            "expected_total_usage": row[3],
+            "expected_item_count": row[4],
+            "recorded_total_usage": row[5],
+            "recorded_item_count": row[6],
+        }
+        for row in db.execute(CUBE_DRIFT_QUERY, {"first_open_date": get_first_open_date(db)})
+    ]
+
+
+def rebuild_spending_cube(db: sqlite3.Connection) -> list[dict]:
+    # item テーブルから集計し直す（締めた月の行はそのまま残す）。集計し直す前に見つかったずれを返す
+    drift = verify_spending_cube(db)
+    first_open_date = get_first_open_date(db)
+    with db:
+        db.execute(
+            "delete from spending_cube where year_month = '*' or year_month >= substr(:first_open_date, 1, 7)",
+            {"first_open_date": first_open_date},
+        )
+        db.execute(
+            "insert into spending_cube (year_month, service_name, item_attribute, total_usage, item_count) "
+            + SPENDING_CUBE_OPEN_MONTH_SELECT,
+            {"first_open_date": first_open_date},
+        )
+        db.execute(
+            "insert into spending_cube (year_month, service_name, item_attribute, total_usage, item_count) "
+            "with month_cells as (select * from spending_cube where year_month != '*') "
+            + SPENDING_CUBE_ALL_MONTHS_SELECT
+        )
+    return drift
+
+
+if __name__ == "__main__":
+    import sys
+
+    from config import DATABASE
+    from schema import migrate
+
+    # 使い方: python cube.py verify | rebuild
+    command = sys.argv[1] if len(sys.argv) > 1 else "verify"
+    con = sqlite3.connect(DATABASE)
+    migrate(con)
+    if command == "rebuild":
+        drift = rebuild_spending_cube(con)
+    else:
+        drift = verify_spending_cube(con)
+    for row in drift:
+        print(
+            f"{row['year_month']} {row['service_name']} {row['item_attribute']}: "
+            f"item={row['expected_total_usage']}円/{row['expected_item_count']}件, "
+            f"集計={row['recorded_total_usage']}円/{row['recorded_item_count']}件"
+        )
+    print(f"{len(drift)}件のずれ" + ("を修正しました" if command == "rebuild" and drift else ""))
+    con.close()
+    sys.exit(1 if drift and command == "verify" else 0)
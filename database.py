@@ -0,0 +1,139 @@
+import os
+import sqlite3
+import threading
+import time
+
+from config import (
+    DATABASE_BUSY_TIMEOUT_MS,
+    DATABASE_CACHE_SIZE_KIB,
+    DATABASE_MMAP_SIZE,
+    DATABASE_POOL_SIZE,
+    DATABASE_POOL_TIMEOUT,
+)
+
+
+class PoolTimeoutError(Exception):
+    # 決められた時間内にプールから接続を借りられなかった
+    pass
+
+
+def apply_pragmas(con: sqlite3.Connection):
+    # 接続ごとに1回だけ設定するPRAGMA
+    # WALモードにすると、片方が書き込んでいる間ももう片方は読み込みができる
+    # WALモードはDBファイルに記録されるので、2回目以降の接続では何もしない
+    con.execute(f"pragma busy_timeout = {DATABASE_BUSY_TIMEOUT_MS}")
+    con.execute("pragma journal_mode = wal")
+    # WALモードでは synchronous = normal でもDBが壊れることはない（電源断で直近のコミットが消える可能性はある）
+    con.execute("pragma synchronous = normal")
+    con.execute(f"pragma cache_size = -{DATABASE_CACHE_SIZE_KIB}")
+    con.execute(f"pragma mmap_size = {DATABASE_MMAP_SIZE}")
+
+
+class ConnectionPool:
+    # SQLiteの接続を使い回すためのプール
+    # 同時に貸し出す接続の数は max_size までで、それを超えると返却されるまで待つ
+    # fork後の子プロセスでは親プロセスの接続を使わず、新しく接続し直す
+
+    def __init__(self, connect, max_size: int = DATABASE_POOL_SIZE, timeout: float = DATABASE_POOL_TIMEOUT):
+        self._connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self._condition = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._closed = False
+        self._idle = []
+        self._in_use = 0
+        self._created = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._total_wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._timeouts = 0
+
+    def _check_pid(self):
+        # forkで引き継いだ接続は親プロセスのものなので、閉じずに捨てる
+        if self._pid != os.getpid():
+            self._reset()
+
+    def acquire(self) -> sqlite3.Connection:
+        started_at = time.perf_counter()
+        with self._condition:
+            self._check_pid()
+            waited = False
+            while not self._idle and self._in_use >= self.max_size:
+                remaining = self.timeout - (time.perf_counter() - started_at)
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeoutError(
+                        f"{self.timeout}秒以内にDBとの接続を取得できませんでした"
+                    )
+                waited = True
+                self._condition.wait(remaining)
+            wait_time = time.perf_counter() - started_at
+            if waited:
+                self._waits += 1
+            self._total_wait_time += wait_time
+            self._max_wait_time = max(self._max_wait_time, wait_time)
+            self._checkouts += 1
+            self._in_use += 1
+            if self._idle:
+                return self._idle.pop()
+        # 新しい接続を作るのはロックの外で行う
+        try:
+            con = self._connect()
+        except BaseException:
+            with self._condition:
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+        with self._condition:
+            self._created += 1
+        return con
+
+    def release(self, con: sqlite3.Connection):
+        # コミットされていない変更は取り消してからプールに戻す
+        try:
+            if con.in_transaction:
+                con.rollback()
+        except sqlite3.Error:
+            con.close()
+            con = None
+        with self._condition:
+            if self._pid != os.getpid():
+                return
+            self._in_use -= 1
+            if con is not None:
+                # close()した後に返された接続はプールに戻さずに閉じる
+                if not self._closed and len(self._idle) < self.max_size:
+                    self._idle.append(con)
+                else:
+                    con.close()
+            self._condition.notify()
+
+    def close(self):
+        # 空いている接続を閉じる。貸し出し中の接続は返されたときに閉じる
+        with self._condition:
+            self._closed = True
+            for con in self._idle:
+                con.close()
+            self._idle = []
+
+    def stats(self) -> dict:
+        with self._condition:
+            self._check_pid()
+            return {
+                "pid": self._pid,
+                "max_size": self.max_size,
+                "size": len(self._idle) + self._in_use,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "created": self._created,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "total_wait_time": round(self._total_wait_time, 6),
+                "max_wait_time": round(self._max_wait_time, 6),
+            }
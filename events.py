@@ -0,0 +1,230 @@
+import collections
+import datetime
+import json
+import os
+import queue
+import sqlite3
+import threading
+
+from api import get_month_summary
+from config import (
+    LIVE_EVENT_MAX_SUMMARY_MONTHS,
+    LIVE_EVENT_POLL_INTERVAL,
+    LIVE_EVENT_REPLAY_SIZE,
+    LIVE_EVENT_RETENTION,
+    LIVE_EVENT_SUBSCRIBER_QUEUE_SIZE,
+)
+
+# ライブ更新（夫婦のもう片方の端末での変更を、再読み込みせずに画面へ反映する。app.pyの /events）
+# 書き込み（operations.pyなど）は、同じトランザクションの中で live_events に1行記録する（コミットされた変更だけが届く）
+# ワーカーはプロセスごとに分かれているので、プロセスの中の購読者への配信はDBを経由する
+#   - 世帯ごとに1つのスレッドが LIVE_EVENT_POLL_INTERVAL 秒ごとに live_events の新しい行だけを読む（購読者の数によらず1つ）
+#   - 1つのイベントにつき、変わった月の固定費ごとの使用額・使用率（/api/v1/months/<月>/summary と同じ形）を1回だけ求め、
+#     SSEのメッセージにしたバイト列を全ての購読者のキューにそのまま入れる
+#   - 購読者がいない世帯ではスレッドを止める
+# 購読者のキューがいっぱいになった（読むのが遅い）接続は閉じる。ブラウザは Last-Event-ID を付けて繋ぎ直し、
+# 直近 LIVE_EVENT_REPLAY_SIZE 件のうち届いていないイベントを受け取る（それより古ければ画面を読み込み直させる）
+
+
+class LiveEventLimitError(Exception):
+    # ライブ更新の接続の数が上限に達している
+    pass
+
+
+def record_live_event(db: sqlite3.Connection, event_type: str, year_month_list, **payload):
+    # 書き込みと同じトランザクションの中で呼ぶ。古いイベントは LIVE_EVENT_RETENTION 件を残して消す
+    event_id = db.execute(
+        "insert into live_events (event_type, year_months, payload, created_at) values (?, ?, ?, ?)",
+        [
+            event_type,
+            json.dumps(sorted({year_month for year_month in year_month_list if year_month})),
+            json.dumps(payload, ensure_ascii=False),
+            datetime.datetime.now().isoformat(timespec="seconds"),
+        ],
+    ).lastrowid
+    db.execute("delete from live_events where event_id <= ?", [event_id - LIVE_EVENT_RETENTION])
+
+
+def format_live_event(db: sqlite3.Connection, row) -> bytes:
+    # live_eventsの1行を、SSEのメッセージ（id・event・data）にする
+    year_month_list = json.loads(row["year_months"])
+    data = {
+        "event_id": row["event_id"],
+        "year_months": year_month_list,
+        **json.loads(row["payload"]),
+        # 月が多い変更（固定費名の変更など）では使用額を送らず、その月を表示している画面に読み込み直させる
+        "summaries": (
+            [get_month_summary(db, year_month) for year_month in year_month_list]
+            if len(year_month_list) <= LIVE_EVENT_MAX_SUMMARY_MONTHS
+            else []
+        ),
+    }
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+        row["event_id"],
+        row["event_type"],
+        json.dumps(data, ensure_ascii=False, separators=(",", ":")),
+    ).encode("utf-8")
+
+
+class LiveEventSubscription:
+    # 1つのSSEの接続。配信するメッセージ（バイト列）を順番に受け取る。Noneを受け取ったら接続を閉じる
+    def __init__(self, max_queued: int = LIVE_EVENT_SUBSCRIBER_QUEUE_SIZE):
+        # 閉じるためのNoneは、キューがいっぱいでも入れられるように1つ多くしておく
+        self.queue = queue.Queue(max_queued + 1)
+        self.max_queued = max_queued
+        self.closed = False
+
+    def put(self, message) -> bool:
+        # messageがNoneのとき、またはキューがいっぱいのときは、Noneを入れて接続を閉じさせる（Falseを返す）
+        if self.closed:
+            return False
+        if message is None or self.queue.qsize() >= self.max_queued:
+            self.closed = True
+            self.queue.put_nowait(None)
+            return False
+        self.queue.put_nowait(message)
+        return True
+
+    def get(self, timeout: float):
+        # timeout秒以内にメッセージがなければqueue.Emptyを投げる
+        return self.queue.get(timeout=timeout)
+
+
+class LiveEventHub:
+    # 1つの世帯のライブ更新の購読者と、live_eventsを読むスレッド
+    # 接続の数の上限（slots）はプロセスの全ての世帯で共有する
+
+    def __init__(
+        self,
+        connect,
+        slots: threading.BoundedSemaphore,
+        poll_interval: float = LIVE_EVENT_POLL_INTERVAL,
+        replay_size: int = LIVE_EVENT_REPLAY_SIZE,
+    ):
+        # connectは読み込み用の接続を返す関数（スレッドの中でだけ使う）
+        self.connect = connect
+        self.slots = slots
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._subscription_set = set()
+        self._replay = collections.deque(maxlen=replay_size)
+        self._last_event_id = None
+        self._pid = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._closed = False
+        self.published = 0
+        self.dropped = 0
+        self.rejected = 0
+
+    def subscribe(self, last_event_id: str = "") -> LiveEventSubscription:
+        # 上限に達していればLiveEventLimitErrorを投げる
+        if not self.slots.acquire(blocking=False):
+            self.rejected += 1
+            raise LiveEventLimitError("ライブ更新の接続の数が上限に達しています")
+        subscription = LiveEventSubscription()
+        try:
+            with self._lock:
+                # 閉じた世帯（households.pyで追い出された世帯）ではスレッドを起動し直さない（繋ぎ直させる）
+                if self._closed:
+                    raise LiveEventLimitError("ライブ更新を停止しています")
+                self._ensure_started()
+                self._replay_to(subscription, last_event_id)
+                self._subscription_set.add(subscription)
+        except BaseException:
+            self.slots.release()
+            raise
+        return subscription
+
+    def unsubscribe(self, subscription: LiveEventSubscription):
+        with self._lock:
+            if subscription not in self._subscription_set:
+                return
+            self._subscription_set.discard(subscription)
+        self.slots.release()
+
+    def close(self):
+        # 全ての購読者の接続を閉じ、スレッドを止める
+        self._stop.set()
+        with self._lock:
+            self._closed = True
+            subscription_list = list(self._subscription_set)
+            thread = self._thread if self._pid == os.getpid() else None
+        for subscription in subscription_list:
+            with self._lock:
+                subscription.put(None)
+        if thread is not None:
+            thread.join()
+
+    def _ensure_started(self):
+        # ロックを取ってから呼ぶ。fork後の子プロセスではスレッドが引き継がれないので、プロセスごとに起動し直す
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._thread = None
+            self._subscription_set = set()
+            self._replay.clear()
+            self._last_event_id = None
+        if self._thread is not None:
+            return
+        db = self.connect()
+        # 直近のイベントを読んでおき、繋ぎ直した接続に送り直せるようにする
+        row_list = db.execute(
+            "select * from live_events order by event_id desc limit ?", [self._replay.maxlen]
+        ).fetchall()
+        for row in reversed(row_list):
+            self._replay.append((row["event_id"], format_live_event(db, row)))
+        self._last_event_id = row_list[0]["event_id"] if row_list else 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, args=(db,), daemon=True)
+        self._thread.start()
+
+    def _replay_to(self, subscription: LiveEventSubscription, last_event_id: str):
+        # 繋ぎ直した接続に、届いていないイベントを送り直す
+        if not last_event_id.isdigit():
+            return
+        last_event_id = int(last_event_id)
+        if last_event_id >= self._last_event_id:
+            return
+        if not self._replay or last_event_id < self._replay[0][0] - 1:
+            # 送り直せるイベントより前で途切れているので、画面を読み込み直させる
+            subscription.put(b"event: reload\ndata: {}\n\n")
+            return
+        for event_id, message in self._replay:
+            if event_id > last_event_id:
+                subscription.put(message)
+
+    def _run(self, db: sqlite3.Connection):
+        try:
+            while not self._stop.wait(self.poll_interval):
+                # メッセージはロックの外で作り、購読者のキューに入れるときだけロックを取る
+                message_list = [
+                    (row["event_id"], format_live_event(db, row))
+                    for row in db.execute(
+                        "select * from live_events where event_id > ? order by event_id",
+                        [self._last_event_id],
+                    ).fetchall()
+                ]
+                with self._lock:
+                    for event_id, message in message_list:
+                        self._replay.append((event_id, message))
+                        self._last_event_id = event_id
+                        self.published += 1
+                        for subscription in self._subscription_set:
+                            if not subscription.closed and not subscription.put(message):
+                                self.dropped += 1
+                    # 購読者がいなくなったらスレッドを止める（次に購読されたときに起動し直す）
+                    if not self._subscription_set:
+                        self._thread = None
+                        return
+        finally:
+            db.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "subscribers": len(self._subscription_set),
+                "last_event_id": self._last_event_id,
+                "published": self.published,
+                "dropped": self.dropped,
+                "rejected": self.rejected,
+            }
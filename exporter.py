@@ -0,0 +1,102 @@
+import csv
+import io
+import json
+import sqlite3
+import zlib
+
+from aggregate import MONTHLY_UPPER_LIMIT_AND_USAGE_QUERY
+from archive import read_ledger
+from util import get_month_date_range
+
+EXPORT_BATCH_SIZE = 500
+
+ITEM_EXPORT_COLUMN_LIST = [
+    "item_id",
+    "purchase_date",
+    "service_name",
+    "item_name",
+    "item_price",
+    "item_attribute",
+]
+
+HISTORY_EXPORT_COLUMN_LIST = ["year_month", "total_upper_limit", "total_usage"]
+
+
+def iter_item_rows(db: sqlite3.Connection, yyyymm: str = "", service_name: str = ""):
+    # 商品を購入日順に返す。月・固定費で絞り込める
+    # purchase_dateのインデックスの順に読むので、並び替えのために全件を溜め込むことはない
+    # 締めた月の商品は、年ごとのアーカイブから順に読む（archive.py）
+    condition_list = []
+    parameters = []
+    if yyyymm:
+        condition_list.append("purchase_date >= ? and purchase_date < ?")
+        parameters.extend(get_month_date_range(yyyymm))
+    if service_name:
+        condition_list.append("service_name = ?")
+        parameters.append(service_name)
+    statement = "select {} from {{schema}}.item".format(", ".join(ITEM_EXPORT_COLUMN_LIST))
+    if condition_list:
+        statement += " where " + " and ".join(condition_list)
+    statement += " order by purchase_date, item_id"
+    return (
+        tuple(row)
+        for row in read_ledger(db, statement, parameters, yyyymm, yyyymm, EXPORT_BATCH_SIZE)
+    )
+
+
+def iter_history_rows(db: sqlite3.Connection):
+    # 履歴画面と同じ、月ごとの上限金額の合計と使用額の合計
+    return iter_cursor(db.execute(MONTHLY_UPPER_LIMIT_AND_USAGE_QUERY))
+
+
+def iter_cursor(cursor: sqlite3.Cursor, batch_size: int = EXPORT_BATCH_SIZE):
+    # fetchallで全件を読み込まず、batch_size件ずつ取り出す
+    while True:
+        row_list = cursor.fetchmany(batch_size)
+        if not row_list:
+            break
+        for row in row_list:
+            yield tuple(row)
+
+
+def iter_csv(column_list: list[str], row_iter, batch_size: int = EXPORT_BATCH_SIZE):
+    # Excelで開いても文字化けしないようにBOMを付ける
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    buffer.write("﻿")
+    writer.writerow(column_list)
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    for row_count, row in enumerate(row_iter, start=1):
+        writer.writerow(row)
+        if row_count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def iter_json(column_list: list[str], row_iter, batch_size: int = EXPORT_BATCH_SIZE):
+    # [{...}, {...}] の形のJSONを、全体を組み立てずに少しずつ書き出す
+    yield "["
+    chunk_list = []
+    for row_count, row in enumerate(row_iter):
+        chunk_list.append(
+            ("," if row_count else "")
+            + json.dumps(dict(zip(column_list, row)), ensure_ascii=False, separators=(",", ":"))
+        )
+        if len(chunk_list) == batch_size:
+            yield "".join(chunk_list)
+            chunk_list = []
+    yield "".join(chunk_list) + "]"
+
+
+def iter_gzip(chunk_iter):
+    # gzip形式で少しずつ圧縮する（wbits=31でgzipのヘッダーが付く）
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunk_iter:
+        compressed = compressor.compress(chunk.encode())
+        if compressed:
+            yield compressed
+    yield compressor.flush()
@@ -0,0 +1,188 @@
+import collections
+import os
+import re
+import sqlite3
+import threading
+
+from config import (
+    DATABASE,
+    DEFAULT_HOUSEHOLD,
+    HOUSEHOLD_DATABASE_DIRECTORY,
+    HOUSEHOLD_POOL_CACHE_SIZE,
+    LIVE_EVENT_MAX_CONNECTIONS,
+)
+from database import ConnectionPool
+from events import LiveEventHub
+from writer import WriteQueue
+from schema import migrate
+
+# 世帯（夫婦）ごとに別のSQLiteファイルを使う
+# 世帯のデータは他の世帯と混ざらないので、1つの世帯の家計簿が大きくなっても他の世帯のクエリは遅くならない
+# 世帯IDはリバースプロキシが X-Household ヘッダーで渡す（ヘッダーで振り分ければ、世帯ごとに別のワーカー・サーバーにも置ける）
+# ヘッダーがない場合は、これまで通り config.DATABASE を使う（DEFAULT_HOUSEHOLD）
+
+HOUSEHOLD_ID_PATTERN = re.compile(r"^[a-z0-9][a-z0-9_-]{0,63}$")
+
+
+class UnknownHouseholdError(Exception):
+    # 世帯IDの形式が正しくない、またはその世帯のDBがない
+    pass
+
+
+def get_household_database_path(
+    household_id: str,
+    database: str = DATABASE,
+    directory: str = HOUSEHOLD_DATABASE_DIRECTORY,
+) -> str:
+    if household_id == DEFAULT_HOUSEHOLD:
+        return database
+    if not HOUSEHOLD_ID_PATTERN.match(household_id):
+        raise UnknownHouseholdError(f"世帯IDの形式が正しくありません：{household_id}")
+    return os.path.join(directory, household_id + ".db")
+
+
+def migrate_database(path: str):
+    con = sqlite3.connect(path)
+    migrate(con)
+    con.close()
+
+
+def create_household(household_id: str, directory: str = HOUSEHOLD_DATABASE_DIRECTORY) -> str:
+    # 世帯のDBを作る。既にある場合はマイグレーションだけ行う
+    path = get_household_database_path(household_id, directory=directory)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    migrate_database(path)
+    return path
+
+
+def list_households(directory: str = HOUSEHOLD_DATABASE_DIRECTORY) -> list[str]:
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        filename[:-3]
+        for filename in os.listdir(directory)
+        if filename.endswith(".db") and HOUSEHOLD_ID_PATTERN.match(filename[:-3])
+    )
+
+
+class Household:
+    # 1つの世帯のDBの、読み込み用の接続プールと書き込み用のキューと、ライブ更新の配信（events.py）
+    def __init__(self, connect, path: str, live_event_slots: threading.BoundedSemaphore):
+        self.pool = ConnectionPool(lambda: connect(path))
+        self.writer = WriteQueue(lambda: connect(path))
+        self.events = LiveEventHub(lambda: connect(path), live_event_slots)
+
+    def close(self):
+        self.events.close()
+        self.writer.close()
+        self.pool.close()
+
+
+class HouseholdRouter:
+    # 世帯IDから、その世帯のDBの接続プールと書き込み用のキューを返す
+    # 開いておく世帯の数は max_households までで、超えたら最も長く使われていない世帯を閉じる
+
+    def __init__(
+        self,
+        connect,
+        database: str = DATABASE,
+        directory: str = HOUSEHOLD_DATABASE_DIRECTORY,
+        max_households: int = HOUSEHOLD_POOL_CACHE_SIZE,
+        max_live_event_connections: int = LIVE_EVENT_MAX_CONNECTIONS,
+    ):
+        # connectはDBファイルのパスを受け取って接続を返す関数
+        # databaseは世帯IDがないとき（DEFAULT_HOUSEHOLD）に使うDB、directoryは世帯ごとのDBを置くディレクトリ
+        self.connect = connect
+        self.database = database
+        self.directory = directory
+        self.max_households = max_households
+        self._households = collections.OrderedDict()
+        self._lock = threading.Lock()
+        # ライブ更新の接続の数は、全ての世帯の合計で max_live_event_connections までにする
+        self.live_event_slots = threading.BoundedSemaphore(max_live_event_connections)
+        self.opened = 0
+        self.evicted = 0
+
+    def get_household(self, household_id: str) -> Household:
+        with self._lock:
+            household = self._households.get(household_id)
+            if household is not None:
+                self._households.move_to_end(household_id)
+                return household
+        path = get_household_database_path(household_id, self.database, self.directory)
+        # 存在しない世帯のDBを勝手に作らない（create_householdで作る）
+        # 世帯ごとのDBは、プロセスの中で初めて開くときにマイグレーションする
+        # （世帯がないときに使うDBは、起動時に1回だけマイグレーションする）
+        if household_id != DEFAULT_HOUSEHOLD:
+            if not os.path.exists(path):
+                raise UnknownHouseholdError(f"世帯が登録されていません：{household_id}")
+            migrate_database(path)
+        evicted_household_list = []
+        with self._lock:
+            household = self._households.get(household_id)
+            if household is None:
+                household = Household(self.connect, path, self.live_event_slots)
+                self._households[household_id] = household
+                self.opened += 1
+            self._households.move_to_end(household_id)
+            while len(self._households) > self.max_households:
+                _, evicted_household = self._households.popitem(last=False)
+                evicted_household_list.append(evicted_household)
+                self.evicted += 1
+        # 書き込み用のスレッドが止まるのを待つので、ロックの外で閉じる
+        for evicted_household in evicted_household_list:
+            evicted_household.close()
+        return household
+
+    def get_pool(self, household_id: str) -> ConnectionPool:
+        return self.get_household(household_id).pool
+
+    def get_writer(self, household_id: str) -> WriteQueue:
+        return self.get_household(household_id).writer
+
+    def get_events(self, household_id: str) -> LiveEventHub:
+        return self.get_household(household_id).events
+
+    def close(self):
+        with self._lock:
+            household_list = list(self._households.values())
+            self._households.clear()
+        for household in household_list:
+            household.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            household_list = list(self._households.items())
+        return {
+            "households": len(household_list),
+            "max_households": self.max_households,
+            "opened": self.opened,
+            "evicted": self.evicted,
+            "pools": {
+                household_id or "default": household.pool.stats()
+                for household_id, household in household_list
+            },
+            "writers": {
+                household_id or "default": household.writer.stats()
+                for household_id, household in household_list
+            },
+            "live_events": {
+                household_id or "default": household.events.stats()
+                for household_id, household in household_list
+            },
+        }
+
+
+if __name__ == "__main__":
+    import sys
+
+    # 使い方: python households.py create <世帯ID> | list
+    command = sys.argv[1] if len(sys.argv) > 1 else "list"
+    if command == "create":
+        try:
+            print(create_household(sys.argv[2]))
+        except UnknownHouseholdError as e:
+            sys.exit(str(e))
+    else:
+        for household_id in list_households():
+            print(household_id)
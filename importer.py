@@ -0,0 +1,244 @@
+import csv
+import datetime
+import io
+import itertools
+import sqlite3
+
+from archive import get_archived_month_message, get_last_archived_yyyymm
+from cube import add_items_to_spending_cube
+from events import record_live_event
+from page_cache import bump_month_versions
+from rollup import add_items_to_month_service_totals
+from util import ITEM_COLUMN_LIST, validate_item_row
+
+IMPORT_BATCH_SIZE = 1000
+
+# ファイルの見出しとitemテーブルの列の対応（画面に表示している日本語の見出しも使える）
+HEADER_ALIASES = {
+    "purchase_date": "purchase_date",
+    "購入日": "purchase_date",
+    "購入した日付": "purchase_date",
+    "日付": "purchase_date",
+    "service_name": "service_name",
+    "サービス名": "service_name",
+    "固定費": "service_name",
+    "固定費名": "service_name",
+    "カテゴリ": "service_name",
+    "item_name": "item_name",
+    "商品名": "item_name",
+    "item_price": "item_price",
+    "値段": "item_price",
+    "金額": "item_price",
+    "item_attribute": "item_attribute",
+    "購入者": "item_attribute",
+}
+
+
+class ImportFormatError(Exception):
+    # ファイル自体が読めない（見出しが足りないなど）
+    pass
+
+
+def _to_text(value) -> str:
+    if value is None:
+        return ""
+    if isinstance(value, datetime.datetime):
+        return value.date().isoformat()
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def _iter_rows_with_header(row_iter):
+    # 1行目を見出しとして読み、(行番号, {列名: 値}) を1行ずつ返す
+    header = next(row_iter, None)
+    if header is None:
+        raise ImportFormatError("ファイルが空です")
+    column_list = [HEADER_ALIASES.get(_to_text(name)) for name in header]
+    missing_column_list = [
+        column for column in ITEM_COLUMN_LIST if column not in column_list
+    ]
+    if missing_column_list:
+        raise ImportFormatError(f"見出しが足りません：{', '.join(missing_column_list)}")
+    for row_number, row in enumerate(row_iter, start=2):
+        values = {
+            column: _to_text(value)
+            for column, value in zip(column_list, row)
+            if column is not None
+        }
+        # 完全に空の行は読み飛ばす
+        if not any(values.values()):
+            continue
+        yield row_number, {column: values.get(column, "") for column in ITEM_COLUMN_LIST}
+
+
+def iter_csv_rows(stream: io.TextIOBase):
+    return _iter_rows_with_header(csv.reader(stream))
+
+
+def iter_xlsx_rows(file):
+    # xlsxを読むにはopenpyxlが必要（CSVだけなら不要）
+    try:
+        import openpyxl
+    except ImportError:
+        raise ImportFormatError("xlsxを読み込むにはopenpyxlをインストールしてください")
+    # read_onlyにすると、シート全体をメモリに載せずに1行ずつ読める
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    return _iter_rows_with_header(workbook.active.iter_rows(values_only=True))
+
+
+def iter_rows(file, filename: str, encoding: str = "utf-8-sig"):
+    # 拡張子でCSVかxlsxかを判断する
+    if filename.lower().endswith(".xlsx"):
+        return iter_xlsx_rows(file)
+    return iter_csv_rows(io.TextIOWrapper(file, encoding=encoding, newline=""))
+
+
+def _find_existing_services(db: sqlite3.Connection, item_list: list[dict]) -> set:
+    # バッチに含まれる月の固定費を1回のクエリでまとめて取得する
+    year_month_list = sorted({item["purchase_date"][:7] for item in item_list})
+    if not year_month_list:
+        return set()
+    return {
+        (row[0], row[1])
+        for row in db.execute(
+            "select year_month, service_name from service where year_month in ({})".format(
+                ", ".join(["?"] * len(year_month_list))
+            ),
+            year_month_list,
+        )
+    }
+
+
+def _find_existing_items(db: sqlite3.Connection, item_list: list[dict]) -> set:
+    # 同じ固定費で同じ名前の商品が既に購入されていないかを、一時テーブルとの結合でまとめて調べる
+    db.execute(
+        "create temp table if not exists import_item_key(service_name text not null, item_name text not null)"
+    )
+    db.execute("delete from import_item_key")
+    db.executemany(
+        "insert into import_item_key (service_name, item_name) values (?, ?)",
+        [[item["service_name"], item["item_name"]] for item in item_list],
+    )
+    return {
+        (row[0], row[1])
+        for row in db.execute(
+            "select distinct k.service_name, k.item_name from import_item_key k "
+            "join item i on i.service_name = k.service_name and i.item_name = k.item_name "
+            "union "
+            "select k.service_name, k.item_name from import_item_key k "
+            "join archived_item_names a on a.service_name = k.service_name and a.item_name = k.item_name"
+        )
+    }
+
+
+def _validate_batch(db: sqlite3.Connection, batch: list, seen_item_key_set: set):
+    valid_item_list = []
+    error_list = []
+    checked_list = []
+    for row_number, item in batch:
+        error_message = validate_item_row(item)
+        if error_message:
+            error_list.append({"row": row_number, "message": error_message})
+        else:
+            checked_list.append((row_number, item))
+
+    item_list = [item for _, item in checked_list]
+    existing_service_set = _find_existing_services(db, item_list)
+    existing_item_set = _find_existing_items(db, item_list)
+    last_archived_yyyymm = get_last_archived_yyyymm(db)
+    for row_number, item in checked_list:
+        year_month = item["purchase_date"][:7]
+        item_key = (item["service_name"], item["item_name"])
+        if year_month <= last_archived_yyyymm:
+            error_message = get_archived_month_message(year_month)
+        elif (year_month, item["service_name"]) not in existing_service_set:
+            error_message = f"{year_month}に固定費{item['service_name']}が登録されていません"
+        elif item_key in existing_item_set or item_key in seen_item_key_set:
+            error_message = f"同じ名前の商品が{item['service_name']}で既に購入されています"
+        else:
+            seen_item_key_set.add(item_key)
+            valid_item_list.append(item)
+            continue
+        error_list.append({"row": row_number, "message": error_message})
+    error_list.sort(key=lambda error: error["row"])
+    return valid_item_list, error_list
+
+
+def insert_items(db: sqlite3.Connection, row_iter, batch_size: int = IMPORT_BATCH_SIZE) -> dict:
+    # 行を batch_size 件ずつ検証して executemany で登録する（書き込み用のスレッドの処理。writer.py）
+    # 呼び出し側が begin immediate で始めたトランザクションの中で呼ぶので、同じ商品が同時に登録されても、
+    # 検証（既にある商品・固定費の確認）から登録までの間に他の書き込みは入らない
+    # 集計テーブルは最後に1回だけ更新する。エラーのあった行は登録せず、行番号とエラーメッセージを返す
+    inserted_item_list = []
+    error_list = []
+    seen_item_key_set = set()
+    while True:
+        batch = list(itertools.islice(row_iter, batch_size))
+        if not batch:
+            break
+        valid_item_list, batch_error_list = _validate_batch(db, batch, seen_item_key_set)
+        error_list.extend(batch_error_list)
+        db.executemany(
+            "insert into item (purchase_date, service_name, item_name, item_price, item_attribute) "
+            "values (:purchase_date, :service_name, :item_name, :item_price, :item_attribute)",
+            valid_item_list,
+        )
+        inserted_item_list.extend(
+            {
+                "purchase_date": item["purchase_date"],
+                "service_name": item["service_name"],
+                "item_price": item["item_price"],
+                "item_attribute": item["item_attribute"],
+            }
+            for item in valid_item_list
+        )
+    add_items_to_month_service_totals(db, inserted_item_list)
+    add_items_to_spending_cube(db, inserted_item_list)
+    year_month_list = [item["purchase_date"][:7] for item in inserted_item_list]
+    bump_month_versions(db, year_month_list)
+    if inserted_item_list:
+        record_live_event(db, "items_changed", year_month_list)
+    db.execute("drop table if exists temp.import_item_key")
+    return {"inserted": len(inserted_item_list), "errors": error_list}
+
+
+def import_items(db: sqlite3.Connection, row_iter, batch_size: int = IMPORT_BATCH_SIZE) -> dict:
+    # 書き込み用のスレッドを使わないとき（コマンドラインから取り込むとき）は、
+    # begin immediate で最初に書き込みのロックを取ってから検証し、全体を1つのトランザクションにする
+    if db.in_transaction:
+        db.commit()
+    db.execute("begin immediate")
+    try:
+        result = insert_items(db, row_iter, batch_size)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    from config import DATABASE
+    from database import apply_pragmas
+    from schema import migrate
+
+    # 使い方: python importer.py 出費.csv [文字コード]
+    filename = sys.argv[1]
+    encoding = sys.argv[2] if len(sys.argv) > 2 else "utf-8-sig"
+    con = sqlite3.connect(DATABASE)
+    apply_pragmas(con)
+    migrate(con)
+    with open(filename, "rb") as file:
+        try:
+            result = import_items(con, iter_rows(file, filename, encoding))
+        except ImportFormatError as e:
+            sys.exit(str(e))
+    for error in result["errors"]:
+        print(f"{error['row']}行目: {error['message']}")
+    print(f"{result['inserted']}件登録しました（エラー{len(result['errors'])}件）")
+    con.close()
@@ -0,0 +1,275 @@
+import contextvars
+import cProfile
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from collections import defaultdict
+
+from config import PROFILE_DIRECTORY, PROFILE_SAMPLE_INTERVAL
+
+# リクエストごとの計測
+# - SQL: InstrumentedConnectionを使うと、実行した文・時間・行数をリクエストの記録に追加する
+# - 処理全体・DB・テンプレートの描画の時間を、画面（endpoint）ごとにヒストグラムに集計する
+# - /metrics でPrometheusのテキスト形式で返す（値はプロセスごと）
+
+# 処理中のリクエストの記録。リクエストの外（CLIなど）ではNone
+current_request_trace = contextvars.ContextVar("current_request_trace", default=None)
+
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+
+PLACEHOLDER_LIST_PATTERN = re.compile(r"\?(\s*,\s*\?)+")
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_statement(statement: str) -> str:
+    # 空白をまとめ、in (?, ?, ?) のような可変長のプレースホルダーを (?) にする
+    statement = WHITESPACE_PATTERN.sub(" ", statement).strip()
+    return PLACEHOLDER_LIST_PATTERN.sub("?", statement)
+
+
+class RequestTrace:
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.started_at = time.perf_counter()
+        self.query_list = []
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_started_at = None
+
+    def add_query(self, statement: str, duration: float, row_count: int) -> dict:
+        query = {
+            "statement": normalize_statement(statement),
+            "duration": duration,
+            "rows": row_count,
+        }
+        self.query_list.append(query)
+        self.db_time += duration
+        return query
+
+    def add_fetch(self, query: dict, duration: float, row_count: int):
+        query["duration"] += duration
+        query["rows"] += row_count
+        self.db_time += duration
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # 実行とfetchにかかった時間・読んだ行数を記録するカーソル
+    _query = None
+
+    def execute(self, statement, parameters=()):
+        trace = current_request_trace.get()
+        if trace is None:
+            return super().execute(statement, parameters)
+        started_at = time.perf_counter()
+        super().execute(statement, parameters)
+        self._query = trace.add_query(
+            statement, time.perf_counter() - started_at, max(self.rowcount, 0)
+        )
+        return self
+
+    def executemany(self, statement, parameter_list):
+        trace = current_request_trace.get()
+        if trace is None:
+            return super().executemany(statement, parameter_list)
+        started_at = time.perf_counter()
+        super().executemany(statement, parameter_list)
+        self._query = trace.add_query(
+            statement, time.perf_counter() - started_at, max(self.rowcount, 0)
+        )
+        return self
+
+    def _record_fetch(self, started_at: float, row_count: int):
+        trace = current_request_trace.get()
+        if trace is not None and self._query is not None:
+            trace.add_fetch(self._query, time.perf_counter() - started_at, row_count)
+
+    def fetchone(self):
+        started_at = time.perf_counter()
+        row = super().fetchone()
+        self._record_fetch(started_at, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        started_at = time.perf_counter()
+        row_list = super().fetchmany(self.arraysize if size is None else size)
+        self._record_fetch(started_at, len(row_list))
+        return row_list
+
+    def fetchall(self):
+        started_at = time.perf_counter()
+        row_list = super().fetchall()
+        self._record_fetch(started_at, len(row_list))
+        return row_list
+
+    def __next__(self):
+        started_at = time.perf_counter()
+        row = super().__next__()
+        self._record_fetch(started_at, 1)
+        return row
+
+
+class InstrumentedConnection(sqlite3.Connection):
+    # sqlite3.connect(..., factory=InstrumentedConnection) で使う
+    # Connection.executeは独自のカーソルを使わないので、ここで置き換える
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, statement, parameters=()):
+        return self.cursor().execute(statement, parameters)
+
+    def executemany(self, statement, parameter_list):
+        return self.cursor().executemany(statement, parameter_list)
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        for index, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[index] += 1
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.request_duration = defaultdict(Histogram)
+        self.db_duration = defaultdict(Histogram)
+        self.template_duration = defaultdict(Histogram)
+        self.request_count = defaultdict(int)
+        self.query_count = defaultdict(int)
+        self.statement_count = defaultdict(int)
+        self.statement_duration = defaultdict(float)
+        self.statement_rows = defaultdict(int)
+
+    def record(self, trace: RequestTrace, status_code: int):
+        duration = time.perf_counter() - trace.started_at
+        with self._lock:
+            self.request_duration[trace.endpoint].observe(duration)
+            self.db_duration[trace.endpoint].observe(trace.db_time)
+            self.template_duration[trace.endpoint].observe(trace.template_time)
+            self.request_count[(trace.endpoint, status_code)] += 1
+            self.query_count[trace.endpoint] += len(trace.query_list)
+            for query in trace.query_list:
+                self.statement_count[query["statement"]] += 1
+                self.statement_duration[query["statement"]] += query["duration"]
+                self.statement_rows[query["statement"]] += query["rows"]
+
+    def render(self) -> str:
+        # Prometheusのテキスト形式（version 0.0.4）
+        line_list = []
+        with self._lock:
+            for name, help_text, histograms in [
+                ("kakeibo_request_duration_seconds", "リクエストの処理時間", self.request_duration),
+                ("kakeibo_request_db_duration_seconds", "リクエスト中のSQLの実行時間", self.db_duration),
+                ("kakeibo_request_template_duration_seconds", "リクエスト中のテンプレートの描画時間", self.template_duration),
+            ]:
+                line_list.append(f"# HELP {name} {help_text}")
+                line_list.append(f"# TYPE {name} histogram")
+                for endpoint, histogram in sorted(histograms.items()):
+                    label = f'endpoint="{escape_label(endpoint)}"'
+                    for upper_bound, count in zip(histogram.buckets, histogram.counts):
+                        line_list.append(f'{name}_bucket{{{label},le="{upper_bound}"}} {count}')
+                    line_list.append(f'{name}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                    line_list.append(f"{name}_sum{{{label}}} {histogram.sum}")
+                    line_list.append(f"{name}_count{{{label}}} {histogram.count}")
+            line_list.append("# HELP kakeibo_requests_total リクエスト数")
+            line_list.append("# TYPE kakeibo_requests_total counter")
+            for (endpoint, status_code), count in sorted(self.request_count.items()):
+                line_list.append(
+                    f'kakeibo_requests_total{{endpoint="{escape_label(endpoint)}",status="{status_code}"}} {count}'
+                )
+            line_list.append("# HELP kakeibo_queries_total リクエスト中に実行したSQLの数")
+            line_list.append("# TYPE kakeibo_queries_total counter")
+            for endpoint, count in sorted(self.query_count.items()):
+                line_list.append(f'kakeibo_queries_total{{endpoint="{escape_label(endpoint)}"}} {count}')
+            for name, help_text, values in [
+                ("kakeibo_statement_executions_total", "SQL文ごとの実行回数", self.statement_count),
+                ("kakeibo_statement_duration_seconds_total", "SQL文ごとの実行時間の合計", self.statement_duration),
+                ("kakeibo_statement_rows_total", "SQL文ごとの読み書きした行数", self.statement_rows),
+            ]:
+                line_list.append(f"# HELP {name} {help_text}")
+                line_list.append(f"# TYPE {name} counter")
+                for statement, value in sorted(values.items()):
+                    line_list.append(f'{name}{{statement="{escape_label(statement)}"}} {value}')
+        return "\n".join(line_list) + "\n"
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class StackSampler:
+    # 一定間隔で対象のスレッドのスタックを記録する（サンプリングプロファイラ）
+    # 結果は flamegraph.pl や speedscope で読める collapsed 形式（"関数;関数;関数 回数"）で書き出す
+
+    def __init__(self, thread_id: int, interval: float = PROFILE_SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stack_counts = defaultdict(int)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = ";".join(
+                f"{os.path.basename(summary.filename)}:{summary.name}"
+                for summary in traceback.extract_stack(frame)
+            )
+            self.stack_counts[stack] += 1
+
+    def write(self, path: str):
+        with open(path, "w", encoding="utf-8") as file:
+            for stack, count in self.stack_counts.items():
+                file.write(f"{stack} {count}\n")
+
+
+class RequestProfiler:
+    # 1リクエスト分のプロファイルを取る
+    # mode="cprofile" は pstats 形式（snakevizなどで読める）、mode="sample" は collapsed 形式で書き出す
+
+    def __init__(self, mode: str):
+        self.mode = mode
+        if mode == "sample":
+            self._profiler = StackSampler(threading.get_ident())
+        else:
+            self._profiler = cProfile.Profile()
+
+    def start(self):
+        if self.mode == "sample":
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+
+    def stop(self, endpoint: str) -> str:
+        os.makedirs(PROFILE_DIRECTORY, exist_ok=True)
+        filename = f"{time.strftime('%Y%m%d-%H%M%S')}-{endpoint}-{os.getpid()}"
+        if self.mode == "sample":
+            self._profiler.stop()
+            path = os.path.join(PROFILE_DIRECTORY, filename + ".collapsed")
+            self._profiler.write(path)
+        else:
+            self._profiler.disable()
+            path = os.path.join(PROFILE_DIRECTORY, filename + ".prof")
+            self._profiler.dump_stats(path)
+        return path
@@ -0,0 +1,355 @@
+import json
+import sqlite3
+
+from archive import (
+    get_archived_month_message,
+    get_first_open_date,
+    is_archived_item_name,
+    is_archived_month,
+)
+from cube import (
+    add_items_to_spending_cube,
+    remove_items_from_spending_cube,
+    rename_service_in_spending_cube,
+    replace_item_in_spending_cube,
+)
+from events import record_live_event
+from page_cache import bump_month_versions
+from rollup import (
+    add_item_to_month_service_total,
+    add_items_to_month_service_totals,
+    remove_item_from_month_service_total,
+    remove_items_from_month_service_totals,
+    replace_item_in_month_service_total,
+)
+
+# app.pyの書き込み処理
+# writer.pyの書き込み用のスレッドで、他の書き込みとまとめて1つのトランザクションの中で実行される
+# 同名の固定費・商品の重複はスキーマの一意インデックスで判定する（schema.pyのマイグレーション2・6）
+# 登録はINSERT ... ON CONFLICT DO NOTHINGの1文で行い、1行も入らなかったら重複として扱う
+# ここではコミット・ロールバックをしないこと（エラーは戻り値のメッセージで返す）
+# まとめて変更・削除する処理は、選んだ商品を1つのUPDATE・DELETE文で書き換え、集計テーブルもまとめて更新する
+# 商品のidの一覧はJSONの配列にして json_each で展開する（件数が多くてもSQLの変数の数の上限に当たらない）
+# 書き込みが成功したら、同じトランザクションでライブ更新のイベントを記録する（events.py）
+
+
+def build_insert_statement(table_name: str, register_body: dict) -> str:
+    return "".join(
+        [
+            f"insert into {table_name} (",
+            ", ".join("`" + key + "`" for key in register_body.keys()),
+            ") values (",
+            ", ".join(["?"] * len(register_body)),
+            ")",
+        ]
+    )
+
+
+def register_service(db: sqlite3.Connection, yyyymm: str, service_name: str, upper_limit) -> str:
+    register_body = {
+        "year_month": yyyymm,
+        "service_name": service_name,
+        "upper_limit": upper_limit,
+    }
+    inserted = db.execute(
+        build_insert_statement("service", register_body)
+        + " on conflict (year_month, service_name) do nothing",
+        [value for value in register_body.values()],
+    ).rowcount
+    # 同名の固定費がある場合のエラー
+    if inserted == 0:
+        return "同じ名前の固定費が既に存在しています"
+    bump_month_versions(db, [yyyymm])
+    record_live_event(db, "service_changed", [yyyymm])
+    return ""
+
+
+def update_service_upper_limit(db: sqlite3.Connection, yyyymm: str, service_name: str, upper_limit):
+    db.execute(
+        "update service set upper_limit = ? where service_name = ? and year_month = ?",
+        [upper_limit, service_name, yyyymm],
+    )
+    bump_month_versions(db, [yyyymm])
+    record_live_event(db, "service_changed", [yyyymm])
+
+
+def is_service_name_in_use(db: sqlite3.Connection, service_name: str) -> bool:
+    # 締めた月（archive.py）の固定費・商品も含めて、その名前が使われているか
+    return (
+        db.execute(
+            "select 1 from service where service_name = :service_name "
+            "union all select 1 from month_service_totals where service_name = :service_name "
+            "union all select 1 from archived_item_names where service_name = :service_name "
+            "limit 1",
+            {"service_name": service_name},
+        ).fetchone()
+        is not None
+    )
+
+
+def rename_service(db: sqlite3.Connection, service_name: str, new_service_name: str) -> str:
+    # 全ての月の固定費と商品の固定費名を、それぞれ1つのUPDATE文で変える
+    # 締めた月は書き換えられないので、アーカイブに移した固定費・商品と集計テーブルの行は元の名前のまま残る
+    if new_service_name == service_name:
+        return ""
+    if is_service_name_in_use(db, new_service_name):
+        return "同じ名前の固定費が既に存在しています"
+    first_open_date = get_first_open_date(db)
+    year_month_list = [
+        row[0]
+        for row in db.execute(
+            "select year_month from service where service_name = :service_name "
+            "union select year_month from month_service_totals "
+            "where service_name = :service_name and year_month >= substr(:first_open_date, 1, 7)",
+            {"service_name": service_name, "first_open_date": first_open_date},
+        )
+    ]
+    db.execute(
+        "update service set service_name = ? where service_name = ?",
+        [new_service_name, service_name],
+    )
+    db.execute(
+        "update item set service_name = ? where service_name = ?",
+        [new_service_name, service_name],
+    )
+    db.execute(
+        "update month_service_totals set service_name = ? "
+        "where service_name = ? and year_month >= substr(?, 1, 7)",
+        [new_service_name, service_name, first_open_date],
+    )
+    rename_service_in_spending_cube(db, service_name, new_service_name, first_open_date)
+    bump_month_versions(db, year_month_list)
+    record_live_event(
+        db,
+        "service_changed",
+        year_month_list,
+        service_name=service_name,
+        new_service_name=new_service_name,
+    )
+    return ""
+
+
+def update_service(
+    db: sqlite3.Connection, yyyymm: str, service_name: str, new_service_name: str, upper_limit
+) -> str:
+    # 予算変更画面から、固定費名の変更と今月の上限金額の変更を1つのトランザクションで行う
+    error_message = rename_service(db, service_name, new_service_name)
+    if error_message:
+        return error_message
+    update_service_upper_limit(db, yyyymm, new_service_name, upper_limit)
+    return ""
+
+
+def delete_service(db: sqlite3.Connection, yyyymm: str, service_name: str):
+    db.execute(
+        "delete from service where service_name = ? and year_month = ?",
+        [service_name, yyyymm],
+    )
+    bump_month_versions(db, [yyyymm])
+    record_live_event(db, "service_changed", [yyyymm])
+
+
+def register_item(db: sqlite3.Connection, register_body: dict) -> str:
+    # 締めた月（archive.py）には登録できない。アーカイブに移した商品とも同じ名前にはできない
+    if is_archived_month(db, register_body["purchase_date"][:7]):
+        return get_archived_month_message(register_body["purchase_date"])
+    if is_archived_item_name(db, register_body["service_name"], register_body["item_name"]):
+        return f"同じ名前の商品が{register_body['service_name']}で既に購入されています"
+    cursor = db.execute(
+        build_insert_statement("item", register_body)
+        + " on conflict (service_name, item_name) do nothing",
+        [value for value in register_body.values()],
+    )
+    # 同じ商品が同じサービスで購入されている場合のエラー
+    if cursor.rowcount == 0:
+        return f"同じ名前の商品が{register_body['service_name']}で既に購入されています"
+    add_item_to_month_service_total(
+        db,
+        register_body["purchase_date"],
+        register_body["service_name"],
+        register_body["item_price"],
+    )
+    add_items_to_spending_cube(db, [register_body])
+    bump_month_versions(db, [register_body["purchase_date"][:7]])
+    record_live_event(
+        db,
+        "item_added",
+        [register_body["purchase_date"][:7]],
+        item={"item_id": cursor.lastrowid, **register_body},
+    )
+    return ""
+
+
+def update_item(db: sqlite3.Connection, item_id, update_body: dict) -> str:
+    # 変更前の商品は、同じトランザクションの中で読み直す
+    objective_item = db.execute(
+        "select * from item where item_id = ?", [item_id]
+    ).fetchone()
+    if objective_item is None:
+        return "商品が見つかりません"
+    if is_archived_month(db, update_body["purchase_date"][:7]):
+        return get_archived_month_message(update_body["purchase_date"])
+    if is_archived_item_name(db, update_body["service_name"], update_body["item_name"]):
+        return f"同じ名前の商品が{update_body['service_name']}で既に購入されています"
+    # UPDATEにはON CONFLICT DO NOTHINGがないので、一意インデックスの違反をエラーとして受け取る
+    # （違反したUPDATE文だけが取り消され、トランザクションは続けられる）
+    try:
+        db.execute(
+            "update item set purchase_date = ?, service_name = ?, item_name = ?, item_price = ?, item_attribute = ? where item_id = ?",
+            [
+                update_body["purchase_date"],
+                update_body["service_name"],
+                update_body["item_name"],
+                update_body["item_price"],
+                update_body["item_attribute"],
+                item_id,
+            ],
+        )
+    except sqlite3.IntegrityError:
+        # 同名の商品が変更先のサービスで購入されている場合のエラー
+        return f"同じ名前の商品が{update_body['service_name']}で既に購入されています"
+    # 月や固定費が変わった場合も含めて、集計テーブルを同じトランザクションで更新する
+    replace_item_in_month_service_total(db, objective_item, update_body)
+    replace_item_in_spending_cube(db, objective_item, update_body)
+    bump_month_versions(
+        db, [objective_item["purchase_date"][:7], update_body["purchase_date"][:7]]
+    )
+    record_live_event(
+        db,
+        "item_updated",
+        [objective_item["purchase_date"][:7], update_body["purchase_date"][:7]],
+        old_item={
+            "item_id": objective_item["item_id"],
+            "purchase_date": objective_item["purchase_date"],
+            "service_name": objective_item["service_name"],
+        },
+        item={"item_id": objective_item["item_id"], **update_body},
+    )
+    return ""
+
+
+def delete_item(db: sqlite3.Connection, item_id):
+    # 削除した商品の購入日を返す（商品がなければNone）
+    deleted_item = db.execute(
+        "select purchase_date, service_name, item_price, item_attribute from item where item_id = ?",
+        [item_id],
+    ).fetchone()
+    if deleted_item is None:
+        return None
+    db.execute(
+        "delete from item where item_id = ?",
+        [item_id],
+    )
+    remove_item_from_month_service_total(
+        db,
+        deleted_item["purchase_date"],
+        deleted_item["service_name"],
+        deleted_item["item_price"],
+    )
+    remove_items_from_spending_cube(db, [deleted_item])
+    bump_month_versions(db, [deleted_item["purchase_date"][:7]])
+    record_live_event(
+        db,
+        "item_removed",
+        [deleted_item["purchase_date"][:7]],
+        old_item={
+            "item_id": int(item_id),
+            "purchase_date": deleted_item["purchase_date"],
+            "service_name": deleted_item["service_name"],
+        },
+    )
+    return deleted_item["purchase_date"]
+
+
+def get_items(db: sqlite3.Connection, item_id_list: list[int]) -> list[sqlite3.Row]:
+    return db.execute(
+        "select * from item where item_id in (select value from json_each(?))",
+        [json.dumps(item_id_list)],
+    ).fetchall()
+
+
+def delete_items(db: sqlite3.Connection, item_id_list: list[int]) -> int:
+    # 選んだ商品をまとめて削除し、削除した件数を返す（締めた月の商品は item にないので消えない）
+    deleted_item_list = get_items(db, item_id_list)
+    if not deleted_item_list:
+        return 0
+    db.execute(
+        "delete from item where item_id in (select value from json_each(?))",
+        [json.dumps(item_id_list)],
+    )
+    remove_items_from_month_service_totals(db, deleted_item_list)
+    remove_items_from_spending_cube(db, deleted_item_list)
+    year_month_list = [item["purchase_date"][:7] for item in deleted_item_list]
+    bump_month_versions(db, year_month_list)
+    record_live_event(db, "items_changed", year_month_list)
+    return len(deleted_item_list)
+
+
+def move_items_to_service(db: sqlite3.Connection, item_id_list: list[int], service_name: str) -> str:
+    # 選んだ商品の固定費をまとめて変える（購入日・商品名・値段・購入者はそのまま）
+    moved_item_list = [
+        item for item in get_items(db, item_id_list) if item["service_name"] != service_name
+    ]
+    if not moved_item_list:
+        return ""
+    moved_item_id_list = json.dumps([item["item_id"] for item in moved_item_list])
+    archived_item_name = db.execute(
+        "select item_name from item where item_id in (select value from json_each(?)) "
+        "and exists (select 1 from archived_item_names a where a.service_name = ? and a.item_name = item.item_name) "
+        "limit 1",
+        [moved_item_id_list, service_name],
+    ).fetchone()
+    if archived_item_name is not None:
+        return f"同じ名前の商品（{archived_item_name[0]}）が{service_name}で既に購入されています"
+    # 変更先の固定費に同名の商品がある場合（選んだ商品どうしが同名の場合も）は、UPDATE文ごと取り消される
+    try:
+        db.execute(
+            "update item set service_name = ? where item_id in (select value from json_each(?))",
+            [service_name, moved_item_id_list],
+        )
+    except sqlite3.IntegrityError:
+        return f"同じ名前の商品が{service_name}で既に購入されています"
+    new_item_list = [{**dict(item), "service_name": service_name} for item in moved_item_list]
+    remove_items_from_month_service_totals(db, moved_item_list)
+    add_items_to_month_service_totals(db, new_item_list)
+    remove_items_from_spending_cube(db, moved_item_list)
+    add_items_to_spending_cube(db, new_item_list)
+    year_month_list = [item["purchase_date"][:7] for item in moved_item_list]
+    bump_month_versions(db, year_month_list)
+    record_live_event(db, "items_changed", year_month_list)
+    return ""
+
+
+def get_missing_service_message(db: sqlite3.Connection, yyyymm: str, service_name: str) -> str:
+    # 画面では今月の固定費から選ぶが、APIではその月に固定費が登録されているかを確かめる（importer.pyと同じメッセージ）
+    if db.execute(
+        "select 1 from service where year_month = ? and service_name = ?", [yyyymm, service_name]
+    ).fetchone() is None:
+        return f"{yyyymm}に固定費{service_name}が登録されていません"
+    return ""
+
+
+def apply_item_changes(db: sqlite3.Connection, change_list: list[dict]) -> list[dict]:
+    # オフラインの間に溜めた商品の変更（POST /api/v1/changes）を、1つのトランザクションでまとめて反映する
+    # 変更ごとに (id, エラーメッセージ) を返す。エラーになった変更は反映されず、他の変更は反映される
+    result_list = []
+    for change in change_list:
+        item_id = change["id"]
+        if change["operation"] == "delete":
+            error_message = "" if delete_item(db, item_id) is not None else "商品が見つかりません"
+        else:
+            item = change["data"]
+            error_message = get_missing_service_message(
+                db, item["purchase_date"][:7], item["service_name"]
+            )
+            if not error_message and item_id is None:
+                error_message = register_item(db, item)
+                if not error_message:
+                    item_id = db.execute(
+                        "select item_id from item where service_name = ? and item_name = ?",
+                        [item["service_name"], item["item_name"]],
+                    ).fetchone()[0]
+            elif not error_message:
+                error_message = update_item(db, item_id, item)
+        result_list.append({"id": item_id, "error": error_message})
+    return result_list
@@ -0,0 +1,90 @@
+import collections
+import hashlib
+import sqlite3
+import threading
+
+from config import PAGE_CACHE_MAX_BYTES, PAGE_CACHE_MAX_ENTRIES
+
+# 月ごとの版数は month_versions テーブルに持つ（複数のプロセスで動かしても同じ版数を見る）
+# 固定費や商品を書き換えたときは、同じトランザクションの中でその月の版数を上げる
+# ALL_MONTHS は全ての月にまたがる画面（履歴など）のための版数で、どの月を書き換えても上がる
+ALL_MONTHS = "*"
+
+
+def bump_month_versions(db: sqlite3.Connection, year_month_list):
+    year_month_set = {year_month for year_month in year_month_list if year_month}
+    if not year_month_set:
+        return
+    db.executemany(
+        "insert into month_versions (year_month, version) values (?, 1) "
+        "on conflict (year_month) do update set version = version + 1",
+        [[year_month] for year_month in sorted(year_month_set | {ALL_MONTHS})],
+    )
+
+
+def get_month_version(db: sqlite3.Connection, year_month: str) -> int:
+    row = db.execute(
+        "select version from month_versions where year_month = ?", [year_month]
+    ).fetchone()
+    return row[0] if row is not None else 0
+
+
+CachedPage = collections.namedtuple(
+    "CachedPage", ["version", "etag", "body", "mimetype"]
+)
+
+
+def make_etag(body: bytes) -> str:
+    # 表示内容そのもののハッシュなので、同じ内容なら同じ（強い）ETagになる
+    return hashlib.sha256(body).hexdigest()[:32]
+
+
+class PageCache:
+    # 描画済みの画面を保存しておくLRUキャッシュ
+    # 件数と合計バイト数の上限を超えたら、最も長く使われていないものから消す
+
+    def __init__(self, max_entries: int = PAGE_CACHE_MAX_ENTRIES, max_bytes: int = PAGE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._pages = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version: int):
+        with self._lock:
+            page = self._pages.get(key)
+            if page is None or page.version != version:
+                self.misses += 1
+                return None
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return page
+
+    def put(self, key, page: CachedPage):
+        if len(page.body) > self.max_bytes:
+            return
+        with self._lock:
+            old_page = self._pages.pop(key, None)
+            if old_page is not None:
+                self._bytes -= len(old_page.body)
+            self._pages[key] = page
+            self._bytes += len(page.body)
+            while len(self._pages) > self.max_entries or self._bytes > self.max_bytes:
+                _, evicted_page = self._pages.popitem(last=False)
+                self._bytes -= len(evicted_page.body)
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._pages),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
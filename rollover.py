@@ -0,0 +1,58 @@
+import sqlite3
+
+from events import record_live_event
+from page_cache import bump_month_versions
+
+# 新しい月になったら、直近の月の固定費（名前と上限金額）を新しい月にコピーする
+# 1つのINSERT ... SELECTを1つのトランザクションで実行し、
+# (year_month, service_name) のユニークインデックスで同じ固定費が2回登録されることを防ぐ
+# 何回実行しても結果は変わらない（既に固定費がある月には何もしない）
+ROLL_OVER_SERVICES_STATEMENT = """
+insert into service (year_month, service_name, upper_limit)
+select :yyyymm, service_name, upper_limit from service
+where year_month = (select max(year_month) from service where year_month < :yyyymm)
+    and not exists (select 1 from service where year_month = :yyyymm)
+order by service_id
+on conflict (year_month, service_name) do nothing
+"""
+
+
+def copy_services_to_new_month(db: sqlite3.Connection, yyyymm: str) -> int:
+    # 書き込み用のキュー（writer.py）で実行する処理。コピーした固定費の数を返す（コミットは呼び出し側で行う）
+    cursor = db.execute(ROLL_OVER_SERVICES_STATEMENT, {"yyyymm": yyyymm})
+    if cursor.rowcount > 0:
+        bump_month_versions(db, [yyyymm])
+        record_live_event(db, "service_changed", [yyyymm])
+    return cursor.rowcount
+
+
+def roll_over_services(db: sqlite3.Connection, yyyymm: str) -> int:
+    # コピーした固定費の数を返す（アプリの外から実行するとき用。アプリでは書き込み用のキューで実行する）
+    # begin immediateで最初に書き込みのロックを取るので、同時に実行されても順番に処理される
+    if db.in_transaction:
+        db.commit()
+    db.execute("begin immediate")
+    try:
+        service_count = copy_services_to_new_month(db, yyyymm)
+        db.commit()
+    except BaseException:
+        db.rollback()
+        raise
+    return service_count
+
+
+if __name__ == "__main__":
+    import sys
+
+    from config import DATABASE
+    from database import apply_pragmas
+    from schema import migrate
+    from util import get_current_yyyymm
+
+    # 使い方: python rollover.py [YYYY-MM]（cronなどで毎月1日に実行する）
+    yyyymm = sys.argv[1] if len(sys.argv) > 1 else get_current_yyyymm()
+    con = sqlite3.connect(DATABASE)
+    apply_pragmas(con)
+    migrate(con)
+    print(f"{yyyymm}: {roll_over_services(con, yyyymm)}件の固定費をコピーしました")
+    con.close()
@@ -0,0 +1,263 @@
+import sqlite3
+
+from archive import get_first_open_date
+
+# month_service_totals は item テーブルを (年月, 固定費名) ごとに集計したもの
+# day_totals は item テーブルを購入日ごとに集計したもの（期間の集計で使う。analytics.py）
+# month_service_totals を更新する関数は、day_totals も一緒に更新する
+# 商品を登録・編集・削除するときは、同じトランザクションの中でここの関数を呼んで集計を更新する
+# コミットは呼び出し側で行う
+
+
+def add_item_to_day_total(db: sqlite3.Connection, purchase_date: str, item_price):
+    db.execute(
+        "insert into day_totals (purchase_date, total_usage, item_count) values (?, ?, 1) "
+        "on conflict (purchase_date) do update set "
+        "total_usage = total_usage + excluded.total_usage, item_count = item_count + 1",
+        [purchase_date, item_price],
+    )
+
+
+def remove_item_from_day_total(db: sqlite3.Connection, purchase_date: str, item_price):
+    db.execute(
+        "update day_totals set total_usage = total_usage - ?, item_count = item_count - 1 "
+        "where purchase_date = ?",
+        [item_price, purchase_date],
+    )
+    db.execute(
+        "delete from day_totals where purchase_date = ? and item_count <= 0",
+        [purchase_date],
+    )
+
+
+def add_item_to_month_service_total(
+    db: sqlite3.Connection, purchase_date: str, service_name: str, item_price
+):
+    add_item_to_day_total(db, purchase_date, item_price)
+    db.execute(
+        "insert into month_service_totals (year_month, service_name, total_usage, item_count) values (?, ?, ?, 1) "
+        "on conflict (year_month, service_name) do update set "
+        "total_usage = total_usage + excluded.total_usage, item_count = item_count + 1",
+        [purchase_date[:7], service_name, item_price],
+    )
+
+
+def remove_item_from_month_service_total(
+    db: sqlite3.Connection, purchase_date: str, service_name: str, item_price
+):
+    remove_item_from_day_total(db, purchase_date, item_price)
+    db.execute(
+        "update month_service_totals set total_usage = total_usage - ?, item_count = item_count - 1 "
+        "where year_month = ? and service_name = ?",
+        [item_price, purchase_date[:7], service_name],
+    )
+    # 商品が1つもなくなった行は消しておく
+    db.execute(
+        "delete from month_service_totals where year_month = ? and service_name = ? and item_count <= 0",
+        [purchase_date[:7], service_name],
+    )
+
+
+def replace_item_in_month_service_total(
+    db: sqlite3.Connection, old_item: sqlite3.Row, new_item: dict
+):
+    # 商品の編集で月や固定費が変わった場合も、古い集計から引いて新しい集計に足せばよい
+    remove_item_from_month_service_total(
+        db, old_item["purchase_date"], old_item["service_name"], old_item["item_price"]
+    )
+    add_item_to_month_service_total(
+        db, new_item["purchase_date"], new_item["service_name"], new_item["item_price"]
+    )
+
+
+def _apply_items_to_month_service_totals(db: sqlite3.Connection, item_list: list, sign: int):
+    # 多くの商品をまとめて足す・引くときは、(年月, 固定費名) ごとに集計してから1回で更新する（sign=-1なら引く）
+    totals = {}
+    day_totals = {}
+    for item in item_list:
+        key = (item["purchase_date"][:7], item["service_name"])
+        total_usage, item_count = totals.get(key, (0, 0))
+        totals[key] = (total_usage + sign * int(item["item_price"]), item_count + sign)
+        total_usage, item_count = day_totals.get(item["purchase_date"], (0, 0))
+        day_totals[item["purchase_date"]] = (
+            total_usage + sign * int(item["item_price"]),
+            item_count + sign,
+        )
+    db.executemany(
+        "insert into day_totals (purchase_date, total_usage, item_count) values (?, ?, ?) "
+        "on conflict (purchase_date) do update set "
+        "total_usage = total_usage + excluded.total_usage, item_count = item_count + excluded.item_count",
+        [
+            [purchase_date, total_usage, item_count]
+            for purchase_date, (total_usage, item_count) in day_totals.items()
+        ],
+    )
+    db.executemany(
+        "insert into month_service_totals (year_month, service_name, total_usage, item_count) values (?, ?, ?, ?) "
+        "on conflict (year_month, service_name) do update set "
+        "total_usage = total_usage + excluded.total_usage, item_count = item_count + excluded.item_count",
+        [
+            [year_month, service_name, total_usage, item_count]
+            for (year_month, service_name), (total_usage, item_count) in totals.items()
+        ],
+    )
+    if sign < 0:
+        # 商品が1つもなくなった行は消しておく
+        db.executemany(
+            "delete from day_totals where purchase_date = ? and item_count <= 0",
+            [[purchase_date] for purchase_date in day_totals],
+        )
+        db.executemany(
+            "delete from month_service_totals where year_month = ? and service_name = ? and item_count <= 0",
+            list(totals.keys()),
+        )
+
+
+def add_items_to_month_service_totals(db: sqlite3.Connection, item_list: list):
+    _apply_items_to_month_service_totals(db, item_list, 1)
+
+
+def remove_items_from_month_service_totals(db: sqlite3.Connection, item_list: list):
+    _apply_items_to_month_service_totals(db, item_list, -1)
+
+
+def get_month_service_totals(db: sqlite3.Connection, yyyymm: str) -> dict[str, int]:
+    # その月の固定費ごとの使用額を {固定費名: 使用額} の形で返す
+    return {
+        row[0]: row[1]
+        for row in db.execute(
+            "select service_name, total_usage from month_service_totals where year_month = ?",
+            [yyyymm],
+        )
+    }
+
+
+# item テーブルから集計し直した結果と、month_service_totals の差分を求めるクエリ
+# アーカイブに移した月（archive.py）の行は固定しているので、購入日が :first_open_date 以降の月だけを比べる
+DRIFT_QUERY = """
+with expected as (
+    select substr(purchase_date, 1, 7) as year_month, service_name,
+        sum(item_price) as total_usage, count(*) as item_count
+    from item where purchase_date >= :first_open_date
+    group by substr(purchase_date, 1, 7), service_name
+),
+recorded as (
+    select * from month_service_totals where year_month >= substr(:first_open_date, 1, 7)
+)
+select e.year_month, e.service_name, e.total_usage, e.item_count, t.total_usage, t.item_count
+from expected e left join recorded t
+    on t.year_month = e.year_month and t.service_name = e.service_name
+where t.total_usage is not e.total_usage or t.item_count is not e.item_count
+union all
+select t.year_month, t.service_name, null, null, t.total_usage, t.item_count
+from recorded t left join expected e
+    on e.year_month = t.year_month and e.service_name = t.service_name
+where e.year_month is null
+"""
+
+
+# item テーブルから集計し直した結果と、day_totals の差分を求めるクエリ
+DAY_DRIFT_QUERY = """
+with expected as (
+    select purchase_date, sum(item_price) as total_usage, count(*) as item_count
+    from item where purchase_date >= :first_open_date group by purchase_date
+),
+recorded as (
+    select * from day_totals where purchase_date >= :first_open_date
+)
+select e.purchase_date, e.total_usage, e.item_count, t.total_usage, t.item_count
+from expected e left join recorded t on t.purchase_date = e.purchase_date
+where t.total_usage is not e.total_usage or t.item_count is not e.item_count
+union all
+select t.purchase_date, null, null, t.total_usage, t.item_count
+from recorded t left join expected e on e.purchase_date = t.purchase_date
+where e.purchase_date is null
+"""
+
+
+def verify_month_service_totals(db: sqlite3.Connection) -> list[dict]:
+    # 集計がずれている (年月, 固定費名) を列挙する。空のリストならずれはない
+    return [
+        {
+            "year_month": row[0],
+            "service_name": row[1],
+            "expected_total_usage": row[2],
+            "expected_item_count": row[3],
+            "recorded_total_usage": row[4],
+            "recorded_item_count": row[5],
+        }
+        for row in db.execute(DRIFT_QUERY, {"first_open_date": get_first_open_date(db)})
+    ]
+
+
+def verify_day_totals(db: sqlite3.Connection) -> list[dict]:
+    # 集計がずれている購入日を列挙する。空のリストならずれはない
+    return [
+        {
+            "purchase_date": row[0],
+            "expected_total_usage": row[1],
+            "expected_item_count": row[2],
+            "recorded_total_usage": row[3],
+            "recorded_item_count": row[4],
+        }
+        for row in db.execute(DAY_DRIFT_QUERY, {"first_open_date": get_first_open_date(db)})
+    ]
+
+
+def rebuild_month_service_totals(db: sqlite3.Connection) -> list[dict]:
+    # item テーブルから集計し直す（day_totalsも。締めた月の行はそのまま残す）。集計し直す前に見つかったずれを返す
+    drift = verify_month_service_totals(db)
+    parameters = {"first_open_date": get_first_open_date(db)}
+    with db:
+        db.execute("delete from day_totals where purchase_date >= :first_open_date", parameters)
+        db.execute(
+            "insert into day_totals (purchase_date, total_usage, item_count) "
+            "select purchase_date, sum(item_price), count(*) from item "
+            "where purchase_date >= :first_open_date group by purchase_date",
+            parameters,
+        )
+        db.execute(
+            "delete from month_service_totals where year_month >= substr(:first_open_date, 1, 7)",
+            parameters,
+        )
+        db.execute(
+            "insert into month_service_totals (year_month, service_name, total_usage, item_count) "
+            "select substr(purchase_date, 1, 7), service_name, sum(item_price), count(*) "
+            "from item where purchase_date >= :first_open_date "
+            "group by substr(purchase_date, 1, 7), service_name",
+            parameters,
+        )
+    return drift
+
+
+if __name__ == "__main__":
+    import sys
+
+    from config import DATABASE
+    from schema import migrate
+
+    # 使い方: python rollup.py verify | rebuild
+    command = sys.argv[1] if len(sys.argv) > 1 else "verify"
+    con = sqlite3.connect(DATABASE)
+    migrate(con)
+    day_drift = verify_day_totals(con)
+    if command == "rebuild":
+        drift = rebuild_month_service_totals(con)
+    else:
+        drift = verify_month_service_totals(con)
+    for row in drift:
+        print(
+            f"{row['year_month']} {row['service_name']}: "
+            f"item={row['expected_total_usage']}円/{row['expected_item_count']}件, "
+            f"集計={row['recorded_total_usage']}円/{row['recorded_item_count']}件"
+        )
+    for row in day_drift:
+        print(
+            f"{row['purchase_date']}: "
+            f"item={row['expected_total_usage']}円/{row['expected_item_count']}件, "
+            f"集計={row['recorded_total_usage']}円/{row['recorded_item_count']}件"
+        )
+    drift = drift + day_drift
+    print(f"{len(drift)}件のずれ" + ("を修正しました" if command == "rebuild" and drift else ""))
+    con.close()
+    sys.exit(1 if drift and command == "verify" else 0)
@@ -0,0 +1,292 @@
+import sqlite3
+
+# スキーマのバージョンは PRAGMA user_version に記録する
+# MIGRATIONS[n] はバージョン n から n + 1 に上げるためのSQL文のリスト
+# 新しい変更は必ず末尾に追加し、既存のマイグレーションは書き換えないこと
+MIGRATIONS = [
+    # 1: 既存のテーブル（以前は app.py の末尾で作成していたもの）
+    [
+        "create table if not exists service(service_id integer primary key autoincrement, year_month text not null, service_name text not null, upper_limit integer not null)",
+        "create table if not exists item(item_id integer primary key autoincrement, purchase_date text not null, service_name text not null, item_name text not null, item_price integer not null, item_attribute text not null)",
+        "create table if not exists extra_item(extra_item_id integer primary key autoincrement, purchase_date text not null, service_name text not null, extra_item_name text not null, extra_item_price integer not null, extra_item_attribute text not null)",
+    ],
+    # 2: 月での絞り込みとサービスごとの検索のためのインデックス
+    # 同じ月に同名の固定費が重複している場合は、最初に登録されたものだけを残し、消した行をservice_duplicate_removalsに残す
+    [
+        "create table if not exists service_duplicate_removals(service_id integer primary key, year_month text not null, service_name text not null, upper_limit integer not null, removed_at text not null default current_timestamp)",
+        "insert into service_duplicate_removals (service_id, year_month, service_name, upper_limit) select service_id, year_month, service_name, upper_limit from service where service_id not in (select min(service_id) from service group by year_month, service_name)",
+        "delete from service where service_id in (select service_id from service_duplicate_removals)",
+        "create index if not exists idx_item_purchase_date_service_name on item(purchase_date, service_name)",
+        "create index if not exists idx_item_service_name_item_name on item(service_name, item_name)",
+        "create unique index if not exists idx_service_year_month_service_name on service(year_month, service_name)",
+    ],
+    # 3: 月×固定費ごとの使用額の集計テーブル（rollup.pyで更新する）
+    [
+        "create table if not exists month_service_totals(year_month text not null, service_name text not null, total_usage integer not null default 0, item_count integer not null default 0, primary key (year_month, service_name)) without rowid",
+        "insert or replace into month_service_totals (year_month, service_name, total_usage, item_count) select substr(purchase_date, 1, 7), service_name, sum(item_price), count(*) from item group by substr(purchase_date, 1, 7), service_name",
+    ],
+    # 4: 月ごとのデータの版数（page_cache.pyで画面のキャッシュを無効にするために使う）
+    [
+        "create table if not exists month_versions(year_month text primary key, version integer not null default 0) without rowid",
+    ],
+    # 5: 固定費ごとの商品を購入日順に読むためのインデックス（item_idは行IDとして末尾に含まれる）
+    [
+        "create index if not exists idx_item_service_name_purchase_date on item(service_name, purchase_date)",
+    ],
+    # 6: 同じ固定費で同じ名前の商品を登録できないように、一意インデックスにする（operations.pyはON CONFLICTで重複を判定する）
+    # 既に重複している商品は消さずに、最初に登録されたもの以外の商品名の末尾に商品IDを付け、元の名前をitem_duplicate_renamesに残す
+    [
+        "create table if not exists item_duplicate_renames(item_id integer primary key, original_item_name text not null, renamed_at text not null default current_timestamp)",
+        lambda con: rename_duplicate_items(con),
+        "drop index if exists idx_item_service_name_item_name",
+        "create unique index idx_item_service_name_item_name on item(service_name, item_name)",
+    ],
+    # 7: (年月, 固定費名, 購入者) の全ての組み合わせの集計（cube.pyで更新する。"*"はその次元の合計）
+    # 主キーは月ごとの切り口、インデックスは固定費ごと・購入者ごとに月をまたぐ切り口のため
+    [
+        "create table if not exists spending_cube(year_month text not null, service_name text not null, item_attribute text not null, total_usage integer not null default 0, item_count integer not null default 0, primary key (year_month, service_name, item_attribute)) without rowid",
+        "create index if not exists idx_spending_cube_service_name_item_attribute on spending_cube(service_name, item_attribute, year_month)",
+        "create index if not exists idx_spending_cube_item_attribute on spending_cube(item_attribute, year_month)",
+        "insert into spending_cube (year_month, service_name, item_attribute, total_usage, item_count) "
+        "with masks(mask) as (values (0), (1), (2), (3), (4), (5), (6), (7)) "
+        "select case when mask & 1 then '*' else substr(purchase_date, 1, 7) end, "
+        "case when mask & 2 then '*' else service_name end, "
+        "case when mask & 4 then '*' else item_attribute end, "
+        "sum(item_price), count(*) from item, masks group by 1, 2, 3",
+    ],
+    # 8: 購入日ごとの使用額の集計（rollup.pyで更新する。analytics.pyで日単位の期間の集計に使う）
+    [
+        "create table if not exists day_totals(purchase_date text primary key, total_usage integer not null default 0, item_count integer not null default 0) without rowid",
+        "insert or replace into day_totals (purchase_date, total_usage, item_count) select purchase_date, sum(item_price), count(*) from item group by purchase_date",
+    ],
+    # 9: 商品名・固定費名の全文検索（search.py）
+    # item_searchはitemを元にしたFTS5の索引（trigramなので日本語の部分一致も引ける）、
+    # item_name_statsは商品名ごとの購入回数と最後に買った日（入力補完の順位づけに使う）
+    # どちらもitemのトリガーで同じトランザクションの中で更新する
+    [
+        "create virtual table if not exists item_search using fts5(item_name, service_name, content='item', content_rowid='item_id', tokenize='trigram')",
+        "insert into item_search(item_search) values ('rebuild')",
+        "create table if not exists item_name_stats(item_name text primary key, purchase_count integer not null default 0, last_purchase_date text not null) without rowid",
+        "insert or replace into item_name_stats (item_name, purchase_count, last_purchase_date) select item_name, count(*), max(purchase_date) from item group by item_name",
+        "create trigger if not exists item_after_insert after insert on item begin "
+        "insert into item_search(rowid, item_name, service_name) values (new.item_id, new.item_name, new.service_name); "
+        "insert into item_name_stats (item_name, purchase_count, last_purchase_date) values (new.item_name, 1, new.purchase_date) "
+        "on conflict (item_name) do update set purchase_count = purchase_count + 1, last_purchase_date = max(last_purchase_date, excluded.last_purchase_date); "
+        "end",
+        # 削除では最後に買った日は戻さない（入力補完の順位が少し変わるだけなので、商品名での検索を省く）
+        "create trigger if not exists item_after_delete after delete on item begin "
+        "insert into item_search(item_search, rowid, item_name, service_name) values ('delete', old.item_id, old.item_name, old.service_name); "
+        "update item_name_stats set purchase_count = purchase_count - 1 where item_name = old.item_name; "
+        "delete from item_name_stats where item_name = old.item_name and purchase_count <= 0; "
+        "end",
+        "create trigger if not exists item_after_update after update of item_name, service_name, purchase_date on item begin "
+        "insert into item_search(item_search, rowid, item_name, service_name) values ('delete', old.item_id, old.item_name, old.service_name); "
+        "insert into item_search(rowid, item_name, service_name) values (new.item_id, new.item_name, new.service_name); "
+        "update item_name_stats set purchase_count = purchase_count - 1 where item_name = old.item_name; "
+        "delete from item_name_stats where item_name = old.item_name and purchase_count <= 0; "
+        "insert into item_name_stats (item_name, purchase_count, last_purchase_date) values (new.item_name, 1, new.purchase_date) "
+        "on conflict (item_name) do update set purchase_count = purchase_count + 1, last_purchase_date = max(last_purchase_date, excluded.last_purchase_date); "
+        "end",
+    ],
+    # 10: 締めた月のアーカイブ（archive.py）
+    # archived_months はアーカイブに移した月と、移したときの件数・合計・上限金額の合計（集計テーブルの行はそのまま残して固定する）
+    # archived_item_names はアーカイブに移した商品の (固定費名, 商品名)（同名の商品を登録できないようにするため）
+    # アーカイブに移すときの削除では入力補完の購入回数を減らさないよう、item_after_delete を2つに分ける
+    [
+        "create table if not exists archived_months(year_month text primary key, archive_year text not null, item_count integer not null, total_usage integer not null, service_count integer not null, total_upper_limit integer not null, archived_at text not null) without rowid",
+        "create table if not exists archived_item_names(service_name text not null, item_name text not null, primary key (service_name, item_name)) without rowid",
+        "drop trigger if exists item_after_delete",
+        "create trigger if not exists item_after_delete after delete on item begin "
+        "insert into item_search(item_search, rowid, item_name, service_name) values ('delete', old.item_id, old.item_name, old.service_name); "
+        "end",
+        "create trigger if not exists item_after_delete_stats after delete on item "
+        "when not exists (select 1 from archived_months where year_month = substr(old.purchase_date, 1, 7)) begin "
+        "update item_name_stats set purchase_count = purchase_count - 1 where item_name = old.item_name; "
+        "delete from item_name_stats where item_name = old.item_name and purchase_count <= 0; "
+        "end",
+    ],
+    # 11: ライブ更新のイベント（events.py）
+    # 書き込みと同じトランザクションで記録し、ワーカーごとのスレッドが event_id の順に読んで配信する
+    [
+        "create table if not exists live_events(event_id integer primary key, event_type text not null, year_months text not null, payload text not null, created_at text not null)",
+    ],
+    # 12: 差分同期のための変更履歴（changes.py）
+    # item・serviceの行が変わるたびに、トリガーで change_log に (版数, 種類, id, upsert/delete) を記録する
+    # (entity, entity_id) の一意インデックスに insert or replace するので、同じ行の古い変更は消え、行ごとに最新の1件だけが残る
+    # 版数は autoincrement で、消した行の版数も含めて二度と使わない
+    # アーカイブに移した月（archive.py）の行の削除は、削除として記録せず、変更履歴からも消す
+    # 今ある全ての行を upsert として記録しておくので、since=0 で全ての行を受け取れる
+    [
+        "create table if not exists change_log(version integer primary key autoincrement, entity text not null, entity_id integer not null, operation text not null, changed_at text not null)",
+        "create unique index if not exists idx_change_log_entity on change_log(entity, entity_id)",
+        "create table if not exists change_log_state(name text primary key, value integer not null) without rowid",
+        "insert or ignore into change_log_state (name, value) values ('horizon', 0)",
+        "insert or replace into change_log (entity, entity_id, operation, changed_at) "
+        "select 'service', service_id, 'upsert', datetime('now') from service order by service_id",
+        "insert or replace into change_log (entity, entity_id, operation, changed_at) "
+        "select 'item', item_id, 'upsert', datetime('now') from item order by item_id",
+        "create trigger if not exists service_after_insert_change after insert on service begin "
+        "insert or replace into change_log (entity, entity_id, operation, changed_at) values ('service', new.service_id, 'upsert', datetime('now')); "
+        "end",
+        "create trigger if not exists service_after_update_change after update on service begin "
+        "insert or replace into change_log (entity, entity_id, operation, changed_at) values ('service', new.service_id, 'upsert', datetime('now')); "
+        "end",
+        "create trigger if not exists service_after_delete_change after delete on service "
+        "when not exists (select 1 from archived_months where year_month = old.year_month) begin "
+        "insert or replace into change_log (entity, entity_id, operation, changed_at) values ('service', old.service_id, 'delete', datetime('now')); "
+        "end",
+        "create trigger if not exists service_after_archive_change after delete on service "
+        "when exists (select 1 from archived_months where year_month = old.year_month) begin "
+        "delete from change_log where entity = 'service' and entity_id = old.service_id; "
+        "end",
+        "create trigger if not exists item_after_insert_change after insert on item begin "
+        "insert or replace into change_log (entity, entity_id, operation, changed_at) values ('item', new.item_id, 'upsert', datetime('now')); "
+        "end",
+        "create trigger if not exists item_after_update_change after update on item begin "
+        "insert or replace into change_log (entity, entity_id, operation, changed_at) values ('item', new.item_id, 'upsert', datetime('now')); "
+        "end",
+        "create trigger if not exists item_after_delete_change after delete on item "
+        "when not exists (select 1 from archived_months where year_month = substr(old.purchase_date, 1, 7)) begin "
+        "insert or replace into change_log (entity, entity_id, operation, changed_at) values ('item', old.item_id, 'delete', datetime('now')); "
+        "end",
+        "create trigger if not exists item_after_archive_change after delete on item "
+        "when exists (select 1 from archived_months where year_month = substr(old.purchase_date, 1, 7)) begin "
+        "delete from change_log where entity = 'item' and entity_id = old.item_id; "
+        "end",
+    ],
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(con: sqlite3.Connection) -> int:
+    return con.execute("pragma user_version").fetchone()[0]
+
+
+def rename_duplicate_items(con: sqlite3.Connection):
+    # マイグレーション6：同じ固定費で名前が重複している商品の、最初に登録されたもの以外の商品名の末尾に (商品ID) を付ける
+    # 付けた名前の商品が既にあれば (商品ID-2)、(商品ID-3)… にする（一意インデックスを作れなくならないように）
+    duplicate_item_list = con.execute(
+        "select item_id, service_name, item_name from item "
+        "where item_id not in (select min(item_id) from item group by service_name, item_name) order by item_id"
+    ).fetchall()
+    for item_id, service_name, item_name in duplicate_item_list:
+        new_item_name = f"{item_name} ({item_id})"
+        number = 2
+        while con.execute(
+            "select 1 from item where service_name = ? and item_name = ?", [service_name, new_item_name]
+        ).fetchone() is not None:
+            new_item_name = f"{item_name} ({item_id}-{number})"
+            number += 1
+        con.execute(
+            "insert into item_duplicate_renames (item_id, original_item_name) values (?, ?)",
+            [item_id, item_name],
+        )
+        con.execute("update item set item_name = ? where item_id = ?", [new_item_name, item_id])
+
+
+def migrate(con: sqlite3.Connection) -> int:
+    # 未適用のマイグレーションを1つずつ、それぞれ1つのトランザクションで適用する
+    # マイグレーションのSQL文の代わりに、接続を受け取る関数も書ける（SQLだけでは書けない処理のため）
+    current_version = get_schema_version(con)
+    for version in range(current_version, SCHEMA_VERSION):
+        if con.in_transaction:
+            con.commit()
+        con.execute("begin")
+        try:
+            for statement in MIGRATIONS[version]:
+                if callable(statement):
+                    statement(con)
+                else:
+                    con.execute(statement)
+            con.execute(f"pragma user_version = {version + 1}")
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+    return get_schema_version(con)
+
+
+def explain_query_plan(con: sqlite3.Connection, statement: str, parameters=()) -> list[str]:
+    # EXPLAIN QUERY PLAN の detail 列だけを返す
+    return [
+        row[-1]
+        for row in con.execute("explain query plan " + statement, parameters).fetchall()
+    ]
+
+
+# 月で絞り込むクエリなど、インデックスを使うべきクエリの一覧
+INDEXED_QUERIES = [
+    (
+        "select * from item where purchase_date >= ? and purchase_date < ?",
+        ["2024-06-01", "2024-07-01"],
+    ),
+    (
+        "select * from item where purchase_date >= ? and purchase_date < ? and service_name = ?",
+        ["2024-06-01", "2024-07-01", "食費"],
+    ),
+    (
+        "select service_name, item_name from item where service_name = ? and item_name = ?",
+        ["食費", "牛乳"],
+    ),
+    (
+        "select item_id, purchase_date from item where service_name = ? and (purchase_date, item_id) > (?, ?) order by purchase_date, item_id limit 50",
+        ["食費", "2024-06-01", 0],
+    ),
+    (
+        "select * from service where year_month = ?",
+        ["2024-06"],
+    ),
+    (
+        "select service_name, upper_limit from service where service_name = ? and year_month = ?",
+        ["食費", "2024-06"],
+    ),
+    (
+        "select year_month, service_name, item_attribute, total_usage, item_count from spending_cube where service_name = ? and item_attribute = ? and year_month >= ? and year_month < ?",
+        ["食費", "*", "2024-01", "2025-01"],
+    ),
+    (
+        "select year_month, service_name, item_attribute, total_usage, item_count from spending_cube where service_name = ? and item_attribute = ?",
+        ["*", "夫"],
+    ),
+]
+
+
+def get_renamed_duplicate_items(con: sqlite3.Connection) -> list:
+    # マイグレーション6で名前を変えた商品（重複していた商品）の一覧
+    return con.execute(
+        "select r.item_id, r.original_item_name, i.item_name, i.service_name, i.purchase_date "
+        "from item_duplicate_renames r join item i on i.item_id = r.item_id order by r.item_id"
+    ).fetchall()
+
+
+def get_removed_duplicate_services(con: sqlite3.Connection) -> list:
+    # マイグレーション2で消した固定費（同じ月に重複していた固定費）の一覧
+    return con.execute(
+        "select service_id, year_month, service_name, upper_limit from service_duplicate_removals order by service_id"
+    ).fetchall()
+
+
+def check_query_plans(con: sqlite3.Connection) -> list[str]:
+    # インデックスを使わずにテーブル全体を走査（SCAN）してしまうクエリを列挙する
+    # 空のリストが返ればすべてのクエリがインデックスを使っている
+    problems = []
+    for statement, parameters in INDEXED_QUERIES:
+        plan = explain_query_plan(con, statement, parameters)
+        if any(detail.startswith("SCAN") and "INDEX" not in detail for detail in plan):
+            problems.append(f"{statement}: {' / '.join(plan)}")
+    return problems
+
+
+if __name__ == "__main__":
+    from config import DATABASE
+
+    con = sqlite3.connect(DATABASE)
+    print(f"schema version: {migrate(con)}")
+    for problem in check_query_plans(con):
+        print(f"full scan: {problem}")
+    for service_id, year_month, service_name, upper_limit in get_removed_duplicate_services(con):
+        print(f"removed duplicate service {service_id}: {year_month} {service_name} {upper_limit}")
+    for item_id, original_item_name, item_name, service_name, purchase_date in get_renamed_duplicate_items(con):
+        print(f"renamed duplicate item {item_id}: {service_name} {purchase_date} {original_item_name} -> {item_name}")
+    con.close()
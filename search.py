@@ -0,0 +1,82 @@
+import sqlite3
+
+from util import get_month_date_range
+
+# 商品名・固定費名の検索と、商品名の入力補完
+# 検索はFTS5の item_search（trigram）を使う。trigramは3文字以上の語を索引にするので、
+# 2文字以下の語（「牛乳」など）はLIKEでの部分一致になる（itemを新しい順に読みながら調べるので、珍しい語だと遅い）
+# 入力補完は item_name_stats の主キー（商品名）を前方一致の範囲で読み、購入回数・最後に買った日の順に並べる
+
+SEARCH_DEFAULT_PAGE_SIZE = 50
+AUTOCOMPLETE_LIMIT = 10
+# 入力補完で順位づけする候補の最大数（1文字目だけのように候補がとても多いときも、読む行数をこれで抑える）
+AUTOCOMPLETE_CANDIDATE_LIMIT = 2000
+TRIGRAM_LENGTH = 3
+
+
+def make_match_query(query: str) -> str:
+    # 入力をそのままFTS5の構文として解釈させないよう、語ごとに "" で囲む（空白区切りの語はAND）
+    return " ".join('"' + term.replace('"', '""') + '"' for term in query.split())
+
+
+def search_items(
+    db: sqlite3.Connection,
+    query: str,
+    yyyymm: str = "",
+    service_name: str = "",
+    item_attribute: str = "",
+    limit: int = SEARCH_DEFAULT_PAGE_SIZE,
+    cursor=None,
+) -> tuple[list, bool]:
+    # 商品を新しい順（購入日, item_id の降順）に limit 件返す。cursorは前のページの最後の (購入日, item_id)
+    # 2つ目の戻り値は、次のページがあるかどうか
+    condition_list = []
+    parameter_list = []
+    term_list = query.split()
+    match_term_list = [term for term in term_list if len(term) >= TRIGRAM_LENGTH]
+    if match_term_list:
+        condition_list.append("item.item_id in (select rowid from item_search where item_search match ?)")
+        parameter_list.append(make_match_query(" ".join(match_term_list)))
+    for term in term_list:
+        if len(term) < TRIGRAM_LENGTH:
+            condition_list.append("(item.item_name like ? escape '\\' or item.service_name like ? escape '\\')")
+            pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            parameter_list.extend([pattern, pattern])
+    if yyyymm:
+        condition_list.append("item.purchase_date >= ? and item.purchase_date < ?")
+        parameter_list.extend(get_month_date_range(yyyymm))
+    if service_name:
+        condition_list.append("item.service_name = ?")
+        parameter_list.append(service_name)
+    if item_attribute:
+        condition_list.append("item.item_attribute = ?")
+        parameter_list.append(item_attribute)
+    if cursor is not None:
+        condition_list.append("(item.purchase_date, item.item_id) < (?, ?)")
+        parameter_list.extend(cursor)
+    row_list = db.execute(
+        "select item.* from item"
+        + (" where " + " and ".join(condition_list) if condition_list else "")
+        + " order by item.purchase_date desc, item.item_id desc limit ?",
+        parameter_list + [limit + 1],
+    ).fetchall()
+    return row_list[:limit], len(row_list) > limit
+
+
+def get_item_name_suggestions(db: sqlite3.Connection, prefix: str, limit: int = AUTOCOMPLETE_LIMIT) -> list[dict]:
+    # prefixで始まる商品名を、よく買う順・最近買った順に返す
+    if not prefix:
+        return []
+    return [
+        {
+            "item_name": row[0],
+            "purchase_count": row[1],
+            "last_purchase_date": row[2],
+        }
+        for row in db.execute(
+            "select item_name, purchase_count, last_purchase_date from ("
+            "select * from item_name_stats where item_name >= ? and item_name < ? order by item_name limit ?"
+            ") order by purchase_count desc, last_purchase_date desc, item_name limit ?",
+            [prefix, prefix + "\U0010ffff", AUTOCOMPLETE_CANDIDATE_LIMIT, limit],
+        )
+    ]
@@ -0,0 +1,129 @@
+import argparse
+import os
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import make_server
+
+from app import create_app
+from config import DATABASE, SERVER_BACKLOG, SERVER_HOST, SERVER_PORT, SERVER_WORKERS
+from households import migrate_database
+
+# 本番用のサーバー（pre-fork）
+# 親プロセスでマイグレーションとポートのbindを1回だけ行い、ワーカーをforkする
+# ワーカーはforkした後にcreate_appを呼ぶので、DBとの接続・プール・書き込み用のスレッドはワーカーごとに作られる
+# ワーカーが落ちたら親プロセスが起動し直す
+# app.pyのimportは親プロセスで済ませておく（importしてもDBには接続しない）ので、ワーカーの起動はcreate_appの分だけで済む
+#
+# 使い方: python server.py --workers 4 --port 8000
+# gunicornを使う場合は gunicorn -w 4 "app:create_app()" でもよい（マイグレーションは flask --app app migrate で先に行う）
+#
+# 1つのDBに書き込めるのは同時に1つの接続だけなので、ワーカーを増やして速くなるのは主に読み込み
+# （書き込みはbusy_timeoutの間待ってからSQLITE_BUSYになる。ワーカーの数はCPUの数くらいにする）
+
+
+def log(message: str):
+    print(f"[{os.getpid()}] {message}", file=sys.stderr, flush=True)
+
+
+def run_worker(listen_socket: socket.socket, host: str, port: int):
+    # forkした後に呼ばれる。親プロセスではFlaskのアプリを作らない
+    started_at = time.perf_counter()
+    app = create_app()
+    created_at = time.perf_counter()
+    server = make_server(host, port, app, threaded=True, fd=listen_socket.fileno())
+    # 起動にかかった時間（create_appとサーバーの準備を分けて）を出す
+    log(
+        "worker ready in {:.1f}ms (create_app {:.1f}ms)".format(
+            (time.perf_counter() - started_at) * 1000,
+            (created_at - started_at) * 1000,
+        )
+    )
+    # SIGTERMを受けたらKeyboardInterruptにして、serve_foreverを抜ける
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        server.serve_forever()
+    finally:
+        app.extensions["kakeibo"]["router"].close()
+
+
+def spawn_worker(listen_socket: socket.socket, host: str, port: int) -> int:
+    pid = os.fork()
+    if pid != 0:
+        return pid
+    # 子プロセス。Ctrl+Cは親プロセスが受けて、SIGTERMでワーカーを止める
+    # 親プロセスのSIGTERMのハンドラー（他のワーカーを止める）を引き継がないよう、すぐに元に戻す
+    # （run_workerがハンドラーを設定するまでの起動中にSIGTERMを受けたら、そのまま終わる）
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    exit_code = 0
+    try:
+        run_worker(listen_socket, host, port)
+    except BaseException:
+        import traceback
+
+        traceback.print_exc()
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+
+def serve(host: str, port: int, workers: int):
+    # マイグレーションは親プロセスで1回だけ行う
+    started_at = time.perf_counter()
+    migrate_database(DATABASE)
+    log("migrated {} in {:.1f}ms".format(DATABASE, (time.perf_counter() - started_at) * 1000))
+
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind((host, port))
+    listen_socket.listen(SERVER_BACKLOG)
+    listen_socket.set_inheritable(True)
+    log(f"listening on http://{host}:{port} with {workers} workers")
+
+    worker_pid_set = set()
+    is_stopping = False
+
+    def stop(signum, frame):
+        nonlocal is_stopping
+        is_stopping = True
+        for pid in worker_pid_set:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        worker_pid_set.add(spawn_worker(listen_socket, host, port))
+
+    while worker_pid_set:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        worker_pid_set.discard(pid)
+        if is_stopping:
+            continue
+        log(f"worker {pid} exited with status {status}, restarting")
+        # 起動直後に落ち続ける場合に、CPUを使い切らないよう少し待つ
+        time.sleep(1)
+        worker_pid_set.add(spawn_worker(listen_socket, host, port))
+
+    listen_socket.close()
+    log("stopped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    args = parser.parse_args()
+    serve(args.host, args.port, args.workers)
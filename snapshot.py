@@ -0,0 +1,390 @@
+import array
+import bisect
+import datetime
+import json
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+from archive import open_month, read_ledger
+from cube import ALL
+from config import SNAPSHOT_SAVE_INTERVAL
+from page_cache import ALL_MONTHS
+from util import get_month_date_range, get_month_number
+
+# 商品（item）の読み取り専用のスナップショット
+# sqlite3.Row を1件ずつ作らずに集計できるよう、商品を列ごとの int32 の配列（array）で持つ
+#   商品は (月, 固定費, 購入者, 購入日) の順に並べ、(月, 固定費, 購入者) が同じ商品の並びを「セル」と呼ぶ
+#   月・固定費・購入者の列はセルごとに1つだけ持つ（商品1件あたりは購入日と値段の8バイトになる）
+#   固定費名・購入者は、出てきた順に番号を振った辞書で持つ
+# 集計は条件に合うセルの範囲の値段を sum() でまとめて足すので、Pythonのループは商品ではなくセルの数だけ回る
+# データが変わったら、版数（month_versions）が変わった月の商品だけを読み直す
+#   （編集・削除では item_id の最大値が変わらないので、item_id ではなく月の版数で読み直す月を決める）
+# DBファイルの隣に「<DB>.snapshot」として保存し、起動したワーカーはそれをmmapで開く（DBを全件読まずに済む）
+
+SNAPSHOT_MAGIC = b"KKBSNAP1"
+SNAPSHOT_EXTENSION = ".snapshot"
+# 保存するときの配列の順番（セルの列、商品の列）
+CELL_COLUMN_LIST = ["cell_month_number", "cell_service_number", "cell_attribute_number", "cell_end"]
+ITEM_COLUMN_LIST = ["day_number", "item_price"]
+
+
+def new_column() -> array.array:
+    return array.array("i")
+
+
+def get_month_versions(db: sqlite3.Connection) -> dict:
+    return {
+        year_month: version
+        for year_month, version in db.execute("select year_month, version from month_versions")
+        if year_month != ALL_MONTHS
+    }
+
+
+def get_snapshot_path(db: sqlite3.Connection) -> str:
+    # メモリ上のDB（ファイル名が空）なら保存しない
+    for _, name, path in db.execute("pragma database_list"):
+        if name == "main":
+            return path + SNAPSHOT_EXTENSION if path else ""
+    return ""
+
+
+class LedgerSnapshot:
+    def __init__(self, service_name_list: list, attribute_list: list, month_versions: dict, columns: dict):
+        # columnsは列名から array('i')（またはmmapしたファイルのmemoryview）への辞書
+        self.service_name_list = service_name_list
+        self.service_number_by_name = {name: number for number, name in enumerate(service_name_list)}
+        self.attribute_list = attribute_list
+        self.attribute_number_by_name = {name: number for number, name in enumerate(attribute_list)}
+        self.month_versions = month_versions
+        self.columns = columns
+        self.cell_month_number = columns["cell_month_number"]
+        self.cell_service_number = columns["cell_service_number"]
+        self.cell_attribute_number = columns["cell_attribute_number"]
+        self.cell_end = columns["cell_end"]
+        self.day_number = columns["day_number"]
+        self.item_price = columns["item_price"]
+
+    def __len__(self) -> int:
+        return len(self.day_number)
+
+    def get_cell_range(self, cell_number: int) -> tuple[int, int]:
+        return (self.cell_end[cell_number - 1] if cell_number else 0), self.cell_end[cell_number]
+
+    def get_month_cell_range(self, first_month_number: int, last_month_number: int) -> tuple[int, int]:
+        # 月が [first_month_number, last_month_number] のセルの番号の範囲
+        return (
+            bisect.bisect_left(self.cell_month_number, first_month_number),
+            bisect.bisect_right(self.cell_month_number, last_month_number),
+        )
+
+    def aggregate(
+        self,
+        first_date: datetime.date,
+        last_date: datetime.date,
+        service_name=ALL,
+        item_attribute=ALL,
+    ) -> dict:
+        # 期間 [first_date, last_date] の商品を (固定費名, 購入者) ごとに集計し、(使用額, 件数) を返す
+        # 固定費名・購入者に"*"以外を渡すと、その固定費・購入者だけに絞り込む
+        service_number = self.service_number_by_name.get(service_name) if service_name != ALL else None
+        attribute_number = (
+            self.attribute_number_by_name.get(item_attribute) if item_attribute != ALL else None
+        )
+        if (service_name != ALL and service_number is None) or (
+            item_attribute != ALL and attribute_number is None
+        ):
+            return {}
+        first_day_number = first_date.toordinal()
+        last_day_number = last_date.toordinal()
+        first_month_number = first_date.year * 12 + first_date.month - 1
+        last_month_number = last_date.year * 12 + last_date.month - 1
+        totals = {}
+        first_cell_number, last_cell_number = self.get_month_cell_range(first_month_number, last_month_number)
+        for cell_number in range(first_cell_number, last_cell_number):
+            if service_number is not None and self.cell_service_number[cell_number] != service_number:
+                continue
+            if attribute_number is not None and self.cell_attribute_number[cell_number] != attribute_number:
+                continue
+            start, end = self.get_cell_range(cell_number)
+            # セルの中は購入日の順なので、期間の最初と最後の月だけは二分探索で日の範囲に絞る
+            month_number = self.cell_month_number[cell_number]
+            if month_number == first_month_number:
+                start = bisect.bisect_left(self.day_number, first_day_number, start, end)
+            if month_number == last_month_number:
+                end = bisect.bisect_right(self.day_number, last_day_number, start, end)
+            if start >= end:
+                continue
+            key = (
+                self.service_name_list[self.cell_service_number[cell_number]],
+                self.attribute_list[self.cell_attribute_number[cell_number]],
+            )
+            usage, count = totals.get(key, (0, 0))
+            totals[key] = (usage + sum(self.item_price[start:end]), count + end - start)
+        return totals
+
+    def get_total(self) -> tuple[int, int]:
+        return sum(self.item_price), len(self.item_price)
+
+
+# 月と購入日の通し番号はSQLiteの中で計算する（Pythonで1件ずつ日付を解析するより速い）
+# 購入日は date.toordinal() と同じ、西暦1年1月1日を1とする通し番号にする
+SNAPSHOT_ITEM_SELECT = """
+select
+    cast(substr(purchase_date, 1, 4) as integer) * 12 + cast(substr(purchase_date, 6, 2) as integer) - 1,
+    service_name,
+    item_attribute,
+    cast(julianday(purchase_date) - 1721424.5 as integer),
+    item_price
+from {schema}.item
+"""
+
+
+def read_month_cells(row_iter, snapshot_names, cells: dict):
+    # SNAPSHOT_ITEM_SELECT で読んだ商品を、(月, 固定費, 購入者) の番号をキーにした (購入日, 値段) のリストに足す
+    service_name_list, service_number_by_name, attribute_list, attribute_number_by_name = snapshot_names
+    for month_number, service_name, item_attribute, day_number, item_price in row_iter:
+        service_number = service_number_by_name.get(service_name)
+        if service_number is None:
+            service_number = service_number_by_name[service_name] = len(service_name_list)
+            service_name_list.append(service_name)
+        attribute_number = attribute_number_by_name.get(item_attribute)
+        if attribute_number is None:
+            attribute_number = attribute_number_by_name[item_attribute] = len(attribute_list)
+            attribute_list.append(item_attribute)
+        key = (month_number, service_number, attribute_number)
+        # 購入日の形式が正しくない商品はjuliandayがnullになるので、どの期間にも入らない0にする（合計には含める）
+        if day_number is None:
+            day_number = 0
+        cell = cells.get(key)
+        if cell is None:
+            cell = cells[key] = []
+        cell.append((day_number, item_price))
+
+
+def build_snapshot(db: sqlite3.Connection, snapshot: LedgerSnapshot = None) -> LedgerSnapshot:
+    # snapshotを渡すと、版数が変わった月だけを読み直した新しいスナップショットを返す（渡したものは変えない）
+    # 版数を先に読むので、読んでいる間に書き込まれてもその月は次の呼び出しでもう一度読み直される
+    month_versions = get_month_versions(db)
+    if snapshot is None:
+        changed_yyyymm_list = None
+        names = ([], {}, [], {})
+    else:
+        changed_yyyymm_list = sorted(
+            yyyymm
+            for yyyymm in month_versions.keys() | snapshot.month_versions.keys()
+            if month_versions.get(yyyymm, 0) != snapshot.month_versions.get(yyyymm, 0)
+        )
+        if not changed_yyyymm_list:
+            return snapshot
+        names = (
+            list(snapshot.service_name_list),
+            dict(snapshot.service_number_by_name),
+            list(snapshot.attribute_list),
+            dict(snapshot.attribute_number_by_name),
+        )
+
+    # 新しく読んだセル（値はリスト）と、前のスナップショットからそのまま使うセル（値は商品の位置の範囲）
+    # 締めた月の商品はアーカイブ（archive.py）から読む
+    cells = {}
+    if changed_yyyymm_list is None:
+        read_month_cells(read_ledger(db, SNAPSHOT_ITEM_SELECT), names, cells)
+    else:
+        for yyyymm in changed_yyyymm_list:
+            with open_month(db, yyyymm) as schema:
+                read_month_cells(
+                    db.execute(
+                        SNAPSHOT_ITEM_SELECT.format(schema=schema)
+                        + " where purchase_date >= ? and purchase_date < ?",
+                        get_month_date_range(yyyymm),
+                    ),
+                    names,
+                    cells,
+                )
+        changed_month_number_set = {get_month_number(yyyymm) for yyyymm in changed_yyyymm_list}
+        for cell_number in range(len(snapshot.cell_end)):
+            month_number = snapshot.cell_month_number[cell_number]
+            if month_number not in changed_month_number_set:
+                key = (month_number, snapshot.cell_service_number[cell_number], snapshot.cell_attribute_number[cell_number])
+                cells[key] = snapshot.get_cell_range(cell_number)
+
+    columns = {column: new_column() for column in CELL_COLUMN_LIST + ITEM_COLUMN_LIST}
+    for key in sorted(cells):
+        cell = cells[key]
+        if isinstance(cell, tuple):
+            start, end = cell
+            for column in ITEM_COLUMN_LIST:
+                columns[column].frombytes(memoryview(snapshot.columns[column])[start:end].cast("B"))
+        else:
+            cell.sort()
+            columns["day_number"].extend(day_number for day_number, _ in cell)
+            columns["item_price"].extend(item_price for _, item_price in cell)
+        for column, value in zip(CELL_COLUMN_LIST, [*key, len(columns["day_number"])]):
+            columns[column].append(value)
+    return LedgerSnapshot(names[0], names[2], month_versions, columns)
+
+
+def is_snapshot_consistent(db: sqlite3.Connection, snapshot: LedgerSnapshot) -> bool:
+    # spending_cube の全体の合計のセルと比べる（別のDBのスナップショットや、版数を上げずに書き換えた場合に気づける）
+    row = db.execute(
+        "select total_usage, item_count from spending_cube "
+        "where year_month = ? and service_name = ? and item_attribute = ?",
+        [ALL, ALL, ALL],
+    ).fetchone()
+    return snapshot.get_total() == (tuple(row) if row is not None else (0, 0))
+
+
+def save_snapshot(snapshot: LedgerSnapshot, path: str):
+    # 途中まで書いたファイルを読まれないよう、別名で書いてから置き換える
+    header = json.dumps(
+        {
+            "service_name_list": snapshot.service_name_list,
+            "attribute_list": snapshot.attribute_list,
+            "month_versions": snapshot.month_versions,
+            "lengths": {column: len(snapshot.columns[column]) for column in CELL_COLUMN_LIST + ITEM_COLUMN_LIST},
+        },
+        ensure_ascii=False,
+    ).encode("utf-8")
+    # 配列の先頭が4バイト境界に来るように、ヘッダーの後ろを空白で埋める
+    header += b" " * (-(len(SNAPSHOT_MAGIC) + 4 + len(header)) % 4)
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(SNAPSHOT_MAGIC + struct.pack("<I", len(header)) + header)
+        for column in CELL_COLUMN_LIST + ITEM_COLUMN_LIST:
+            file.write(snapshot.columns[column])
+    os.replace(temporary_path, path)
+
+
+def load_snapshot(path: str):
+    # 配列はコピーせず、mmapしたファイルをそのまま読む（同じファイルを開いたワーカー同士でメモリを共有できる）
+    # ファイルがない・壊れている・形式が違う場合はNoneを返す
+    try:
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return None
+    offset = len(SNAPSHOT_MAGIC) + 4
+    try:
+        if mapped[: len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("形式が違う")
+        (header_length,) = struct.unpack_from("<I", mapped, len(SNAPSHOT_MAGIC))
+        header = json.loads(mapped[offset : offset + header_length].decode("utf-8"))
+        offset += header_length
+        lengths = [header["lengths"][column] * new_column().itemsize for column in CELL_COLUMN_LIST + ITEM_COLUMN_LIST]
+        if offset + sum(lengths) != len(mapped):
+            raise ValueError("途中までしか書かれていない")
+    except (ValueError, KeyError, struct.error):
+        mapped.close()
+        return None
+    view = memoryview(mapped)
+    columns = {}
+    for column, length in zip(CELL_COLUMN_LIST + ITEM_COLUMN_LIST, lengths):
+        columns[column] = view[offset : offset + length].cast("i")
+        offset += length
+    return LedgerSnapshot(
+        header["service_name_list"], header["attribute_list"], header["month_versions"], columns
+    )
+
+
+class SnapshotCache:
+    # 世帯ごとのスナップショット。リクエストのたびに版数を確かめ、変わった月だけを読み直す
+    # 保存は SNAPSHOT_SAVE_INTERVAL 秒に1回まで（再起動したワーカーは、保存した後に変わった月だけを読み直せばよい）
+
+    def __init__(self, save_interval: float = SNAPSHOT_SAVE_INTERVAL):
+        self.save_interval = save_interval
+        self._snapshots = {}
+        # _lockは_snapshots・_key_locks・数を読み書きする間だけ持つ。読み直す間は世帯ごとのロックを持つ
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self.builds = 0
+        self.loads = 0
+        self.refreshes = 0
+
+    def get(self, db: sqlite3.Connection, key) -> LedgerSnapshot:
+        # 読み直している間に同じ世帯を何度も読み直さないよう、世帯ごとのロックの中で作る
+        # （他の世帯のリクエストは待たせない）
+        with self._lock:
+            key_lock = self._key_locks.get(key)
+            if key_lock is None:
+                key_lock = self._key_locks[key] = threading.Lock()
+        with key_lock:
+            with self._lock:
+                snapshot, saved_at = self._snapshots.get(key, (None, 0.0))
+            builds = loads = refreshes = 0
+            refreshed_snapshot = snapshot
+            path = get_snapshot_path(db)
+            if refreshed_snapshot is None and path:
+                refreshed_snapshot = load_snapshot(path)
+                if refreshed_snapshot is not None:
+                    loads += 1
+                    saved_at = time.monotonic()
+            built = refreshed_snapshot is None
+            if built:
+                refreshed_snapshot = build_snapshot(db)
+                builds += 1
+            else:
+                previous_snapshot = refreshed_snapshot
+                refreshed_snapshot = build_snapshot(db, previous_snapshot)
+                if refreshed_snapshot is not previous_snapshot:
+                    refreshes += 1
+            if refreshed_snapshot is snapshot:
+                return snapshot
+            if not is_snapshot_consistent(db, refreshed_snapshot):
+                refreshed_snapshot = build_snapshot(db)
+                builds += 1
+                built = True
+            if path and (built or time.monotonic() - saved_at >= self.save_interval):
+                save_snapshot(refreshed_snapshot, path)
+                saved_at = time.monotonic()
+            with self._lock:
+                self._snapshots[key] = (refreshed_snapshot, saved_at)
+                self.builds += builds
+                self.loads += loads
+                self.refreshes += refreshes
+            return refreshed_snapshot
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            snapshot_list = [snapshot for snapshot, _ in self._snapshots.values()]
+        return {
+            "snapshots": len(snapshot_list),
+            "items": sum(len(snapshot) for snapshot in snapshot_list),
+            "builds": self.builds,
+            "loads": self.loads,
+            "refreshes": self.refreshes,
+        }
+
+
+if __name__ == "__main__":
+    import sys
+
+    from config import DATABASE
+    from schema import migrate
+
+    # 使い方: python snapshot.py [DBファイル]
+    # スナップショットを作り直して保存し、DBから集計した結果と合っているかを確かめる
+    path = sys.argv[1] if len(sys.argv) > 1 else DATABASE
+    con = sqlite3.connect(path)
+    migrate(con)
+    started_at = time.perf_counter()
+    snapshot = build_snapshot(con)
+    built_seconds = time.perf_counter() - started_at
+    save_snapshot(snapshot, get_snapshot_path(con))
+    started_at = time.perf_counter()
+    loaded_snapshot = load_snapshot(get_snapshot_path(con))
+    loaded_seconds = time.perf_counter() - started_at
+    consistent = is_snapshot_consistent(con, loaded_snapshot)
+    print(
+        f"{len(snapshot)}件・{len(snapshot.cell_end)}セル "
+        f"作成 {built_seconds * 1000:.0f}ms / mmapで読み込み {loaded_seconds * 1000:.1f}ms / "
+        + ("集計は一致しました" if consistent else "集計がspending_cubeと一致しません")
+    )
+    con.close()
+    sys.exit(0 if consistent else 1)
@@ -0,0 +1,144 @@
+// ライブ更新（app.pyの /events）
+// もう片方の端末で商品・固定費が変わったら、表示中の月の使用額・使用率と商品の行をその場で書き換える
+// 書き換えられない変更（固定費の追加・削除、まとめての変更など）のときは画面を読み込み直す
+(function () {
+    var root = document.querySelector("[data-live-month]");
+    if (root === null || !window.EventSource) {
+        return;
+    }
+    var month = root.dataset.liveMonth;
+    // 商品一覧なら固定費名、トップ画面なら空
+    var servicePage = root.dataset.liveServicePage || "";
+
+    function setUsage(element, currentUsage, upperLimit, usageRatio) {
+        var usage = element.querySelector("[data-live-usage]");
+        if (usage !== null) {
+            usage.textContent = currentUsage + "円 / " + upperLimit + "円";
+        }
+        var bar = element.querySelector("[data-live-bar]");
+        if (bar === null || usageRatio === null) {
+            return;
+        }
+        // 使用率が80%未満なら緑、100%未満なら黄、それ以上なら赤（テンプレートと同じ）
+        bar.classList.remove("bg-success", "bg-warning", "text-dark", "bg-danger");
+        if (usageRatio < 80) {
+            bar.classList.add("bg-success");
+        } else if (usageRatio < 100) {
+            bar.classList.add("bg-warning", "text-dark");
+        } else {
+            bar.classList.add("bg-danger");
+        }
+        bar.style.width = usageRatio + "%";
+        bar.textContent = usageRatio + "%";
+    }
+
+    function applySummary(summary) {
+        if (servicePage === "") {
+            var cardList = document.querySelectorAll("[data-live-service]");
+            var cardNameList = Array.prototype.map.call(cardList, function (card) {
+                return card.dataset.liveService;
+            });
+            var serviceNameList = summary.services.map(function (service) {
+                return service.service_name;
+            });
+            // 固定費が増えた・減った場合はカードを作り直せないので読み込み直す
+            if (cardNameList.join("\n") !== serviceNameList.join("\n")) {
+                location.reload();
+                return;
+            }
+            summary.services.forEach(function (service, index) {
+                setUsage(cardList[index], service.current_usage, service.upper_limit, service.usage_ratio);
+            });
+            setUsage(
+                document.querySelector("[data-live-total]"),
+                summary.total_usage,
+                summary.total_upper_limit,
+                summary.usage_ratio
+            );
+            return;
+        }
+        summary.services.forEach(function (service) {
+            if (service.service_name === servicePage) {
+                setUsage(root, service.current_usage, service.upper_limit, service.usage_ratio);
+            }
+        });
+    }
+
+    function isShown(item) {
+        return item.purchase_date.slice(0, 7) === month && item.service_name === servicePage;
+    }
+
+    function removeItemRow(itemId) {
+        var row = document.querySelector('[data-live-items] tr[data-item-id="' + itemId + '"]');
+        if (row !== null) {
+            row.remove();
+        }
+    }
+
+    function addItemRow(item) {
+        var tbody = document.querySelector("[data-live-items]");
+        if (tbody === null) {
+            return;
+        }
+        var row = document.createElement("tr");
+        row.dataset.itemId = item.item_id;
+        var checkboxCell = document.createElement("td");
+        var checkbox = document.createElement("input");
+        checkbox.className = "form-check-input";
+        checkbox.type = "checkbox";
+        checkbox.name = "item_id";
+        checkbox.value = item.item_id;
+        checkboxCell.appendChild(checkbox);
+        row.appendChild(checkboxCell);
+        [item.purchase_date, item.item_name, item.item_price, item.item_attribute, item.service_name].forEach(function (value) {
+            var cell = document.createElement("td");
+            cell.textContent = value;
+            row.appendChild(cell);
+        });
+        [["item_edit", "fa-pen-to-square"], ["item_delete", "fa-trash"]].forEach(function (link) {
+            var cell = document.createElement("td");
+            var anchor = document.createElement("a");
+            anchor.href = "/" + encodeURIComponent(item.service_name) + "/" + link[0] + "/" + item.item_id;
+            var icon = document.createElement("i");
+            icon.className = "fa-solid " + link[1];
+            anchor.appendChild(icon);
+            cell.appendChild(anchor);
+            row.appendChild(cell);
+        });
+        tbody.appendChild(row);
+    }
+
+    function applyEvent(eventType, data) {
+        if (data.year_months.indexOf(month) < 0) {
+            return;
+        }
+        var summary = data.summaries.filter(function (summary) {
+            return summary.year_month === month;
+        })[0];
+        // 使用額が送られてこない（月の多い変更）、または行を書き換えられない変更なら読み込み直す
+        if (summary === undefined || (servicePage !== "" && (eventType === "items_changed" || eventType === "service_changed"))) {
+            location.reload();
+            return;
+        }
+        if (servicePage !== "") {
+            if (data.old_item && isShown(data.old_item)) {
+                removeItemRow(data.old_item.item_id);
+            }
+            if (data.item && isShown(data.item)) {
+                addItemRow(data.item);
+            }
+        }
+        applySummary(summary);
+    }
+
+    var source = new EventSource("/events");
+    ["item_added", "item_updated", "item_removed", "items_changed", "service_changed"].forEach(function (eventType) {
+        source.addEventListener(eventType, function (event) {
+            applyEvent(eventType, JSON.parse(event.data));
+        });
+    });
+    // 接続が切れている間のイベントを送り直せなかったとき
+    source.addEventListener("reload", function () {
+        location.reload();
+    });
+})();
@@ -0,0 +1,62 @@
+from analytics import build_range_index, get_range_summary
+from conftest import add_service, make_item
+from operations import register_item
+
+
+def test_range_index_skips_malformed_purchase_dates(db):
+    add_service(db, "2024-06", "食費")
+    with db:
+        assert register_item(db, make_item("2024-06-01", "食費", "牛乳", 200)) == ""
+        # 入力のチェックを入れる前に登録された、購入日の形式が正しくない商品
+        assert register_item(db, make_item("2024-06-1", "食費", "パン", 300)) == ""
+        assert register_item(db, make_item("2024-6-02", "食費", "卵", 400)) == ""
+    range_index = build_range_index(db)
+    # 年月が読める商品は月の集計には入り、日の集計には入らない
+    assert get_range_summary(range_index, "2024-06", "2024-06")["total_usage"] == 500
+    assert get_range_summary(range_index, "2024-06-01", "2024-06-30")["total_usage"] == 200
+
+
+def test_range_api_with_malformed_purchase_date(db, client):
+    add_service(db, "2024-06", "食費")
+    with db:
+        assert register_item(db, make_item("2024-06-01", "食費", "牛乳", 200)) == ""
+        assert register_item(db, make_item("2024-6-01", "食費", "パン", 300)) == ""
+    assert client.get("/api/v1/range?from=2024-01&to=2024-12").status_code == 200
+    assert client.get("/api/v1/range?from=2024-01&to=2024-12&service=食費").status_code == 200
+
+
+def test_item_register_rejects_malformed_purchase_date(db, client):
+    add_service(db, "2024-06", "食費")
+    client.get("/")
+    response = client.post(
+        "/item_register",
+        data={
+            "purchase_date": "2024-13-01",
+            "service_name": "食費",
+            "item_name": "牛乳",
+            "item_price": "200",
+            "item_attribute": "夫",
+        },
+    )
+    assert "購入日の形式が正しくありません" in response.get_data(as_text=True)
+    assert db.execute("select count(*) from item").fetchone()[0] == 0
+
+
+def test_range_index_stays_small_with_far_off_dates(db):
+    add_service(db, "2024-06", "食費", 1000)
+    with db:
+        assert register_item(db, make_item("1900-01-01", "食費", "古い記録", 100)) == ""
+        assert register_item(db, make_item("2024-06-01", "食費", "牛乳", 200)) == ""
+        assert register_item(db, make_item("2024-06-03", "食費", "パン", 300)) == ""
+        assert register_item(db, make_item("2999-12-31", "食費", "遠い予定", 400)) == ""
+    range_index = build_range_index(db)
+    # 記録のある月・日の分だけの配列になる
+    assert len(range_index.day_usage_sum) == 5
+    assert len(range_index.month_usage_sum) == 4
+    assert get_range_summary(range_index, "2024-06-02", "2024-06-03")["total_usage"] == 300
+    assert get_range_summary(range_index, "2024-06-01", "2024-06-30")["total_usage"] == 500
+    assert get_range_summary(range_index, "1899-01-01", "2024-06-01")["total_usage"] == 300
+    summary = get_range_summary(range_index, "2024-01", "2024-12")
+    assert (summary["total_usage"], summary["total_upper_limit"]) == (500, 1000)
+    assert get_range_summary(range_index, "1900-01", "2999-12")["total_usage"] == 1000
+    assert get_range_summary(range_index, "2025-01", "2025-12")["total_usage"] == 0
@@ -0,0 +1,49 @@
+import base64
+
+from archive import archive_month
+from conftest import add_service, make_item
+from operations import register_item
+
+
+def get_pages(client, url) -> list[dict]:
+    page_list = [client.get(url).get_json()]
+    while page_list[-1]["next_cursor"] is not None:
+        page_list.append(client.get(f"{url}&cursor={page_list[-1]['next_cursor']}").get_json())
+    return page_list
+
+
+def test_service_items_pages_in_stable_order(db, client):
+    add_service(db, "2024-01", "食費")
+    add_service(db, "2024-06", "食費")
+    add_service(db, "2024-06", "日用品")
+    with db:
+        # 同じ購入日の商品は item_id の順に並ぶ
+        for item_name in ["牛乳", "パン", "卵"]:
+            assert register_item(db, make_item("2024-01-10", "食費", item_name, 100)) == ""
+        assert register_item(db, make_item("2024-06-01", "日用品", "洗剤", 500)) == ""
+        assert register_item(db, make_item("2024-06-01", "食費", "米", 2000)) == ""
+        assert register_item(db, make_item("2024-06-01", "食費", "味噌", 400)) == ""
+    # 締めた月（アーカイブ）から締めていない月へ続けてページを送れる
+    archive_month(db, "2024-01")
+
+    page_list = get_pages(client, "/api/v1/services/食費/items?limit=2&fields=item_name")
+    assert [page["items"] for page in page_list] == [[["牛乳"], ["パン"]], [["卵"], ["米"]], [["味噌"]]]
+    assert page_list[-1]["next_cursor"] is None
+    # 件数がちょうどlimitで割り切れる最後のページにも、次のcursorは付かない
+    page_list = get_pages(client, "/api/v1/services/食費/items?limit=2&fields=item_name&month=2024-06")
+    assert [page["items"] for page in page_list] == [[["米"], ["味噌"]]]
+
+
+def test_service_items_rejects_bad_cursor(client):
+    for cursor in [
+        "!!!",
+        "あ",
+        base64.urlsafe_b64encode(b"2024-06-01").decode(),
+        base64.urlsafe_b64encode(b"2024-06-01|abc").decode(),
+        base64.urlsafe_b64encode(b"2024-06-01|1|2").decode(),
+        base64.urlsafe_b64encode(b"0|1").decode(),
+        base64.urlsafe_b64encode(b"\xff\xfe|1").decode(),
+    ]:
+        response = client.get(f"/api/v1/services/食費/items?cursor={cursor}")
+        assert response.status_code == 400, cursor
+        assert response.get_json() == {"error": "cursorが正しくありません"}
@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+from archive import MissingArchiveError, archive_month, get_archive_path, open_month, read_ledger, verify_archive
+from conftest import add_service, make_item
+from operations import register_item
+
+
+def add_ledger(db):
+    add_service(db, "2024-01", "食費", 30000)
+    add_service(db, "2024-06", "食費", 30000)
+    with db:
+        assert register_item(db, make_item("2024-01-05", "食費", "牛乳", 200)) == ""
+        assert register_item(db, make_item("2024-01-20", "食費", "パン", 300)) == ""
+        assert register_item(db, make_item("2024-06-01", "食費", "卵", 400)) == ""
+
+
+def test_archived_month_is_read_through(db, client):
+    add_ledger(db)
+    result = archive_month(db, "2024-01")
+    assert (result["item_count"], result["total_usage"], result["service_count"]) == (2, 500, 1)
+    assert verify_archive(db) == []
+    assert db.execute("select count(*) from item where purchase_date < '2024-02-01'").fetchone()[0] == 0
+
+    # 締めた月も、これまで通り内訳・履歴・書き出し・商品一覧に出る
+    summary = client.get("/api/v1/months/2024-01/summary").get_json()
+    assert (summary["total_upper_limit"], summary["total_usage"]) == (30000, 500)
+    history = client.get("/api/v1/history").get_json()
+    month_number = history["year_months"].index("2024-01")
+    assert (history["total_upper_limit"][month_number], history["total_usage"][month_number]) == (30000, 500)
+    csv_text = client.get("/export/items.csv?month=2024-01").get_data(as_text=True)
+    assert "牛乳" in csv_text and "パン" in csv_text and "卵" not in csv_text
+    exported = client.get("/export/items.json").get_json()
+    assert [item["item_name"] for item in exported] == ["牛乳", "パン", "卵"]
+    page = client.get("/食費/2024-01/item_detail").get_data(as_text=True)
+    assert "牛乳" in page and "パン" in page
+
+
+def test_missing_archive_raises_without_creating_file(db):
+    add_ledger(db)
+    archive_month(db, "2024-01")
+    path = get_archive_path(db, "2024")
+    os.remove(path)
+    with pytest.raises(MissingArchiveError):
+        list(read_ledger(db, "select item_name from {schema}.item"))
+    with pytest.raises(MissingArchiveError):
+        with open_month(db, "2024-01"):
+            pass
+    assert not os.path.exists(path)
+    assert verify_archive(db) == [f"{path} がありません"]
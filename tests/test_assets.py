@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+from assets import ASSET_DIST_DIRECTORY, load_asset_manifest
+
+MANIFEST = load_asset_manifest()
+CSS_FILENAME = MANIFEST["bundles"]["app.css"]
+
+
+def read_dist(filename: str) -> bytes:
+    with open(os.path.join(ASSET_DIST_DIRECTORY, filename), "rb") as file:
+        return file.read()
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, encoding, extension",
+    [
+        ("gzip, deflate, br", "br", ".br"),
+        ("br;q=0, gzip", "gzip", ".gz"),
+        ("gzip", "gzip", ".gz"),
+        ("", None, ""),
+    ],
+)
+def test_asset_picks_precompressed_variant(client, app, accept_encoding, encoding, extension):
+    response = client.get(f"/assets/{CSS_FILENAME}", headers={"Accept-Encoding": accept_encoding})
+    assert response.status_code == 200
+    assert response.headers.get("Content-Encoding") == encoding
+    assert response.get_data() == read_dist(CSS_FILENAME + extension)
+    assert response.mimetype == "text/css"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    # ファイル名に内容のハッシュが付いているので、確認せずに使わせる
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age == app.config["ASSET_MAX_AGE"]
+
+
+def test_asset_without_compressed_variant_and_unknown_files(client):
+    font_filename = next(filename for filename, encoding_list in MANIFEST["files"].items() if not encoding_list)
+    response = client.get(f"/assets/{font_filename}", headers={"Accept-Encoding": "br, gzip"})
+    assert response.status_code == 200
+    assert "Content-Encoding" not in response.headers
+    assert response.get_data() == read_dist(font_filename)
+    # manifestにないファイルは返さない
+    assert client.get("/assets/manifest.json").status_code == 404
+    assert client.get("/assets/app.css").status_code == 404
+
+
+def test_asset_url_and_conditional_request(client):
+    assert f"/assets/{CSS_FILENAME}" in client.get("/").get_data(as_text=True)
+    response = client.get(f"/assets/{CSS_FILENAME}", headers={"Accept-Encoding": "gzip"})
+    response = client.get(
+        f"/assets/{CSS_FILENAME}",
+        headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]},
+    )
+    assert response.status_code == 304
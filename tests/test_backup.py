@@ -0,0 +1,108 @@
+import os
+import shutil
+import sqlite3
+
+import pytest
+
+from backup import BackupError, backup_database, list_backups, restore_backup, verify_backup
+from conftest import add_service, make_item
+from operations import register_item
+
+
+def get_row_counts(path) -> tuple[int, int]:
+    con = sqlite3.connect(path)
+    try:
+        return tuple(con.execute("select (select count(*) from service), (select count(*) from item)").fetchone())
+    finally:
+        con.close()
+
+
+def add_items(db):
+    add_service(db, "2024-06", "食費")
+    with db:
+        for item_name, item_price in [("牛乳", 200), ("パン", 300), ("卵", 400)]:
+            assert register_item(db, make_item("2024-06-01", "食費", item_name, item_price)) == ""
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_backup_and_restore(db, database_path, tmp_path, compress):
+    add_items(db)
+    result = backup_database(database_path, str(tmp_path / "backups"), compress=compress)
+    assert result["path"].endswith(".db.gz" if compress else ".db")
+    assert list_backups(str(tmp_path / "backups")) == [result["path"]]
+    assert verify_backup(result["path"]) == []
+
+    restored_path = str(tmp_path / "restored.db")
+    restore_backup(result["path"], restored_path)
+    assert get_row_counts(restored_path) == get_row_counts(database_path) == (1, 3)
+
+
+def test_backup_copies_archives(database_path, tmp_path):
+    # 締めた月のアーカイブ（<DB>.archive/YYYY.db）もスナップショットの隣にコピーし、書き戻す
+    os.makedirs(database_path + ".archive")
+    con = sqlite3.connect(database_path + ".archive/2023.db")
+    with con:
+        con.execute("create table item (item_id integer primary key)")
+        con.execute("insert into item (item_id) values (1)")
+    con.close()
+    result = backup_database(database_path, str(tmp_path / "backups"), compress=True)
+    assert result["archives"] == 1
+
+    restored_path = str(tmp_path / "restored.db")
+    assert restore_backup(result["path"], restored_path)["archives"] == 1
+    con = sqlite3.connect(restored_path + ".archive/2023.db")
+    assert con.execute("select count(*) from item").fetchone()[0] == 1
+    con.close()
+
+
+def test_old_backups_are_removed(database_path, tmp_path):
+    directory = tmp_path / "backups"
+    directory.mkdir()
+    for name in ["20240101-000000.db", "20240102-000000.db.gz", "20240103-000000.db"]:
+        shutil.copy(database_path, directory / name)
+    os.makedirs(directory / "20240101-000000.db.archive")
+    # スナップショットではないファイルは数えず、消さない
+    (directory / "memo.txt").write_text("")
+    result = backup_database(database_path, str(directory), compress=False, retention=2)
+    assert result["removed"] == [str(directory / "20240101-000000.db"), str(directory / "20240102-000000.db.gz")]
+    assert list_backups(str(directory)) == [str(directory / "20240103-000000.db"), result["path"]]
+    assert not (directory / "20240101-000000.db.archive").exists()
+    assert (directory / "memo.txt").exists()
+
+
+def test_corrupted_backup_is_refused(db, database_path, tmp_path):
+    add_items(db)
+    result = backup_database(database_path, str(tmp_path / "backups"), compress=False)
+    with open(result["path"], "r+b") as file:
+        file.seek(100)
+        file.write(b"\xff" * 4096)
+    assert verify_backup(result["path"]) != []
+
+    restored_path = str(tmp_path / "restored.db")
+    with pytest.raises(BackupError):
+        restore_backup(result["path"], restored_path)
+    assert not os.path.exists(restored_path)
+
+    # 途中で切れたgzipも書き戻さない
+    result = backup_database(database_path, str(tmp_path / "compressed"), compress=True)
+    with open(result["path"], "r+b") as file:
+        file.truncate(os.path.getsize(result["path"]) // 2)
+    with pytest.raises(BackupError):
+        restore_backup(result["path"], restored_path)
+    assert not os.path.exists(restored_path)
+
+
+def test_restore_clears_stale_archives_and_snapshot(db, database_path, tmp_path):
+    add_items(db)
+    result = backup_database(database_path, str(tmp_path / "backups"), compress=False)
+    # バックアップを取った後に締めた年のアーカイブと、集計用のスナップショットがある先に書き戻す
+    restored_path = str(tmp_path / "restored.db")
+    shutil.copy(database_path, restored_path)
+    os.makedirs(restored_path + ".archive")
+    shutil.copy(database_path, restored_path + ".archive/2023.db")
+    with open(restored_path + ".snapshot", "wb") as file:
+        file.write(b"stale")
+    restore_backup(result["path"], restored_path)
+    assert not os.path.exists(restored_path + ".archive/2023.db")
+    assert not os.path.exists(restored_path + ".snapshot")
+    assert get_row_counts(restored_path) == (1, 3)
@@ -0,0 +1,86 @@
+from conftest import add_service, make_item
+from cube import verify_spending_cube
+from operations import register_item
+from rollup import get_month_service_totals, verify_day_totals, verify_month_service_totals
+from search import search_items
+
+
+def get_item_id(db, service_name, item_name) -> int:
+    return db.execute(
+        "select item_id from item where service_name = ? and item_name = ?", [service_name, item_name]
+    ).fetchone()[0]
+
+
+def assert_rollups_in_sync(db):
+    assert verify_month_service_totals(db) == []
+    assert verify_day_totals(db) == []
+    assert verify_spending_cube(db) == []
+    # item_searchの索引がitemと食い違っていればエラーになる
+    with db:
+        db.execute("insert into item_search(item_search, rank) values ('integrity-check', 1)")
+
+
+def add_ledger(db):
+    add_service(db, "2024-06", "食費")
+    add_service(db, "2024-06", "日用品")
+    with db:
+        assert register_item(db, make_item("2024-06-01", "食費", "牛乳パック", 200)) == ""
+        assert register_item(db, make_item("2024-06-02", "食費", "洗剤ボトル", 500, "妻")) == ""
+        assert register_item(db, make_item("2024-06-03", "日用品", "歯ブラシ", 300)) == ""
+
+
+def test_batch_move_keeps_rollups_and_search_in_sync(db, client):
+    add_ledger(db)
+    response = client.post(
+        "/api/v1/items/batch",
+        json={"action": "move", "item_ids": [get_item_id(db, "食費", "洗剤ボトル")], "service_name": "日用品"},
+    )
+    assert response.status_code == 200
+    assert get_month_service_totals(db, "2024-06") == {"食費": 200, "日用品": 800}
+    assert [item["item_name"] for item in search_items(db, "洗剤ボトル", service_name="日用品")[0]] == ["洗剤ボトル"]
+    assert_rollups_in_sync(db)
+
+
+def test_batch_delete_keeps_rollups_and_search_in_sync(db, client):
+    add_ledger(db)
+    response = client.post(
+        "/api/v1/items/batch",
+        json={"action": "delete", "item_ids": [get_item_id(db, "食費", "牛乳パック"), get_item_id(db, "日用品", "歯ブラシ")]},
+    )
+    assert response.get_json() == {"action": "delete", "item_count": 2}
+    assert get_month_service_totals(db, "2024-06") == {"食費": 500}
+    assert search_items(db, "牛乳パック")[0] == []
+    assert_rollups_in_sync(db)
+
+
+def test_rename_service_keeps_rollups_and_search_in_sync(db, client):
+    add_ledger(db)
+    response = client.post("/api/v1/services/食費/rename", json={"service_name": "食料品費"})
+    assert response.status_code == 200
+    assert get_month_service_totals(db, "2024-06") == {"食料品費": 700, "日用品": 300}
+    # 固定費名でも検索できる
+    assert sorted(item["item_name"] for item in search_items(db, "食料品費")[0]) == ["洗剤ボトル", "牛乳パック"]
+    assert_rollups_in_sync(db)
+
+    response = client.post("/api/v1/services/食料品費/rename", json={"service_name": "日用品"})
+    assert response.status_code == 409
+
+
+def test_move_with_name_collision_rolls_back_whole_batch(db, client):
+    add_ledger(db)
+    with db:
+        assert register_item(db, make_item("2024-06-04", "日用品", "牛乳パック", 250)) == ""
+    before = db.execute("select item_id, service_name from item order by item_id").fetchall()
+    # 2件目が変更先の固定費の「牛乳パック」とぶつかるので、1件目も動かない
+    response = client.post(
+        "/api/v1/items/batch",
+        json={
+            "action": "move",
+            "item_ids": [get_item_id(db, "食費", "洗剤ボトル"), get_item_id(db, "食費", "牛乳パック")],
+            "service_name": "日用品",
+        },
+    )
+    assert response.status_code == 409
+    assert db.execute("select item_id, service_name from item order by item_id").fetchall() == before
+    assert get_month_service_totals(db, "2024-06") == {"食費": 700, "日用品": 550}
+    assert_rollups_in_sync(db)
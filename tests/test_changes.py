@@ -0,0 +1,93 @@
+import pytest
+
+from changes import ChangeLogExpiredError, compact_change_log, get_changes
+from conftest import add_service, make_item
+from operations import delete_item, register_item, update_item
+
+
+def get_item_id(db, service_name, item_name) -> int:
+    return db.execute(
+        "select item_id from item where service_name = ? and item_name = ?", [service_name, item_name]
+    ).fetchone()[0]
+
+
+def test_get_changes_pages_and_keeps_latest_change_per_row(db):
+    add_service(db, "2024-06", "食費")
+    with db:
+        for item_name, item_price in [("牛乳", 200), ("パン", 300), ("卵", 400)]:
+            assert register_item(db, make_item("2024-06-01", "食費", item_name, item_price)) == ""
+    change_list, version, has_more = get_changes(db, 0, 3)
+    assert [change["entity"] for change in change_list] == ["service", "item", "item"]
+    assert has_more
+    change_list, version, has_more = get_changes(db, version, 3)
+    assert [change["data"]["item_name"] for change in change_list] == ["卵"]
+    assert not has_more
+
+    # sinceより後に変わった行だけを、今の内容で受け取る（1行につき最新の変更だけ）
+    with db:
+        assert update_item(db, get_item_id(db, "食費", "牛乳"), make_item("2024-06-01", "食費", "牛乳", 250)) == ""
+        assert update_item(db, get_item_id(db, "食費", "牛乳"), make_item("2024-06-01", "食費", "牛乳", 260)) == ""
+    change_list, _, _ = get_changes(db, version, 10)
+    assert [(change["operation"], change["data"]["item_price"]) for change in change_list] == [("upsert", 260)]
+
+
+def test_tombstone_and_compaction(db, client):
+    add_service(db, "2024-06", "食費")
+    with db:
+        assert register_item(db, make_item("2024-06-01", "食費", "牛乳", 200)) == ""
+    item_id = get_item_id(db, "食費", "牛乳")
+    _, since, _ = get_changes(db, 0, 10)
+    with db:
+        delete_item(db, item_id)
+    change_list, _, _ = get_changes(db, since, 10)
+    assert change_list == [{"version": since + 1, "entity": "item", "id": item_id, "operation": "delete"}]
+
+    # 保存期間が過ぎたトゥームストーンを消すと、それより前のsinceは410になる
+    assert compact_change_log(db) == 0
+    with db:
+        db.execute("update change_log set changed_at = datetime('now', '-100 days') where operation = 'delete'")
+    assert compact_change_log(db) == 1
+    with pytest.raises(ChangeLogExpiredError):
+        get_changes(db, since, 10)
+    assert client.get(f"/api/v1/changes?since={since}").status_code == 410
+    response = client.get("/api/v1/changes?since=0")
+    assert response.status_code == 200
+    assert "item" not in [change["entity"] for change in response.get_json()["changes"]]
+
+
+def test_upload_changes_returns_error_per_change(db, client):
+    add_service(db, "2024-06", "食費")
+    response = client.post(
+        "/api/v1/changes",
+        json={
+            "changes": [
+                {"entity": "item", "operation": "upsert", "id": None, "data": make_item("2024-06-01", "食費", "牛乳", 200)},
+                {"entity": "item", "operation": "upsert", "id": None, "data": make_item("2024-06-01", "日用品", "洗剤", 500)},
+                {"entity": "item", "operation": "delete", "id": 9999},
+            ]
+        },
+    )
+    assert response.status_code == 200
+    result_list = response.get_json()["results"]
+    assert result_list[0] == {"id": get_item_id(db, "食費", "牛乳"), "error": ""}
+    assert result_list[1]["id"] is None and result_list[1]["error"]
+    assert result_list[2] == {"id": 9999, "error": "商品が見つかりません"}
+
+
+def test_upload_changes_treats_null_as_missing(db, client):
+    add_service(db, "2024-06", "食費")
+    item = make_item("2024-06-01", "食費", "牛乳", 200)
+    response = client.post(
+        "/api/v1/changes",
+        json={"changes": [{"entity": "item", "operation": "upsert", "id": None, "data": {**item, "item_attribute": None}}]},
+    )
+    assert response.status_code == 400
+    assert "全て入力してください" in response.get_json()["error"]
+
+    response = client.post(
+        "/api/v1/changes",
+        json={"changes": [{"entity": "item", "operation": "upsert", "id": None, "data": {**item, "item_price": [200]}}]},
+    )
+    assert response.status_code == 400
+    assert "item_priceは文字列か数値で指定してください" in response.get_json()["error"]
+    assert db.execute("select count(*) from item").fetchone()[0] == 0
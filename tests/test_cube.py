@@ -0,0 +1,71 @@
+import io
+
+from archive import archive_month
+from conftest import add_service, make_item
+from cube import ALL, get_spending_cube, rebuild_spending_cube, verify_spending_cube
+from importer import import_items, iter_csv_rows
+from operations import delete_item, delete_items, move_items_to_service, register_item, update_item
+
+
+def get_item_id(db, service_name, item_name) -> int:
+    return db.execute(
+        "select item_id from item where service_name = ? and item_name = ?", [service_name, item_name]
+    ).fetchone()[0]
+
+
+def get_usage(db, year_month=ALL, service_name=ALL, item_attribute=ALL) -> int:
+    row_list = get_spending_cube(db, year_month, service_name, item_attribute)
+    return row_list[0]["total_usage"] if row_list else 0
+
+
+def test_cube_stays_in_sync_with_items(db):
+    add_service(db, "2024-06", "食費")
+    add_service(db, "2024-06", "日用品")
+    add_service(db, "2024-07", "食費")
+    with db:
+        assert register_item(db, make_item("2024-06-01", "食費", "牛乳", 200)) == ""
+        assert register_item(db, make_item("2024-06-02", "食費", "パン", 300, "妻")) == ""
+        assert register_item(db, make_item("2024-06-03", "日用品", "洗剤", 500)) == ""
+    assert verify_spending_cube(db) == []
+    assert get_usage(db, "2024-06", ALL, "妻") == 300
+
+    # 月・購入者が変わる編集
+    with db:
+        assert update_item(db, get_item_id(db, "食費", "パン"), make_item("2024-07-01", "食費", "パン", 350)) == ""
+    assert verify_spending_cube(db) == []
+    assert get_usage(db, "2024-06", ALL, "妻") == 0
+    assert get_usage(db, "2024-07", "食費", "夫") == 350
+
+    with db:
+        assert move_items_to_service(db, [get_item_id(db, "食費", "牛乳")], "日用品") == ""
+    assert verify_spending_cube(db) == []
+    assert get_usage(db, "2024-06", "日用品") == 700
+
+    result = import_items(
+        db,
+        iter_csv_rows(io.StringIO("購入日,固定費,商品名,値段,購入者\n2024-06-10,食費,卵,250,妻\n2024-07-02,食費,米,2000,夫\n")),
+    )
+    assert result["inserted"] == 2
+    assert verify_spending_cube(db) == []
+
+    with db:
+        delete_item(db, get_item_id(db, "日用品", "洗剤"))
+        assert delete_items(db, [get_item_id(db, "食費", "卵"), get_item_id(db, "食費", "米")]) == 2
+    assert verify_spending_cube(db) == []
+    assert get_usage(db) == 550
+
+    # 締めた月の行はそのまま残り、ずれとは数えない
+    archive_month(db, "2024-06")
+    assert verify_spending_cube(db) == []
+    assert get_usage(db, "2024-06") == 200
+
+
+def test_rebuild_spending_cube_repairs_drift(db):
+    add_service(db, "2024-06", "食費")
+    with db:
+        assert register_item(db, make_item("2024-06-01", "食費", "牛乳", 200)) == ""
+        db.execute("update spending_cube set total_usage = total_usage + 1 where service_name = '食費'")
+    assert verify_spending_cube(db) != []
+    assert rebuild_spending_cube(db) != []
+    assert verify_spending_cube(db) == []
+    assert get_usage(db, "2024-06", "食費") == 200
@@ -0,0 +1,95 @@
+import queue
+import threading
+
+import pytest
+
+from app import create_app
+from conftest import add_service, connect, make_item
+from events import LiveEventHub, LiveEventLimitError
+from households import HouseholdRouter, create_household
+from operations import register_item
+
+
+def register_items(db, item_name_list):
+    with db:
+        for item_name in item_name_list:
+            assert register_item(db, make_item("2024-06-01", "食費", item_name, 100)) == ""
+
+
+def get_messages(subscription, count) -> list[bytes]:
+    return [subscription.get(5) for _ in range(count)]
+
+
+def test_reconnect_replays_missed_events(db, database_path):
+    add_service(db, "2024-06", "食費")
+    register_items(db, ["牛乳", "パン", "卵"])
+    hub = LiveEventHub(lambda: connect(database_path), threading.BoundedSemaphore(4), poll_interval=0.01, replay_size=2)
+    try:
+        # Last-Event-IDより後の、送り直せるイベントだけを受け取る
+        subscription = hub.subscribe("1")
+        assert [message.split(b"\n")[0] for message in get_messages(subscription, 2)] == [b"id: 2", b"id: 3"]
+        # 送り直せるイベントより前で途切れていれば、画面を読み込み直させる
+        assert hub.subscribe("0").get(1).startswith(b"event: reload")
+        # 初めての接続には送り直さず、この後のイベントだけを送る
+        new_subscription = hub.subscribe("")
+        with pytest.raises(queue.Empty):
+            new_subscription.get(0.05)
+        register_items(db, ["米"])
+        assert get_messages(new_subscription, 1)[0].startswith(b"id: 4\nevent: item_added\n")
+        assert get_messages(subscription, 1)[0].startswith(b"id: 4\n")
+    finally:
+        hub.close()
+    assert subscription.get(1) is None
+
+
+def test_disconnect_releases_slot_and_full_returns_503(database_path, tmp_path):
+    app = create_app(
+        {
+            "DATABASE": database_path,
+            "HOUSEHOLD_DATABASE_DIRECTORY": str(tmp_path / "households"),
+            "TESTING": True,
+            "LIVE_EVENT_MAX_CONNECTIONS": 1,
+        }
+    )
+    client = app.test_client()
+    try:
+        response = client.get("/events")
+        assert response.status_code == 200
+        assert next(iter(response.response)).startswith(b"retry: ")
+        # 接続の数が上限に達していれば503で、繋ぎ直すまでの秒数を返す
+        full_response = client.get("/events")
+        assert full_response.status_code == 503
+        assert full_response.headers["Retry-After"] == str(app.config["LIVE_EVENT_STREAM_MAX_AGE"])
+        # クライアントが切断すると（ストリームを閉じると）枠が空く
+        response.close()
+        assert app.extensions["kakeibo"]["router"].get_events("").stats()["subscribers"] == 0
+        response = client.get("/events")
+        assert response.status_code == 200
+        response.close()
+    finally:
+        app.extensions["kakeibo"]["router"].close()
+
+
+def test_hub_thread_stops_when_household_is_evicted(database_path, tmp_path):
+    directory = str(tmp_path / "households")
+    create_household("first", directory)
+    create_household("second", directory)
+    router = HouseholdRouter(connect, database_path, directory, max_households=1, max_live_event_connections=2)
+    try:
+        hub = router.get_events("first")
+        subscription = hub.subscribe()
+        thread = hub._thread
+        assert thread.is_alive()
+        # 別の世帯を開くと最も長く使われていない世帯が閉じられ、スレッドが止まり、接続も閉じられる
+        router.get_household("second")
+        assert not thread.is_alive()
+        assert subscription.get(1) is None
+        # 閉じた世帯ではスレッドを起動し直さず、枠も使わない
+        with pytest.raises(LiveEventLimitError):
+            hub.subscribe()
+        assert hub._thread is thread
+        hub.unsubscribe(subscription)
+        assert router.live_event_slots.acquire(blocking=False)
+        assert router.live_event_slots.acquire(blocking=False)
+    finally:
+        router.close()
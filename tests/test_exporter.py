@@ -0,0 +1,85 @@
+import csv
+import gzip
+import io
+import json
+
+from archive import archive_month
+from conftest import add_service, make_item
+from exporter import ITEM_EXPORT_COLUMN_LIST, iter_csv, iter_json, iter_item_rows
+from operations import register_item
+
+
+def add_ledger(db) -> list[tuple]:
+    # 2024-01を締めた家計簿を作り、締める前の商品を書き出しの順（購入日, item_id）で返す
+    add_service(db, "2024-01", "食費", 30000)
+    add_service(db, "2024-06", "食費", 30000)
+    add_service(db, "2024-06", "日用品", 5000)
+    with db:
+        assert register_item(db, make_item("2024-01-20", "食費", "パン", 300)) == ""
+        assert register_item(db, make_item("2024-01-05", "食費", "牛乳", 200, "妻")) == ""
+        assert register_item(db, make_item("2024-06-01", "日用品", '洗剤 "詰め替え", 大', 500)) == ""
+        assert register_item(db, make_item("2024-06-01", "食費", "卵\n10個", 250)) == ""
+    row_list = [
+        tuple(row)
+        for row in db.execute(
+            "select {} from item order by purchase_date, item_id".format(", ".join(ITEM_EXPORT_COLUMN_LIST))
+        )
+    ]
+    archive_month(db, "2024-01")
+    return row_list
+
+
+def read_csv(text: str) -> list[tuple]:
+    assert text.startswith("﻿")
+    row_list = list(csv.reader(io.StringIO(text[1:])))
+    assert row_list[0] == ITEM_EXPORT_COLUMN_LIST
+    return [tuple(row) for row in row_list[1:]]
+
+
+def as_text_rows(row_list) -> list[tuple]:
+    return [tuple(str(value) for value in row) for row in row_list]
+
+
+def test_export_items_matches_database(db, client):
+    row_list = add_ledger(db)
+    response = client.get("/export/items.csv")
+    assert response.status_code == 200
+    assert response.headers["Content-Disposition"] == "attachment; filename*=UTF-8''items.csv"
+    assert read_csv(response.get_data(as_text=True)) == as_text_rows(row_list)
+
+    response = client.get("/export/items.json")
+    assert response.get_json() == [dict(zip(ITEM_EXPORT_COLUMN_LIST, row)) for row in row_list]
+
+    # 締めた月だけ・固定費だけに絞り込める
+    response = client.get("/export/items.csv?month=2024-01")
+    assert read_csv(response.get_data(as_text=True)) == as_text_rows(row_list[:2])
+    response = client.get("/export/items.json?month=2024-06&service=日用品")
+    assert [item["item_name"] for item in response.get_json()] == ['洗剤 "詰め替え", 大']
+    assert client.get("/export/items.xml").status_code == 404
+
+
+def test_export_is_gzipped_when_accepted(db, client):
+    add_ledger(db)
+    plain = client.get("/export/items.csv").get_data()
+    response = client.get("/export/items.csv", headers={"Accept-Encoding": "gzip, deflate"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert gzip.decompress(response.get_data()) == plain
+
+    response = client.get("/export/history.json", headers={"Accept-Encoding": "gzip"})
+    history = json.loads(gzip.decompress(response.get_data()))
+    # 締めた月の上限金額・使用額も書き出す（今月は最初のリクエストで固定費がコピーされるので比べない）
+    assert [row for row in history if row["year_month"] <= "2024-06"] == [
+        {"year_month": "2024-01", "total_upper_limit": 30000, "total_usage": 500},
+        {"year_month": "2024-06", "total_upper_limit": 35000, "total_usage": 750},
+    ]
+
+
+def test_streaming_writers_split_rows_into_chunks(db):
+    row_list = add_ledger(db)
+    # 少ない件数ずつ書き出しても、つなげれば同じ内容になる
+    chunk_list = list(iter_csv(ITEM_EXPORT_COLUMN_LIST, iter_item_rows(db), batch_size=1))
+    assert len(chunk_list) == len(row_list) + 2
+    assert read_csv("".join(chunk_list)) == as_text_rows(row_list)
+    chunk_list = list(iter_json(ITEM_EXPORT_COLUMN_LIST, iter_item_rows(db), batch_size=1))
+    assert json.loads("".join(chunk_list)) == [dict(zip(ITEM_EXPORT_COLUMN_LIST, row)) for row in row_list]
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+from conftest import connect
+from households import HouseholdRouter, create_household
+
+
+@pytest.fixture
+def router(database_path, tmp_path):
+    directory = str(tmp_path / "households")
+    for household_id in ["first", "second", "third"]:
+        create_household(household_id, directory)
+    router = HouseholdRouter(connect, database_path, directory, max_households=2)
+    yield router
+    router.close()
+
+
+def insert_note(db, text):
+    db.execute("create table if not exists note(text text not null)")
+    db.execute("insert into note (text) values (?)", [text])
+    return text
+
+
+def test_least_recently_used_household_is_evicted_and_closed(router):
+    first = router.get_household("first")
+    second = router.get_household("second")
+    assert router.get_household("first") is first
+    # 「first」の方が最近使われたので、「second」が閉じられる
+    third = router.get_household("third")
+    assert router.stats()["evicted"] == 1
+    assert router.get_household("first") is first
+    assert router.get_household("third") is third
+    with pytest.raises(RuntimeError):
+        second.writer.submit(insert_note, "a")
+    # 閉じた世帯をもう一度使うと、新しく開き直す
+    assert router.get_household("second") is not second
+    assert router.get_writer("second").submit(insert_note, "b") == "b"
+    assert router.stats()["opened"] == 4
+
+
+def test_request_in_flight_finishes_when_household_is_evicted(router):
+    # 書き込みの途中で世帯が追い出されても、その書き込みは最後まで実行されてコミットされる
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_insert(db):
+        started.set()
+        release.wait(5)
+        return insert_note(db, "in flight")
+
+    writer = router.get_writer("first")
+    router.get_household("second")
+    result_list = []
+    request_thread = threading.Thread(target=lambda: result_list.append(writer.submit(slow_insert)))
+    request_thread.start()
+    assert started.wait(5)
+    evicting_thread = threading.Thread(target=router.get_household, args=("third",))
+    evicting_thread.start()
+    # 追い出す側が書き込み用のスレッドの停止を待ち始めてから、書き込みを終わらせる
+    while router.stats()["evicted"] == 0:
+        time.sleep(0.01)
+    release.set()
+    request_thread.join(5)
+    evicting_thread.join(5)
+    assert not request_thread.is_alive() and not evicting_thread.is_alive()
+    assert result_list == ["in flight"]
+    with pytest.raises(RuntimeError):
+        writer.submit(insert_note, "after close")
+    db = router.get_pool("first").acquire()
+    try:
+        assert [row[0] for row in db.execute("select text from note")] == ["in flight"]
+    finally:
+        router.get_pool("first").release(db)
+
+
+def test_unknown_or_invalid_household_returns_404(client, app):
+    create_household("known", app.config["HOUSEHOLD_DATABASE_DIRECTORY"])
+    assert client.get("/", headers={"X-Household": "known"}).status_code == 200
+    for household_id in ["unknown", "../kakeibo", "Known", "a" * 65]:
+        response = client.get("/", headers={"X-Household": household_id})
+        assert response.status_code == 404, household_id
+    assert "unknown" not in app.extensions["kakeibo"]["router"].stats()["pools"]
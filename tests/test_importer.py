@@ -0,0 +1,96 @@
+import io
+
+import pytest
+
+from conftest import add_service, connect, make_item
+from importer import ImportFormatError, import_items, iter_csv_rows
+from operations import register_item
+from rollup import get_month_service_totals, verify_month_service_totals
+
+CSV_HEADER = "購入日,固定費,商品名,値段,購入者\n"
+
+
+def read_csv(text: str):
+    return iter_csv_rows(io.StringIO(CSV_HEADER + text))
+
+
+def test_import_items_registers_valid_rows_and_reports_errors(db):
+    add_service(db, "2024-06", "食費")
+    with db:
+        register_item(db, make_item("2024-06-01", "食費", "牛乳", 200))
+    result = import_items(
+        db,
+        read_csv(
+            "2024/06/02,食費,パン,\"1,200\",妻\n"
+            "2024-06-03,食費,牛乳,300,夫\n"
+            "2024-06-04,日用品,洗剤,500,夫\n"
+            "2024-06-05,食費,卵,abc,夫\n"
+            "2024-06-06,食費,パン,100,夫\n"
+            ",,,,\n"
+        ),
+    )
+    assert result["inserted"] == 1
+    assert [(error["row"], error["message"]) for error in result["errors"]] == [
+        (3, "同じ名前の商品が食費で既に購入されています"),
+        (4, "2024-06に固定費日用品が登録されていません"),
+        (5, "値段が数値ではありません：abc"),
+        (6, "同じ名前の商品が食費で既に購入されています"),
+    ]
+    assert tuple(db.execute("select purchase_date, item_price from item where item_name = 'パン'").fetchone()) == (
+        "2024-06-02",
+        1200,
+    )
+    assert get_month_service_totals(db, "2024-06") == {"食費": 1400}
+    assert verify_month_service_totals(db) == []
+
+
+def test_import_items_rejects_missing_header(db):
+    with pytest.raises(ImportFormatError):
+        import_items(db, iter_csv_rows(io.StringIO("購入日,商品名\n2024-06-01,牛乳\n")))
+
+
+def post_csv(client, text: str):
+    return client.post(
+        "/item_import",
+        data={"file": (io.BytesIO((CSV_HEADER + text).encode("utf-8")), "items.csv")},
+    )
+
+
+def test_import_route_registers_rows_through_writer(client, db):
+    add_service(db, "2024-06", "食費")
+    response = post_csv(client, "2024-06-01,食費,牛乳,200,夫\n")
+    assert response.status_code == 200
+    assert db.execute("select count(*) from item").fetchone()[0] == 1
+
+
+def test_import_route_reports_conflicting_insert(client, db, monkeypatch):
+    # 検証の後で同じ名前の商品が登録されていた場合（一意インデックスの違反）は、何も登録せずにメッセージを出す
+    add_service(db, "2024-06", "食費")
+    db.execute(
+        "insert into item (purchase_date, service_name, item_name, item_price, item_attribute) "
+        "values ('2024-06-01', '食費', '牛乳', 200, '夫')"
+    )
+    db.commit()
+    monkeypatch.setattr("importer._find_existing_items", lambda db, item_list: set())
+    response = post_csv(client, "2024-06-02,食費,パン,300,夫\n2024-06-03,食費,牛乳,300,夫\n")
+    assert response.status_code == 200
+    assert "もう一度取り込んでください" in response.get_data(as_text=True)
+    assert db.execute("select count(*) from item").fetchone()[0] == 1
+
+
+def test_import_route_reports_locked_database(client, db, database_path, monkeypatch):
+    # 他の接続が書き込みのロックを持ったままなら、500にせずメッセージを出す
+    add_service(db, "2024-06", "食費")
+    # 書き込み用の接続は最初の書き込み（月の初めの固定費のコピー）で開くので、その前に待ち時間を短くしておく
+    monkeypatch.setattr("database.DATABASE_BUSY_TIMEOUT_MS", 50)
+    client.get("/")
+    other = connect(database_path)
+    other.execute("begin immediate")
+    try:
+        response = post_csv(client, "2024-06-01,食費,牛乳,200,夫\n")
+    finally:
+        other.rollback()
+        other.close()
+    assert response.status_code == 200
+    assert "他の書き込みが終わらなかった" in response.get_data(as_text=True)
+    assert db.execute("select count(*) from item").fetchone()[0] == 0
@@ -0,0 +1,32 @@
+from conftest import add_service, make_item
+from operations import register_item
+from page_cache import CachedPage, PageCache, get_month_version
+
+
+def test_page_cache_returns_page_only_for_same_version():
+    page_cache = PageCache(max_entries=2, max_bytes=1024)
+    page_cache.put("a", CachedPage(1, "etag", b"body", "text/html"))
+    assert page_cache.get("a", 1).body == b"body"
+    assert page_cache.get("a", 2) is None
+    # 件数の上限を超えたら、最も長く使われていないものから消す
+    page_cache.put("b", CachedPage(1, "etag", b"b", "text/html"))
+    page_cache.put("c", CachedPage(1, "etag", b"c", "text/html"))
+    assert page_cache.get("a", 1) is None
+    assert page_cache.stats()["entries"] == 2
+
+
+def test_top_page_is_not_reused_across_month_boundary(client, db, monkeypatch):
+    # 10月に保存したトップ画面を、版数が同じになった11月に返さない
+    monkeypatch.setattr("app.get_current_yyyymm", lambda: "2024-10")
+    add_service(db, "2024-10", "食費")
+    with db:
+        register_item(db, make_item("2024-10-01", "食費", "牛乳", 200))
+    assert get_month_version(db, "2024-10") == 1
+    assert "2024年10月" in client.get("/").get_data(as_text=True)
+
+    monkeypatch.setattr("app.get_current_yyyymm", lambda: "2024-11")
+    body = client.get("/").get_data(as_text=True)
+    # 11月の最初のリクエストで固定費がコピーされ、11月の版数も1になっている
+    assert get_month_version(db, "2024-11") == 1
+    assert "2024年11月" in body
+    assert "2024年10月" not in body
@@ -0,0 +1,17 @@
+from conftest import add_service, make_item
+from operations import register_item
+from util import get_current_yyyymm
+
+
+def test_pages_show_services_with_zero_upper_limit(client, db):
+    # 上限金額が0の固定費だけの月でも、使用率を「-」にして表示する
+    yyyymm = get_current_yyyymm()
+    add_service(db, yyyymm, "食費", 0)
+    with db:
+        register_item(db, make_item(f"{yyyymm}-01", "食費", "牛乳", 200))
+    response = client.get("/")
+    assert response.status_code == 200
+    assert "200円 / 0円" in response.get_data(as_text=True)
+    response = client.get(f"/食費/{yyyymm}/item_detail")
+    assert response.status_code == 200
+    assert "牛乳" in response.get_data(as_text=True)
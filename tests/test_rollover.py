@@ -0,0 +1,43 @@
+import threading
+
+from conftest import add_service
+
+
+def get_services(db, year_month) -> list[tuple]:
+    return [
+        tuple(row)
+        for row in db.execute(
+            "select service_name, upper_limit from service where year_month = ? order by service_id", [year_month]
+        )
+    ]
+
+
+def test_new_month_copies_each_service_once(db, client, monkeypatch):
+    add_service(db, "2024-06", "食費", 30000)
+    add_service(db, "2024-06", "日用品", 5000)
+    monkeypatch.setattr("app.get_current_yyyymm", lambda: "2024-07")
+    # 新しい月の最初のリクエストが同時に来ても、固定費は1回だけコピーされる
+    status_list = []
+    thread_list = [threading.Thread(target=lambda: status_list.append(client.get("/").status_code)) for _ in range(4)]
+    for thread in thread_list:
+        thread.start()
+    for thread in thread_list:
+        thread.join()
+    assert status_list == [200] * 4
+    assert client.get("/service_detail").status_code == 200
+    assert get_services(db, "2024-07") == [("食費", 30000), ("日用品", 5000)]
+
+    # 別のプロセス（覚えている月が違うワーカー）がもう一度コピーしても増えない
+    client.application.extensions["kakeibo"]["rolled_over_yyyymm"].clear()
+    assert client.get("/").status_code == 200
+    assert get_services(db, "2024-07") == [("食費", 30000), ("日用品", 5000)]
+
+
+def test_health_and_metrics_do_not_roll_over(db, client, monkeypatch):
+    add_service(db, "2024-06", "食費", 30000)
+    monkeypatch.setattr("app.get_current_yyyymm", lambda: "2024-07")
+    assert client.get("/health").status_code == 200
+    assert client.get("/metrics").status_code == 200
+    assert get_services(db, "2024-07") == []
+    assert client.get("/").status_code == 200
+    assert get_services(db, "2024-07") == [("食費", 30000)]
@@ -0,0 +1,66 @@
+from conftest import add_service, make_item
+from operations import delete_item, delete_items, register_item, update_item
+from rollup import (
+    get_month_service_totals,
+    rebuild_month_service_totals,
+    verify_day_totals,
+    verify_month_service_totals,
+)
+
+
+def get_item_id(db, service_name, item_name) -> int:
+    return db.execute(
+        "select item_id from item where service_name = ? and item_name = ?", [service_name, item_name]
+    ).fetchone()[0]
+
+
+def test_register_update_delete_keep_totals_in_sync(db):
+    add_service(db, "2024-06", "食費")
+    add_service(db, "2024-06", "日用品")
+    add_service(db, "2024-07", "食費")
+    with db:
+        assert register_item(db, make_item("2024-06-01", "食費", "牛乳", 200)) == ""
+        assert register_item(db, make_item("2024-06-02", "食費", "パン", 300)) == ""
+        assert register_item(db, make_item("2024-06-02", "日用品", "洗剤", 500)) == ""
+    assert get_month_service_totals(db, "2024-06") == {"食費": 500, "日用品": 500}
+
+    # 月と固定費が変わる編集では、元の集計から引いて新しい集計に足す
+    with db:
+        assert update_item(db, get_item_id(db, "食費", "パン"), make_item("2024-07-10", "食費", "パン", 350)) == ""
+    assert get_month_service_totals(db, "2024-06") == {"食費": 200, "日用品": 500}
+    assert get_month_service_totals(db, "2024-07") == {"食費": 350}
+
+    with db:
+        assert delete_item(db, get_item_id(db, "日用品", "洗剤")) == "2024-06-02"
+    assert get_month_service_totals(db, "2024-06") == {"食費": 200}
+    # 商品がなくなった日・月の行は消える
+    assert db.execute("select count(*) from day_totals where purchase_date = '2024-06-02'").fetchone()[0] == 0
+    assert verify_month_service_totals(db) == []
+    assert verify_day_totals(db) == []
+
+
+def test_batch_delete_keeps_totals_in_sync(db):
+    add_service(db, "2024-06", "食費")
+    with db:
+        for number in range(5):
+            register_item(db, make_item(f"2024-06-0{number + 1}", "食費", f"商品{number}", 100 * (number + 1)))
+    item_id_list = [get_item_id(db, "食費", f"商品{number}") for number in (0, 2, 4)]
+    with db:
+        assert delete_items(db, item_id_list) == 3
+    assert get_month_service_totals(db, "2024-06") == {"食費": 600}
+    assert verify_month_service_totals(db) == []
+    assert verify_day_totals(db) == []
+
+
+def test_rebuild_repairs_drift(db):
+    add_service(db, "2024-06", "食費")
+    with db:
+        register_item(db, make_item("2024-06-01", "食費", "牛乳", 200))
+        db.execute("update month_service_totals set total_usage = 999")
+    drift = verify_month_service_totals(db)
+    assert [(row["year_month"], row["expected_total_usage"], row["recorded_total_usage"]) for row in drift] == [
+        ("2024-06", 200, 999)
+    ]
+    assert rebuild_month_service_totals(db) == drift
+    assert verify_month_service_totals(db) == []
+    assert get_month_service_totals(db, "2024-06") == {"食費": 200}
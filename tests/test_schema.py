@@ -0,0 +1,89 @@
+import sqlite3
+
+import pytest
+
+from schema import (
+    INDEXED_QUERIES,
+    MIGRATIONS,
+    SCHEMA_VERSION,
+    check_query_plans,
+    explain_query_plan,
+    get_removed_duplicate_services,
+    get_renamed_duplicate_items,
+    get_schema_version,
+    migrate,
+)
+
+
+def create_version_1_database(path) -> sqlite3.Connection:
+    # マイグレーション1だけを適用した家計簿（インデックスがなく、重複した行も登録できる）
+    con = sqlite3.connect(path)
+    for statement in MIGRATIONS[0]:
+        con.execute(statement)
+    con.execute("pragma user_version = 1")
+    con.commit()
+    return con
+
+
+def test_migrate_creates_latest_schema(database_path):
+    con = sqlite3.connect(database_path)
+    assert get_schema_version(con) == SCHEMA_VERSION
+    # 2回目は何もしない
+    assert migrate(con) == SCHEMA_VERSION
+    con.close()
+
+
+def test_indexed_queries_do_not_scan_tables(db):
+    assert check_query_plans(db) == []
+    for statement, parameters in INDEXED_QUERIES:
+        plan = explain_query_plan(db, statement, parameters)
+        assert not any(detail.startswith(("SCAN item", "SCAN service")) for detail in plan), plan
+
+
+def test_migration_records_removed_duplicate_services(tmp_path):
+    con = create_version_1_database(tmp_path / "old.db")
+    con.executemany(
+        "insert into service (year_month, service_name, upper_limit) values (?, ?, ?)",
+        [("2024-06", "食費", 30000), ("2024-06", "食費", 50000), ("2024-06", "日用品", 5000)],
+    )
+    con.commit()
+    migrate(con)
+    assert con.execute("select service_id, upper_limit from service where service_name = '食費'").fetchall() == [(1, 30000)]
+    assert [tuple(row) for row in get_removed_duplicate_services(con)] == [(2, "2024-06", "食費", 50000)]
+    con.close()
+
+
+def test_migration_renames_duplicate_items_without_collision(tmp_path):
+    con = create_version_1_database(tmp_path / "old.db")
+    # 3番目の商品を「牛乳 (3)」にすると、既にある「牛乳 (3)」と重なる
+    con.executemany(
+        "insert into item (purchase_date, service_name, item_name, item_price, item_attribute) values (?, ?, ?, ?, ?)",
+        [
+            ("2024-06-01", "食費", "牛乳", 200, "夫"),
+            ("2024-06-02", "食費", "牛乳 (3)", 210, "妻"),
+            ("2024-06-03", "食費", "牛乳", 220, "夫"),
+            ("2024-06-04", "日用品", "牛乳", 230, "妻"),
+        ],
+    )
+    con.commit()
+    assert migrate(con) == SCHEMA_VERSION
+    assert con.execute("select item_id, item_name from item order by item_id").fetchall() == [
+        (1, "牛乳"),
+        (2, "牛乳 (3)"),
+        (3, "牛乳 (3-2)"),
+        (4, "牛乳"),
+    ]
+    assert [(row[0], row[1], row[2]) for row in get_renamed_duplicate_items(con)] == [(3, "牛乳", "牛乳 (3-2)")]
+    con.close()
+
+
+def test_failed_migration_is_rolled_back(tmp_path, monkeypatch):
+    con = create_version_1_database(tmp_path / "old.db")
+    broken_migrations = [MIGRATIONS[0], MIGRATIONS[1] + ["select * from no_such_table"]]
+    monkeypatch.setattr("schema.MIGRATIONS", broken_migrations)
+    monkeypatch.setattr("schema.SCHEMA_VERSION", len(broken_migrations))
+    with pytest.raises(sqlite3.OperationalError):
+        migrate(con)
+    assert get_schema_version(con) == 1
+    assert con.execute("select count(*) from sqlite_master where name = 'service_duplicate_removals'").fetchone()[0] == 0
+    con.close()
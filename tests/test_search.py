@@ -0,0 +1,78 @@
+from conftest import add_service, make_item
+from operations import delete_item, register_item, rename_service, update_item
+from search import get_item_name_suggestions, search_items
+
+
+def get_item_id(db, service_name, item_name) -> int:
+    return db.execute(
+        "select item_id from item where service_name = ? and item_name = ?", [service_name, item_name]
+    ).fetchone()[0]
+
+
+def get_found_names(db, query, **kwargs) -> list[str]:
+    return [item["item_name"] for item in search_items(db, query, **kwargs)[0]]
+
+
+def test_search_follows_register_update_rename_and_delete(db):
+    add_service(db, "2024-06", "食費")
+    add_service(db, "2024-06", "日用品")
+    with db:
+        assert register_item(db, make_item("2024-06-01", "食費", "牛乳パック", 200)) == ""
+    assert get_found_names(db, "乳パック") == ["牛乳パック"]
+
+    with db:
+        assert update_item(db, get_item_id(db, "食費", "牛乳パック"), make_item("2024-06-01", "食費", "豆乳パック", 250)) == ""
+    assert get_found_names(db, "牛乳パ") == []
+    assert get_found_names(db, "豆乳パ") == ["豆乳パック"]
+
+    # 固定費名でも引ける。固定費名を変えると新しい名前で引ける
+    assert get_found_names(db, "食費 豆乳パック") == ["豆乳パック"]
+    with db:
+        assert rename_service(db, "食費", "食料品費") == ""
+    assert get_found_names(db, "食料品費") == ["豆乳パック"]
+    assert get_found_names(db, "豆乳パック", service_name="食料品費") == ["豆乳パック"]
+
+    with db:
+        delete_item(db, get_item_id(db, "食料品費", "豆乳パック"))
+    assert get_found_names(db, "豆乳パック") == []
+
+
+def test_short_terms_use_like_fallback(db):
+    add_service(db, "2024-06", "食費")
+    with db:
+        assert register_item(db, make_item("2024-06-01", "食費", "牛乳パック", 200)) == ""
+        assert register_item(db, make_item("2024-06-02", "食費", "食パン", 150)) == ""
+        assert register_item(db, make_item("2024-06-03", "食費", "100%ジュース", 180)) == ""
+    # trigramの索引では引けない2文字以下の語も、部分一致で引ける（新しい順）
+    assert get_found_names(db, "パ") == ["食パン", "牛乳パック"]
+    assert get_found_names(db, "乳パ") == ["牛乳パック"]
+    # 長い語と短い語を混ぜるとANDになる
+    assert get_found_names(db, "牛乳パック 食") == ["牛乳パック"]
+    # LIKEの特殊文字はそのままの文字として扱う
+    assert get_found_names(db, "0%") == ["100%ジュース"]
+    assert get_found_names(db, "_") == []
+
+
+def test_autocomplete_counts_follow_deletes(db, client):
+    add_service(db, "2024-06", "食費")
+    add_service(db, "2024-06", "日用品")
+    with db:
+        assert register_item(db, make_item("2024-06-01", "食費", "牛乳", 200)) == ""
+        assert register_item(db, make_item("2024-06-05", "日用品", "牛乳", 210)) == ""
+        assert register_item(db, make_item("2024-06-03", "食費", "牛肉", 800)) == ""
+    assert get_item_name_suggestions(db, "牛") == [
+        {"item_name": "牛乳", "purchase_count": 2, "last_purchase_date": "2024-06-05"},
+        {"item_name": "牛肉", "purchase_count": 1, "last_purchase_date": "2024-06-03"},
+    ]
+
+    with db:
+        delete_item(db, get_item_id(db, "日用品", "牛乳"))
+    assert [(row["item_name"], row["purchase_count"]) for row in get_item_name_suggestions(db, "牛")] == [
+        ("牛乳", 1),
+        ("牛肉", 1),
+    ]
+    with db:
+        delete_item(db, get_item_id(db, "食費", "牛肉"))
+    response = client.get("/api/v1/items/autocomplete?q=牛")
+    assert response.status_code == 200
+    assert "牛肉" not in response.get_data(as_text=True)
@@ -0,0 +1,40 @@
+import threading
+
+from snapshot import SnapshotCache
+
+
+def test_building_one_household_does_not_block_others(monkeypatch):
+    # 世帯「slow」のスナップショットを作っている間も、世帯「fast」のリクエストは待たされない
+    started = threading.Event()
+    release = threading.Event()
+
+    def build_snapshot(db, snapshot=None):
+        if snapshot is not None:
+            return snapshot
+        if db == "slow":
+            started.set()
+            release.wait(5)
+        return [db]
+
+    monkeypatch.setattr("snapshot.build_snapshot", build_snapshot)
+    monkeypatch.setattr("snapshot.get_snapshot_path", lambda db: "")
+    monkeypatch.setattr("snapshot.is_snapshot_consistent", lambda db, snapshot: True)
+    cache = SnapshotCache()
+    slow_result = []
+    slow_thread = threading.Thread(target=lambda: slow_result.append(cache.get("slow", "slow")))
+    slow_thread.start()
+    try:
+        assert started.wait(5)
+        fast_result = []
+        fast_thread = threading.Thread(target=lambda: fast_result.append(cache.get("fast", "fast")))
+        fast_thread.start()
+        fast_thread.join(2)
+        assert fast_result == [["fast"]]
+    finally:
+        release.set()
+        slow_thread.join(5)
+    assert slow_result == [["slow"]]
+    assert cache.builds == 2
+    # 2回目は作り直さず、同じスナップショットを返す
+    assert cache.get("slow", "slow") is slow_result[0]
+    assert cache.builds == 2
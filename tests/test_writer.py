@@ -0,0 +1,125 @@
+import threading
+import time
+
+import pytest
+
+from conftest import connect
+from writer import WriteQueue
+
+
+def insert_note(db, text):
+    db.execute("insert into note (text) values (?)", [text])
+    return text
+
+
+def fail_after_insert(db, text):
+    db.execute("insert into note (text) values (?)", [text])
+    raise ValueError(text)
+
+
+@pytest.fixture
+def write_queue(database_path):
+    con = connect(database_path)
+    con.execute("create table note(text text not null)")
+    con.commit()
+    con.close()
+    write_queue = WriteQueue(lambda: connect(database_path))
+    yield write_queue
+    write_queue.close()
+
+
+def get_notes(database_path) -> list[str]:
+    con = connect(database_path)
+    try:
+        return [row[0] for row in con.execute("select text from note order by rowid")]
+    finally:
+        con.close()
+
+
+def test_submit_commits_and_returns_result(write_queue, database_path):
+    assert write_queue.submit(insert_note, "a") == "a"
+    assert get_notes(database_path) == ["a"]
+
+
+def test_failed_operation_is_rolled_back_without_affecting_batch(write_queue, database_path):
+    # 1つ目の処理が終わるまで待たせておき、その間に入れた処理を1つのトランザクションにまとめさせる
+    started = threading.Event()
+    release = threading.Event()
+
+    def wait(db):
+        started.set()
+        release.wait()
+
+    blocker = threading.Thread(target=write_queue.submit, args=(wait,))
+    blocker.start()
+    started.wait()
+    result_list = []
+
+    def submit(operation, text):
+        try:
+            result_list.append(write_queue.submit(operation, text))
+        except ValueError as e:
+            result_list.append(f"error:{e}")
+
+    thread_list = [
+        threading.Thread(target=submit, args=(insert_note, "b")),
+        threading.Thread(target=submit, args=(fail_after_insert, "c")),
+        threading.Thread(target=submit, args=(insert_note, "d")),
+    ]
+    for thread in thread_list:
+        thread.start()
+    while write_queue._queue.qsize() < len(thread_list):
+        time.sleep(0.01)
+    release.set()
+    for thread in [blocker] + thread_list:
+        thread.join()
+
+    assert sorted(result_list) == ["b", "d", "error:c"]
+    assert sorted(get_notes(database_path)) == ["b", "d"]
+    # 待たせていた処理と、その間に溜まった3つの処理の2回でコミットした
+    assert write_queue.stats()["batches"] == 2
+    assert write_queue.stats()["max_batch"] == 3
+
+
+def test_submit_after_close_raises(write_queue, database_path):
+    write_queue.submit(insert_note, "a")
+    write_queue.close()
+    with pytest.raises(RuntimeError):
+        write_queue.submit(insert_note, "b")
+    assert get_notes(database_path) == ["a"]
+
+
+def test_close_while_submitting_never_leaves_requests_waiting(write_queue, database_path):
+    # closeと同時に呼ばれたsubmitは、実行されるか RuntimeError になるかのどちらかで、待ったままにならない
+    result_list = []
+    start = threading.Event()
+
+    def submit(text):
+        start.wait()
+        try:
+            result_list.append(write_queue.submit(insert_note, text))
+        except RuntimeError:
+            result_list.append("closed")
+
+    thread_list = [threading.Thread(target=submit, args=(str(number),)) for number in range(50)]
+    for thread in thread_list:
+        thread.start()
+    start.set()
+    write_queue.close()
+    for thread in thread_list:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert len(result_list) == 50
+    # 実行された処理は全てコミットされ、閉じた後に書き込み用のスレッドが起動し直されることはない
+    assert sorted(get_notes(database_path)) == sorted(result for result in result_list if result != "closed")
+    assert write_queue._pid is None
+
+
+def test_requests_fail_when_writer_cannot_connect(database_path):
+    def connect_fails():
+        raise OSError("cannot open")
+
+    write_queue = WriteQueue(connect_fails)
+    with pytest.raises(OSError):
+        write_queue.submit(insert_note, "a")
+    write_queue.close()
@@ -1,6 +1,18 @@
 import datetime
 import sqlite3
 
+from aggregate import get_monthly_upper_limit_and_usage
+from config import ITEM_ATTRIBUTE_LIST
+
+# 商品の入力項目（一括登録のファイルの列・APIで送る商品の項目）
+ITEM_COLUMN_LIST = [
+    "purchase_date",
+    "service_name",
+    "item_name",
+    "item_price",
+    "item_attribute",
+]
+
 
 def get_current_yyyymm() -> str:  # 年と月を取得する
     tokyo_tz = datetime.timezone(datetime.timedelta(hours=9))
@@ -10,6 +22,42 @@ def get_current_yyyymm() -> str:  # 年と月を取得する
     return year + "-" + month
 
 
+# ここから月のカレンダーの計算
+# 年月を「西暦0年1月から数えて何か月目か」の通し番号にすると、月の足し引きや月数の計算が整数の計算になる
+def get_month_number(yyyymm: str) -> int:
+    return int(yyyymm[:4]) * 12 + int(yyyymm[5:7]) - 1
+
+
+def get_yyyymm_from_month_number(month_number: int) -> str:
+    return "{:04}-{:02}".format(month_number // 12, month_number % 12 + 1)
+
+
+def add_months(yyyymm: str, months: int) -> str:  # monthsか月後（負なら前）の年月
+    return get_yyyymm_from_month_number(get_month_number(yyyymm) + months)
+
+
+def get_next_yyyymm(yyyymm: str) -> str:  # 翌月を "YYYY-MM" の形で取得する
+    return add_months(yyyymm, 1)
+
+
+def get_previous_yyyymm(yyyymm: str) -> str:  # 前月を "YYYY-MM" の形で取得する
+    return add_months(yyyymm, -1)
+
+
+def get_yyyymm_list(first_yyyymm: str, last_yyyymm: str) -> list[str]:
+    # first_yyyymm から last_yyyymm まで（両端を含む）の年月のリスト
+    return [
+        get_yyyymm_from_month_number(month_number)
+        for month_number in range(get_month_number(first_yyyymm), get_month_number(last_yyyymm) + 1)
+    ]
+
+
+def get_month_date_range(yyyymm: str) -> tuple[str, str]:
+    # その月の購入日を [月初, 翌月初) の半開区間で表す
+    # purchase_date like 'YYYY-MM%' と違い、purchase_dateのインデックスを範囲検索で使える
+    return yyyymm + "-01", get_next_yyyymm(yyyymm) + "-01"
+
+
 def is_there_empty_entry(entry_list: list[str]) -> bool:
     for entry in entry_list:
         if entry == "":
@@ -17,49 +65,42 @@ def is_there_empty_entry(entry_list: list[str]) -> bool:
     return False
 
 
-def get_total_usage_info(
-    service_detail_list: list[sqlite3.Row], item_detail_list: list[sqlite3.Row]
-):
+def validate_item_row(item: dict) -> str:
+    # 一括登録の1行分・APIで送られた1件分の入力をチェックし、エラーメッセージを返す（問題がなければ空文字）
+    if is_there_empty_entry([item[column] for column in ITEM_COLUMN_LIST]):
+        return "全て入力してください"
+    try:
+        item["purchase_date"] = datetime.date.fromisoformat(
+            item["purchase_date"].replace("/", "-")
+        ).isoformat()
+    except ValueError:
+        return f"購入日の形式が正しくありません：{item['purchase_date']}"
+    try:
+        item["item_price"] = int(item["item_price"].replace(",", ""))
+    except ValueError:
+        return f"値段が数値ではありません：{item['item_price']}"
+    if item["item_price"] < 1:
+        return "値段は1円以上にしてください"
+    if item["item_attribute"] not in ITEM_ATTRIBUTE_LIST:
+        return f"購入者は{'・'.join(ITEM_ATTRIBUTE_LIST)}のどれかにしてください"
+    return ""
+
+
+def get_total_usage_info(db: sqlite3.Connection):
     # 毎月登録している商品とサービスについて、使用額と上限額の合計を出す
-    # いくら節約できたかを可視化したいので、サービスの上限金額が記録されている月だけ選ぶ
-    recorded_year_month_list = list(
-        set([service_detail["year_month"] for service_detail in service_detail_list])
-    )
-    recorded_year_month_list.sort()
-
-    total_upper_limit_and_usage_for_each_month = {}
-    for year_month in recorded_year_month_list:
-        total_upper_limit_and_usage_for_each_month[year_month] = {
-            "total_upper_limit": 0,
-            "total_usage": 0,
-        }
-
-    for service_detail in service_detail_list:
-        total_upper_limit_and_usage_for_each_month[service_detail["year_month"]][
-            "total_upper_limit"
-        ] += service_detail["upper_limit"]
-
-    for item_detail in item_detail_list:
-        # サービスの使用上限金額が決まっている月に購入された商品のみ購入する
-        if (
-            item_detail["purchase_date"][:7]
-            in total_upper_limit_and_usage_for_each_month
-        ):
-            total_upper_limit_and_usage_for_each_month[
-                item_detail["purchase_date"][:7]
-            ]["total_usage"] += item_detail["item_price"]
-
-    total_upper_limit = [
-        total_upper_limit_and_usage["total_upper_limit"]
-        for total_upper_limit_and_usage in total_upper_limit_and_usage_for_each_month.values()
-    ]
-    total_usage = [
-        total_upper_limit_and_usage["total_usage"]
-        for total_upper_limit_and_usage in total_upper_limit_and_usage_for_each_month.values()
-    ]
+    # 集計はaggregate.pyでSQLiteの中で行う
+    (
+        recorded_year_month_list,
+        total_upper_limit,
+        total_usage,
+    ) = get_monthly_upper_limit_and_usage(db)
     sum_of_total_upper_limit = sum(total_upper_limit)
     sum_of_total_usage = sum(total_usage)
-    usage_ratio = round((sum_of_total_usage * 100) / sum_of_total_upper_limit, 1)
+    # まだ何も記録されていない（上限金額の合計が0の）場合は使用率を出せないのでNoneにする
+    if sum_of_total_upper_limit == 0:
+        usage_ratio = None
+    else:
+        usage_ratio = round((sum_of_total_usage * 100) / sum_of_total_upper_limit, 1)
 
     return (
         recorded_year_month_list,
@@ -71,13 +112,27 @@ def get_total_usage_info(
     )
 
 
+def get_usage_ratio(current_usage: int, upper_limit: int):
+    # 上限金額が0のときは使用率を出せないのでNoneにする
+    if upper_limit == 0:
+        return None
+    return round(current_usage * 100 / upper_limit, 1)
+
+
+def format_usage_ratio(usage_ratio) -> tuple[str, str]:
+    # 画面の使用率のバーの幅と表示する文字（使用率を出せないときは幅0で「-」）
+    if usage_ratio is None:
+        return "width:0%", "-"
+    return f"width:{usage_ratio}%", f"{usage_ratio}%"
+
+
 def add_usage_info_to_service_detail(service_detail: sqlite3.Row, current_usage: int):
     # 月のサービスの上限金額と、そのサービスで買った商品の合計金額を元に、使用率を計算する
     service_name = service_detail["service_name"]
     upper_limit = service_detail["upper_limit"]
-    usage_ratio = round((current_usage * 100 / upper_limit), 1)
-    text_style_usage_ratio = f"width:{usage_ratio}%"
-    usage_ratio_with_percent = f"{usage_ratio}%"
+    text_style_usage_ratio, usage_ratio_with_percent = format_usage_ratio(
+        get_usage_ratio(current_usage, upper_limit)
+    )
 
     return {
         "service_name": service_name,
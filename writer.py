@@ -0,0 +1,166 @@
+import contextvars
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from config import WRITER_MAX_BATCH_SIZE
+
+# 書き込みを1つのスレッドにまとめる（シングルライター）
+# リクエストは書き込み処理（operation）をキューに入れて結果を待つ
+# 書き込み用のスレッドは溜まっている処理をまとめて1つのトランザクションで実行し、1回だけコミットする（グループコミット）
+# 処理ごとにSAVEPOINTを作るので、1つの処理が失敗しても同じトランザクションの他の処理には影響しない
+#
+# operationは db を最初の引数に取る関数で、その中ではコミット・ロールバックをしないこと
+
+
+class WriteRequest:
+    def __init__(self, operation, args, kwargs):
+        self.operation = operation
+        self.args = args
+        self.kwargs = kwargs
+        # リクエスト中のSQLの計測（metrics.py）が書き込み用のスレッドでも効くように、呼び出し元のコンテキストで実行する
+        self.context = contextvars.copy_context()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class WriteQueue:
+    def __init__(self, connect, max_batch_size: int = WRITER_MAX_BATCH_SIZE):
+        # connectは書き込み専用の接続を返す関数
+        self.connect = connect
+        self.max_batch_size = max_batch_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._closed = False
+        self.batches = 0
+        self.operations = 0
+        self.max_batch = 0
+        self.commit_time = 0.0
+
+    def _ensure_started(self):
+        # fork後の子プロセスではスレッドが引き継がれないので、プロセスごとに起動し直す（_lockを持って呼ぶ）
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, args=(self._queue,), daemon=True)
+        self._thread.start()
+
+    def submit(self, operation, *args, **kwargs):
+        # 処理がコミットされるまで待ち、operationの戻り値を返す（例外はそのまま投げ直す）
+        # 停止の確認とキューへの追加を_lockの中で行うので、closeと同時に呼ばれても停止の合図より後ろには入らない
+        write_request = WriteRequest(operation, args, kwargs)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("書き込み用のキューは停止しています")
+            self._ensure_started()
+            self._queue.put(write_request)
+        write_request.done.wait()
+        if write_request.error is not None:
+            raise write_request.error
+        return write_request.result
+
+    def close(self):
+        # 溜まっている処理を全て実行してからスレッドを止める
+        # _closedにしてから停止の合図を入れるので、この後のsubmitはキューに入らずにエラーになる
+        with self._lock:
+            self._closed = True
+            if self._pid != os.getpid():
+                return
+            self._pid = None
+            write_queue = self._queue
+            thread = self._thread
+            write_queue.put(None)
+        # スレッドが止まるときに_lockを使うので、待つのはロックの外で行う
+        thread.join()
+        # スレッドが途中で止まっていた場合に、残った処理を待たせたままにしない
+        with self._lock:
+            self._fail_pending(write_queue, RuntimeError("書き込み用のキューは停止しています"))
+
+    def _fail_pending(self, write_queue: queue.Queue, error: BaseException):
+        # キューに残っている処理を全て失敗にする（_lockを持って呼ぶ）
+        while True:
+            try:
+                write_request = write_queue.get_nowait()
+            except queue.Empty:
+                return
+            if write_request is not None:
+                write_request.error = error
+                write_request.done.set()
+
+    def _run(self, write_queue: queue.Queue):
+        try:
+            db = self.connect()
+        except BaseException as e:
+            # 接続できなかったエラーは、待っている処理に返す
+            self._stop_after_error(write_queue, e)
+            return
+        # BEGIN・COMMIT・SAVEPOINTは自分で発行する
+        db.isolation_level = None
+        stopping = False
+        try:
+            while not stopping:
+                batch = [write_queue.get()]
+                while len(batch) < self.max_batch_size:
+                    try:
+                        batch.append(write_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if None in batch:
+                    stopping = True
+                    batch = [write_request for write_request in batch if write_request is not None]
+                if batch:
+                    self._run_batch(db, batch)
+        except BaseException as e:
+            self._stop_after_error(write_queue, e)
+        finally:
+            db.close()
+
+    def _stop_after_error(self, write_queue: queue.Queue, error: BaseException):
+        # スレッドが止まるときは、残った処理を失敗にし、次のsubmitで起動し直せるようにする
+        with self._lock:
+            if self._queue is write_queue:
+                self._pid = None
+            self._fail_pending(write_queue, error)
+
+    def _run_batch(self, db: sqlite3.Connection, batch: list):
+        started_at = time.perf_counter()
+        try:
+            db.execute("begin immediate")
+            for write_request in batch:
+                db.execute("savepoint write_operation")
+                try:
+                    write_request.result = write_request.context.run(
+                        write_request.operation, db, *write_request.args, **write_request.kwargs
+                    )
+                except Exception as e:
+                    write_request.error = e
+                    db.execute("rollback to write_operation")
+                db.execute("release write_operation")
+            db.execute("commit")
+        except BaseException as e:
+            # BEGINやCOMMITに失敗した場合は、まとめた処理の全てを失敗にする
+            if db.in_transaction:
+                db.execute("rollback")
+            for write_request in batch:
+                write_request.result = None
+                write_request.error = e
+        finally:
+            self.batches += 1
+            self.operations += len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+            self.commit_time += time.perf_counter() - started_at
+            for write_request in batch:
+                write_request.done.set()
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "operations": self.operations,
+            "max_batch": self.max_batch,
+            "average_batch": round(self.operations / self.batches, 2) if self.batches else 0,
+            "commit_time": round(self.commit_time, 6),
+        }